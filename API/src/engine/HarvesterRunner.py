@@ -0,0 +1,194 @@
+'''
+Created on 19 Oct 2026
+
+Runs the harvests of all the active webservices, each as often as its
+frequency says, several webservices at once.
+
+Each webservice is harvested incrementally from its watermark (see
+H_QueryInvoker.execute_incremental), no further than its end_date, and with at
+least its wait_window (in seconds) between the requests made to its host. Every
+harvest is recorded in the history index, with when it started and finished,
+how long it took and how many records it found. A webservice whose harvest
+failed is tried again after HARVEST_RETRY_DELAY, backing off further while it
+keeps failing. Once a webservice has been harvested up to its end_date it is no
+longer due.
+
+Run it on its own to keep harvesting:
+
+    cd API/src
+    PYTHONPATH=../../OAUtils/src python -m engine.HarvesterRunner
+
+Using config static:
+DB_NAME
+WEBSERVICES_INDEX_NAME
+WEBSERVICES_DOCTYPE_NAME
+HISTORY_INDEX_NAME
+HISTORY_DOCTYPE_NAME
+HARVEST_WEBSERVICE_CONCURRENCY
+HARVEST_POLL_INTERVAL
+HARVEST_FREQUENCY_DAYS
+HARVEST_RETRY_DELAY
+
+'''
+from datetime import date, timedelta
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+import time
+from engine.query.QueryInvoker import H_QueryInvoker
+from engine.query.Watermark import H_Watermark, from_millis
+from utils.invoker.invoker import set_wait_window
+import utils.logger.handler as LH
+from utils.config import DB_NAME, ACTIVE_WS_PROVIDER_QUERY, WEBSERVICES_INDEX_NAME, WEBSERVICES_DOCTYPE_NAME, \
+    HISTORY_INDEX_NAME, HISTORY_DOCTYPE_NAME, HARVEST_WEBSERVICE_CONCURRENCY, HARVEST_POLL_INTERVAL, \
+    HARVEST_FREQUENCY_DAYS, HARVEST_RETRY_DELAY
+
+
+class H_HarvesterRunner(object):
+
+    def __init__(self, db, concurrency = HARVEST_WEBSERVICE_CONCURRENCY, poll = HARVEST_POLL_INTERVAL):
+        """
+        Values:
+            db - DB connection
+            concurrency - most webservices harvested at once
+            poll - seconds between checks for webservices which are due
+        """
+        self._db = db
+        self._pool = ThreadPool(concurrency)
+        self._running = set()
+        self._lock = Lock()
+        self.poll = poll
+
+    def webservices(self):
+        """
+        Load the active webservices
+
+        Returns:
+            list of tuples of webservice id and record
+        """
+        hits = self._db.execute_search_query_scan(WEBSERVICES_INDEX_NAME, WEBSERVICES_DOCTYPE_NAME,
+                                                  ACTIVE_WS_PROVIDER_QUERY)
+        return [(hit['_id'], hit['_source']) for hit in hits if hit['_source'].get('active')]
+
+    def history(self, name_ws):
+        """
+        The latest harvests of a webservice
+
+        Returns:
+            list of history records, the latest first
+        """
+        query = {"query": {"match": {"name_ws": {"query": name_ws, "operator": "and"}}}}
+        result = self._db.execute_search_query_sort_pag(HISTORY_INDEX_NAME, HISTORY_DOCTYPE_NAME, query,
+                                                        size=10, offset=0, sort='date:desc')
+        return [hit['_source'] for hit in result['hits'] if hit['_source'].get('name_ws') == name_ws]
+
+    def last_run(self, name_ws):
+        """
+        When the last successful harvest of a webservice started
+
+        Returns:
+            seconds since the epoch, or None if it has never been harvested
+        """
+        for source in self.history(name_ws):
+            if not source.get('error'):
+                return _started(source)
+        return None
+
+    def is_due(self, webservice, now = None):
+        """
+        Check if a webservice is due to be harvested, by its frequency, or, if its last harvest failed, once
+        HARVEST_RETRY_DELAY has passed since that harvest started (doubled for each further failure in a row).
+        A webservice which has been harvested up to its end_date is never due.
+
+        Args:
+            webservice - the webservice record
+            now - the time, in seconds since the epoch
+        """
+        now = time.time() if now is None else now
+        if webservice.get('end_date') is not None:
+            # there is nothing left to harvest, and a harvest would write no history to say when it ran
+            watermark = H_Watermark.load(self._db, webservice['name'])
+            if watermark.date is not None and watermark.date >= from_millis(webservice['end_date']):
+                return False
+        history = self.history(webservice['name'])
+        days = HARVEST_FREQUENCY_DAYS.get(webservice.get('frequency'), 1)
+        # allow a poll's slack, so the harvests don't drift later each time
+        interval = days * 86400 - self.poll
+        failures = 0
+        while failures < len(history) and history[failures].get('error'):
+            failures += 1
+        if failures > 0:
+            return now - _started(history[0]) >= min(HARVEST_RETRY_DELAY * 2 ** (failures - 1), interval)
+        if len(history) == 0:
+            return True
+        return now - _started(history[0]) >= interval
+
+    def start_due(self, now = None):
+        """
+        Start harvesting every webservice which is due and isn't already being harvested
+
+        Returns:
+            list of AsyncResult, one for each harvest started
+        """
+        started = []
+        for ws_id, webservice in self.webservices():
+            with self._lock:
+                if ws_id in self._running:
+                    continue
+            if not self.is_due(webservice, now):
+                continue
+            with self._lock:
+                self._running.add(ws_id)
+            LH.logger.info("Starting harvest of %s" % webservice['name'])
+            started.append(self._pool.apply_async(self._harvest, (ws_id, webservice)))
+        return started
+
+    def run_once(self, now = None):
+        """
+        Harvest every webservice which is due, and wait for them all to finish
+
+        Returns:
+            list of tuples of webservice name, number of records found and the error, if it failed
+        """
+        return [result.get() for result in self.start_due(now)]
+
+    def run_forever(self):
+        """Keep starting the harvests of the webservices as they become due"""
+        while True:
+            try:
+                self.start_due()
+            except Exception as err:
+                LH.logger.error("Could not check which webservices are due: %s" % str(err))
+            time.sleep(self.poll)
+
+    def close(self):
+        """Wait for the running harvests to finish"""
+        self._pool.close()
+        self._pool.join()
+
+    def _harvest(self, ws_id, webservice):
+        name = webservice['name']
+        try:
+            set_wait_window(webservice['url'], webservice.get('wait_window') or 0)
+            date_end = date.today() - timedelta(days=1)
+            if webservice.get('end_date') is not None:
+                date_end = min(date_end, from_millis(webservice['end_date']))
+            found, watermark = H_QueryInvoker.execute_incremental(webservice['engine'], self._db, name,
+                                                                   webservice['url'], date_end)
+            LH.logger.info("Harvested %s records from %s, now up to %s" % (found, name, watermark.date))
+            return name, found, None
+        except Exception as err:
+            LH.logger.error("Harvest of %s failed: %s" % (name, str(getattr(err, 'message', err))))
+            return name, 0, err
+        finally:
+            with self._lock:
+                self._running.discard(ws_id)
+
+
+def _started(source):
+    """When the harvest of a history record started, in seconds since the epoch"""
+    return source.get('started', source['date']) / 1000.0
+
+
+if __name__ == "__main__":
+    from utils.connector.connector import U_DBConnection
+    H_HarvesterRunner(U_DBConnection().get_connection(DB_NAME)).run_forever()
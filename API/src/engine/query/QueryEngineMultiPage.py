@@ -10,15 +10,52 @@ Using config static:
 DB_NAME
 TEMPORARY_INDEX_NAME
 TEMPORARY_DOCTYPE_NAME
+HARVEST_SLICE_DAYS
+HARVEST_CONCURRENCY
+HARVEST_BULK_CHUNK
 
 @author: Mateusz.Kasiuba
 '''
 from engine.query.QueryEngine import H_QueryEngine
 
 from datetime import date, timedelta
+from multiprocessing.pool import ThreadPool
+from threading import Thread, Lock
+from urllib import quote
 from utils.invoker.invoker import U_WSInvoker
+from engine.query.Watermark import H_Watermark
 import utils.logger.handler as LH
-from utils.config import TEMPORARY_DOCTYPE_NAME, TEMPORARY_INDEX_NAME
+import utils.exception.handler as EH
+from utils.config import TEMPORARY_DOCTYPE_NAME, TEMPORARY_INDEX_NAME, HARVEST_SLICE_DAYS, HARVEST_CONCURRENCY, HARVEST_BULK_CHUNK
+
+
+class _Prefetch(object):
+    """Runs a call in a background thread, and hands back its result (or raises its exception) when asked"""
+
+    def __init__(self, fn, *args):
+        self._result = None
+        self._error = None
+        self._thread = Thread(target=self._run, args=(fn, args))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, fn, args):
+        try:
+            self._result = fn(*args)
+        except Exception as err:
+            self._error = err
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def close(self):
+        """Give up on the result, closing it once the call has finished, if it can be"""
+        self._thread.join()
+        if hasattr(self._result, 'close'):
+            self._result.close()
 
 
 class H_QueryEngineMultiPage(H_QueryEngine):
@@ -40,42 +77,186 @@ class H_QueryEngineMultiPage(H_QueryEngine):
         if(0 == date_end):
             date_end = date.today().replace(day=1)
 
-        self.__current_page = 1
         self.__api_query = ''
         self.__pageSize = 1000
         self._date_start = date_start
         self._date_end = date_end
         self._db = DB
+        self._url_template = url
         self._url = url.format(
                                start_date = self._date_start.isoformat(), 
                                end_date = self._date_end.isoformat()
                                )
+        self.slice_days = HARVEST_SLICE_DAYS
+        self.concurrency = HARVEST_CONCURRENCY
+        self.resume = None
+        self.received = 0
+        self.hits = 0
+        self._progress = {}
+        self._lock = Lock()
 
     def execute(self):
         """
         Import all data from EPMC using setted variables
 
+        The date range is split into slices of slice_days, which are harvested independently, up to concurrency
+        of them at once. Each slice is walked with EPMC's cursorMark, so deep pages are not re-scanned, and the
+        next page of a slice is downloaded while the current one is being inserted.
+
         Params:
             DB - Object of H_DBConnection
 
         Returns:
-            Boolean
+            Number of records harvested (also kept in received, which counts them as they are inserted, so
+            says how far a harvest which failed got). The number EPMC reports it holds for the range (the
+            hitCount of the first page of each slice, including any records before a resumed cursor) is
+            kept in hits.
         """
-        invoker = U_WSInvoker()
-        self.__pageSize = 1000
+        self._progress = {}
+        self.received = 0
+        self.hits = 0
+        slices = self._slices()
+        if self.concurrency <= 1 or len(slices) == 1:
+            return sum([self._harvest_slice(s) for s in slices])
+        pool = ThreadPool(min(self.concurrency, len(slices)))
+        try:
+            return sum(pool.map(self._harvest_slice, slices))
+        finally:
+            pool.close()
+            pool.join()
+
+    def _slices(self):
+        """Split the date range into consecutive, non-overlapping (EPMC date ranges are inclusive) slices"""
+        slices = []
+        start = self._date_start
         while True:
-            self._bulid_query()
-            LH.logger.info("Execute: %s" % self.__api_query)
-            data = invoker.retrieve_information_json(self.__api_query)
-            if(0 == len(data['resultList']['result'])):
-                break
-            self._db.execute_bulk_insert_query(TEMPORARY_INDEX_NAME, TEMPORARY_DOCTYPE_NAME, data['resultList']['result'])
-            self.__current_page += 1
-        return data['hitCount']
-
-    def _bulid_query(self):
-        """Bulid default url and put the start and end date - without page and page number"""
-        self.__api_query = self._url + '&pageSize=%s&page=%s' % (str(self.__pageSize),str(self.__current_page))
+            end = min(start + timedelta(days=max(self.slice_days, 1) - 1), self._date_end)
+            slices.append((start, end))
+            if end >= self._date_end:
+                return slices
+            start = end + timedelta(days=1)
+
+    def watermark(self):
+        """
+        How far the last execute got: the last date up to which every slice was harvested and inserted, and, if
+        the slice after that was started, the cursor to carry on from in it
+
+        Returns:
+            H_Watermark
+        """
+        watermark = H_Watermark(date = self._date_start - timedelta(days=1))
+        for date_range in self._slices():
+            state = self._progress.get(date_range)
+            if state is True:
+                watermark.date = date_range[1]
+                continue
+            if state is not None:
+                watermark.cursor = state
+                watermark.cursor_start, watermark.cursor_end = date_range
+            break
+        return watermark
+
+    def _record_progress(self, date_range, state):
+        """Note that a slice is finished (state True) or has been inserted up to a cursor"""
+        with self._lock:
+            self._progress[date_range] = state
+
+    def _insert(self, batch):
+        """
+        Insert a batch of records, and count them as received
+
+        Raises:
+            GenericError if any of them could not be inserted, so that the slice's progress is not moved past them
+        """
+        summary = self._db.execute_bulk_insert_query(TEMPORARY_INDEX_NAME, TEMPORARY_DOCTYPE_NAME, batch, refresh=False)
+        if summary is not None and summary.get('failed', 0) > 0:
+            raise EH.GenericError("Bulk insert failed", "%s of %s records could not be inserted" % (summary['failed'], len(batch)))
+        with self._lock:
+            self.received += len(batch)
+        return len(batch)
+
+    def _harvest_slice(self, date_range):
+        """
+        Import all the records in one slice of the date range
+
+        Each page is parsed as it arrives, rather than read whole and then decoded, and its records are
+        inserted in batches of HARVEST_BULK_CHUNK. The index is left to refresh itself, rather than being
+        refreshed after every batch. Records are inserted as they are, without checking for duplicates (the
+        router's duplicate keys aren't available here), so a range harvested again is inserted again.
+
+        Args:
+            date_range - tuple of start and end date
+
+        Returns:
+            Number of records harvested from the slice (by this run, so not those before a resumed cursor)
+        """
+        url = self._url_template.format(start_date = date_range[0].isoformat(),
+                                        end_date = date_range[1].isoformat())
+        invoker = U_WSInvoker()
+        cursor = '*'
+        if self.resume is not None and self.resume.resumes(date_range):
+            LH.logger.info("Carrying on from cursor %s in %s to %s" % (self.resume.cursor, date_range[0], date_range[1]))
+            cursor = self.resume.cursor
+        page = self._fetch(invoker, url, cursor)
+        prefetch = None
+        received = 0
+        hits = None
+        try:
+            while True:
+                prefetch = None
+                count = 0
+                batch = []
+                for record in page.results():
+                    if(0 == count):
+                        # start on the next page while this one is read and inserted
+                        prefetch = self._prefetch(invoker, url, cursor, page.header)
+                    count += 1
+                    batch.append(record)
+                    if len(batch) >= HARVEST_BULK_CHUNK:
+                        received += self._insert(batch)
+                        batch = []
+                if len(batch) > 0:
+                    received += self._insert(batch)
+                if hits is None:
+                    hits = page.header.get('hitCount', 0)
+                    with self._lock:
+                        self.hits += hits
+                if(0 == count):
+                    break
+                if prefetch is None:
+                    prefetch = self._prefetch(invoker, url, cursor, page.header)
+                if prefetch is None:
+                    break
+                cursor = page.header['nextCursorMark']
+                self._record_progress(date_range, cursor)
+                page = prefetch.result()
+                prefetch = None
+        finally:
+            # if the slice stopped part way, neither the page it was on nor the next one will be read
+            page.close()
+            if prefetch is not None:
+                prefetch.close()
+        self._record_progress(date_range, True)
+        return received
+
+    def _prefetch(self, invoker, url, cursor, header):
+        """Start fetching the page after the current one, if the current one says where that is"""
+        next_cursor = header.get('nextCursorMark')
+        if next_cursor is None or next_cursor == cursor:
+            return None
+        return _Prefetch(self._fetch, invoker, url, next_cursor)
+
+    def _fetch(self, invoker, url, cursor):
+        query = self._bulid_query(url, cursor)
+        LH.logger.info("Execute: %s" % query)
+        return invoker.retrieve_information_json_stream(query)
+
+    def _bulid_query(self, url=None, cursor='*'):
+        """Bulid default url and put the start and end date, page size and cursor"""
+        if url is None:
+            url = self._url
+        self.__api_query = url + '&pageSize=%s&cursorMark=%s' % (str(self.__pageSize), quote(cursor, safe=''))
+        return self.__api_query
 
 
 #.##.....##....###....##.......####....###....########..########.########
@@ -6,8 +6,12 @@ Engine invoker
 @author: Mateusz.Kasiuba
 '''
 from engine.query.QueryEngineMultiPage import H_QueryEngineMultiPage
-from utils.config import MULTI_PAGE, DB_NAME
+from engine.query.Watermark import H_Watermark, to_millis
+from utils.config import MULTI_PAGE, DB_NAME, DAYS_TO_START_FROM
 from utils.connector.connector import U_DBConnection
+from datetime import date, timedelta
+import time
+import utils.logger.handler as LH
 
 
 class H_QueryInvoker():
@@ -25,4 +29,63 @@ class H_QueryInvoker():
         if(engine_name == MULTI_PAGE):
             return H_QueryEngineMultiPage(DB,url).valid()
         
-        raise ValueError('Engine %s do not exists!'% engine_name)
\ No newline at end of file
+        raise ValueError('Engine %s do not exists!'% engine_name)
+    
+    @staticmethod
+    def execute_incremental(engine_name, db, name_ws, url, date_end = 0, backfill_from = None):
+        """
+        Harvest a webservice from where its last harvest got to (its watermark), up to date_end (by default
+        yesterday, the last complete day), and record in the history index how far this harvest got.
+
+        In backfill mode (backfill_from given) everything from backfill_from is harvested again, whatever the
+        watermark says; the watermark is only moved on if the backfill gets past it.
+
+        The history record also holds when the harvest started and finished, how long it took (in seconds), the
+        number of records received (inserted), even if the harvest failed part way, and the number the
+        webservice reported it holds for the range (num_files_found), to compare them with.
+
+        Returns:
+            tuple of the number of records received and the new H_Watermark
+        """
+        if(0 == date_end):
+            date_end = date.today() - timedelta(days=1)
+        previous = H_Watermark.load(db, name_ws)
+        if backfill_from is not None:
+            date_start = backfill_from
+        elif previous.date is not None:
+            date_start = previous.date + timedelta(days=1)
+        else:
+            date_start = date.today() - timedelta(days=DAYS_TO_START_FROM)
+        if date_start > date_end:
+            LH.logger.info("%s is already harvested up to %s" % (name_ws, previous.date))
+            return 0, previous
+
+        engine = H_QueryInvoker.get_engine(engine_name, db, url, date_start, date_end)
+        if backfill_from is None:
+            engine.resume = previous
+        record = {
+            'url': url,
+            'start_date': to_millis(date_start),
+            'end_date': to_millis(date_end),
+            'backfill': backfill_from is not None
+        }
+        found = 0
+        started = time.time()
+        record['started'] = int(started * 1000)
+        try:
+            found = engine.execute()
+        except Exception as err:
+            record['error'] = str(getattr(err, 'message', err))
+            raise
+        finally:
+            finished = time.time()
+            record['num_files_received'] = engine.received
+            record['num_files_found'] = engine.hits
+            LH.logger.info("%s: received %s of the %s records found from %s to %s" % (name_ws, engine.received, engine.hits, date_start, date_end))
+            record['finished'] = int(finished * 1000)
+            record['duration'] = round(finished - started, 3)
+            watermark = engine.watermark()
+            if backfill_from is not None:
+                watermark = previous.later(watermark)
+            watermark.save(db, name_ws, record)
+        return found, watermark
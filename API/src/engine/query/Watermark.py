@@ -0,0 +1,135 @@
+'''
+Created on 19 Oct 2026
+
+High-watermark of the harvests of a webservice: the last date up to which
+everything has been harvested and inserted, and, if a harvest stopped part way
+through the slice after that, the cursor to carry on from in it.
+
+It is kept on the webservice's records in the history index, so the next
+harvest can start from where the last one got to.
+
+Using config static:
+HISTORY_INDEX_NAME
+HISTORY_DOCTYPE_NAME
+
+'''
+from datetime import datetime
+import calendar
+import time
+import utils.logger.handler as LH
+from utils.config import HISTORY_INDEX_NAME, HISTORY_DOCTYPE_NAME
+
+
+def to_millis(value):
+    """Date (or datetime) as milliseconds since the epoch, as dates are held in the history index"""
+    return calendar.timegm(value.timetuple()) * 1000
+
+
+def from_millis(value):
+    """Date from milliseconds since the epoch (or a YYYY-MM-DD string), as held in the history index"""
+    if isinstance(value, basestring):
+        return datetime.strptime(value[:10], "%Y-%m-%d").date()
+    return datetime.utcfromtimestamp(int(value) / 1000).date()
+
+
+class H_Watermark(object):
+
+    def __init__(self, date=None, cursor=None, cursor_start=None, cursor_end=None):
+        """
+        Values:
+            date - last date harvested completely, or None if never harvested
+            cursor - cursor to carry on from in the slice after date
+            cursor_start - start date of the slice the cursor belongs to
+            cursor_end - end date of the slice the cursor belongs to
+        """
+        self.date = date
+        self.cursor = cursor
+        self.cursor_start = cursor_start
+        self.cursor_end = cursor_end
+
+    def resumes(self, date_range):
+        """
+        Check if the cursor carries on a harvest of the given slice (cursors are only good for the
+        query they came from)
+        """
+        return self.cursor is not None and (self.cursor_start, self.cursor_end) == tuple(date_range)
+
+    def later(self, other):
+        """Get whichever of this and the other watermark has got further"""
+        if other is None or other.date is None:
+            return self
+        if self.date is None or other.date > self.date:
+            return other
+        if other.date == self.date and self.cursor is None:
+            return other
+        return self
+
+    def fields(self):
+        """
+        The watermark as fields of a history record
+
+        Returns:
+            dict
+        """
+        fields = {}
+        if self.date is not None:
+            fields['watermark_date'] = to_millis(self.date)
+        if self.cursor is not None:
+            fields['watermark_cursor'] = self.cursor
+            fields['watermark_cursor_start'] = to_millis(self.cursor_start)
+            fields['watermark_cursor_end'] = to_millis(self.cursor_end)
+        return fields
+
+    @classmethod
+    def load(cls, db, name_ws):
+        """
+        Get the watermark from the latest history record of a webservice which has one
+
+        Args:
+            db - DB connection
+            name_ws - name of the webservice
+
+        Returns:
+            H_Watermark, with no date if the webservice has never been harvested
+        """
+        query = {
+            "query": {
+                "filtered": {
+                    "query": {"match": {"name_ws": {"query": name_ws, "operator": "and"}}},
+                    "filter": {"exists": {"field": "watermark_date"}}
+                }
+            }
+        }
+        result = db.execute_search_query_sort_pag(HISTORY_INDEX_NAME, HISTORY_DOCTYPE_NAME, query,
+                                                  size=10, offset=0, sort='date:desc')
+        for hit in result['hits']:
+            source = hit['_source']
+            # name_ws is analysed, so the match may find other webservices with similar names
+            if source.get('name_ws') != name_ws:
+                continue
+            watermark = cls(date = from_millis(source['watermark_date']))
+            if source.get('watermark_cursor') is not None:
+                watermark.cursor = source['watermark_cursor']
+                watermark.cursor_start = from_millis(source['watermark_cursor_start'])
+                watermark.cursor_end = from_millis(source['watermark_cursor_end'])
+            return watermark
+        return cls()
+
+    def save(self, db, name_ws, record=None):
+        """
+        Record the watermark in a new history record for the webservice
+
+        Args:
+            db - DB connection
+            name_ws - name of the webservice
+            record - other fields of the history record
+
+        Returns:
+            DB response
+        """
+        body = dict(record or {})
+        body['date'] = body.get('date', int(time.time() * 1000))
+        body['name_ws'] = name_ws
+        body.update(self.fields())
+        LH.logger.info("Watermark of %s is now %s (cursor %s)" % (name_ws, self.date, self.cursor))
+        return db.execute_insert_query(HISTORY_INDEX_NAME, HISTORY_DOCTYPE_NAME, body)
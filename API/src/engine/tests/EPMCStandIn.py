@@ -0,0 +1,216 @@
+'''
+Created on 19 Oct 2026
+
+Local stand-in for the EPMC search webservice, so that harvesting can be run and
+benchmarked offline.
+
+It answers search requests in the same form as EPMC (parameters either in the
+path, as in WEBSERVICES_DATA['url'], or the query string) with generated records,
+a given number for each day of the CREATION_DATE range in the query. Both the
+page and the cursorMark styles of paging are supported.
+
+Run it on its own to benchmark H_QueryEngineMultiPage against it:
+
+    cd API/src
+    PYTHONPATH=../../OAUtils/src python -m engine.tests.EPMCStandIn --days 28 --per-day 500
+
+'''
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from threading import Thread
+from datetime import date, datetime, timedelta
+from collections import OrderedDict
+import urlparse
+import json
+import re
+import time
+# strptime imports this lazily, which can fail if that first happens on two threads at once
+import _strptime
+
+DATE_RANGE = re.compile(r"CREATION_DATE:\[(\d{4}-\d{2}-\d{2}) TO (\d{4}-\d{2}-\d{2})\]")
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class H_EPMCStandIn(object):
+    """Local http server which behaves like the EPMC search webservice"""
+
+    def __init__(self, records_per_day=100, latency=0, port=0, fail_every=0):
+        """
+        Values:
+            records_per_day - number of records created on each day
+            latency - seconds to wait before answering each request
+            port - port to listen on, or 0 for any free port
+            fail_every - answer every this many requests with a 503 (and Retry-After), or 0 never to
+        """
+        self.records_per_day = records_per_day
+        self.latency = latency
+        self.fail_every = fail_every
+        self.requests = 0
+        self.request_times = []
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                standin.requests += 1
+                standin.request_times.append(time.time())
+                if standin.latency > 0:
+                    time.sleep(standin.latency)
+                if standin.fail_every > 0 and standin.requests % standin.fail_every == 0:
+                    self.send_response(503)
+                    self.send_header("Retry-After", "0")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                status, body = standin.search(self.path)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._thread = None
+
+    @property
+    def url(self):
+        """Base url to use in place of http://www.ebi.ac.uk/europepmc/webservices/rest"""
+        return "http://127.0.0.1:%s/europepmc/webservices/rest" % self._server.server_address[1]
+
+    def search_url(self):
+        """Search url template, with {start_date} and {end_date}, as in WEBSERVICES_DATA['url']"""
+        return self.url + "/search/resulttype=core&format=json&query=%20CREATION_DATE%3A%5B{start_date}%20TO%20{end_date}%5D"
+
+    def start(self):
+        self._thread = Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def search(self, path):
+        """
+        Answer a search request
+
+        Args:
+            path - the request path, including any query string
+
+        Returns:
+            tuple of http status and json body
+        """
+        tail = path.split("/search", 1)[-1].lstrip("/?").replace("?", "&")
+        params = dict([(k, v[0]) for k, v in urlparse.parse_qs(tail).items()])
+        match = DATE_RANGE.search(params.get("query", ""))
+        if match is None:
+            return 200, json.dumps({"errCode": 400, "errMsg": "query must contain a CREATION_DATE range"})
+        start = datetime.strptime(match.group(1), "%Y-%m-%d").date()
+        end = datetime.strptime(match.group(2), "%Y-%m-%d").date()
+        days = max((end - start).days + 1, 0)
+        total = days * self.records_per_day
+
+        size = min(int(params.get("pageSize", 25)), 1000)
+        cursor = params.get("cursorMark")
+        if cursor is not None:
+            offset = 0 if cursor == "*" else int(cursor[len("AoE"):])
+        else:
+            offset = (int(params.get("page", 1)) - 1) * size
+
+        results = [self._record(start, i) for i in range(offset, min(offset + size, total))]
+        # in the order EPMC gives them, with the cursor ahead of the results
+        response = OrderedDict([("version", "5.0"), ("hitCount", total)])
+        if cursor is not None:
+            # like EPMC, the last page hands back the cursor it was asked for
+            response["nextCursorMark"] = "AoE%d" % (offset + len(results)) if len(results) > 0 else cursor
+        response["request"] = {"query": params.get("query"), "pageSize": size}
+        response["resultList"] = {"result": results}
+        return 200, json.dumps(response)
+
+    def _record(self, start, n):
+        day = start + timedelta(days=n // self.records_per_day)
+        num = n % self.records_per_day
+        ident = "%s%05d" % (day.strftime("%Y%m%d"), num)
+        return {
+            "id": ident,
+            "source": "MED",
+            "pmid": ident,
+            "pmcid": "PMC" + ident,
+            "doi": "10.5555/standin.%s" % ident,
+            "title": "Stand-in record %s" % ident,
+            "creationDate": day.isoformat(),
+            "authorList": {"author": [
+                {"fullName": "Author %s" % num, "affiliation": "University of Stand-in, Department %d" % (num % 10)}
+            ]}
+        }
+
+
+class _H_CountingDB(object):
+    """Takes the place of the DB connection in benchmarks: counts the inserted records, taking latency
+    seconds for every thousand of them"""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.inserted = 0
+
+    def execute_bulk_insert_query(self, index, docType, body, docId=None, raise_on_error=True, refresh=True):
+        if self.latency > 0:
+            time.sleep(self.latency * len(body) / 1000.0)
+        self.inserted += len(body)
+        return {"indexed": len(body), "failed": 0, "errors": []}
+
+
+def benchmark(days=28, per_day=500, latency=0.05, index_latency=0.05, concurrency=(1, 4), fail_every=0):
+    """
+    Harvest the same stand-in date range at each level of concurrency, timing each
+
+    Args:
+        days - number of days to harvest
+        per_day - number of records on each day
+        latency - seconds the stand-in takes to answer each page
+        index_latency - seconds taken to insert each thousand records
+        concurrency - levels of concurrency to try
+        fail_every - have the stand-in fail every this many requests
+
+    Returns:
+        list of a line describing each harvest
+    """
+    from engine.query.QueryEngineMultiPage import H_QueryEngineMultiPage
+
+    report = []
+    standin = H_EPMCStandIn(records_per_day=per_day, latency=latency, fail_every=fail_every).start()
+    try:
+        start = date(2015, 1, 1)
+        end = start + timedelta(days=days - 1)
+        for c in concurrency:
+            db = _H_CountingDB(index_latency)
+            engine = H_QueryEngineMultiPage(db, standin.search_url(), start, end)
+            engine.concurrency = c
+            before = standin.requests
+            t = time.time()
+            received = engine.execute()
+            took = time.time() - t
+            report.append("concurrency %s: %s of %s records in %s requests, %.2fs" % (c, received, engine.hits, standin.requests - before, took))
+    finally:
+        standin.stop()
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark harvesting against a local EPMC stand-in")
+    parser.add_argument("--days", type=int, default=28)
+    parser.add_argument("--per-day", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--index-latency", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--fail-every", type=int, default=0)
+    args = parser.parse_args()
+    for line in benchmark(args.days, args.per_day, args.latency, args.index_latency, args.concurrency, args.fail_every):
+        print(line)
@@ -0,0 +1,167 @@
+'''
+Tests of the harvester runner, harvesting from the local EPMC stand-in into an
+in-memory DB
+
+    cd API/src
+    PYTHONPATH=../../OAUtils/src python -m unittest engine.tests.test_harvester_runner
+
+'''
+import unittest
+import time
+from datetime import date, timedelta
+from engine.HarvesterRunner import H_HarvesterRunner
+from engine.tests.EPMCStandIn import H_EPMCStandIn
+from engine.query.Watermark import to_millis
+from utils.config import MULTI_PAGE, WEBSERVICES_INDEX_NAME, HISTORY_INDEX_NAME, TEMPORARY_INDEX_NAME, \
+    HARVEST_RETRY_DELAY
+import utils.config as config
+
+
+class _MemoryDB(object):
+    """Just enough of the DB connection for the runner, held in memory"""
+
+    def __init__(self):
+        self.indexes = {}
+
+    def add(self, index, docId, body):
+        self.indexes.setdefault(index, []).append({'_id': docId, '_source': body})
+
+    def execute_search_query_scan(self, index, docType=None, body="", size=None, scroll=None, source=None):
+        return iter(list(self.indexes.get(index, [])))
+
+    def execute_search_query_sort_pag(self, index, docType=None, body="", size=100, offset=0, sort=""):
+        hits = sorted(self.indexes.get(index, []), key=lambda h: -h['_source']['date'])
+        if 'filtered' in body.get('query', {}):
+            hits = [h for h in hits if 'watermark_date' in h['_source']]
+        return {'hits': hits[offset:offset + size], 'total': len(hits)}
+
+    def execute_insert_query(self, index, docType, body, docId=None):
+        self.add(index, docId, body)
+
+    def execute_bulk_insert_query(self, index, docType, body, docId=None, raise_on_error=True, refresh=True):
+        for document in body:
+            self.add(index, None, document)
+        return {'indexed': len(body), 'failed': 0, 'errors': []}
+
+
+class TestHarvesterRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.standin = H_EPMCStandIn(records_per_day=20).start()
+        self.db = _MemoryDB()
+        self.yesterday = date.today() - timedelta(days=1)
+
+    def tearDown(self):
+        self.standin.stop()
+
+    def webservice(self, name, active=True, frequency='daily', wait_window=0, end_date=None):
+        return {
+            'name': name,
+            'url': self.standin.search_url() + '&ws=' + name,
+            'frequency': frequency,
+            'active': active,
+            'engine': MULTI_PAGE,
+            'wait_window': wait_window,
+            # by default, well after the harvests the tests make
+            'end_date': to_millis(end_date or self.yesterday + timedelta(days=365))
+        }
+
+    def test_01_harvest_due_webservices(self):
+        self.db.add(WEBSERVICES_INDEX_NAME, 'ws1', self.webservice('one'))
+        self.db.add(WEBSERVICES_INDEX_NAME, 'ws2', self.webservice('two', end_date=self.yesterday - timedelta(days=10)))
+        self.db.add(WEBSERVICES_INDEX_NAME, 'ws3', self.webservice('three', active=False))
+        runner = H_HarvesterRunner(self.db, concurrency=2)
+        try:
+            results = sorted(runner.run_once())
+        finally:
+            runner.close()
+
+        # the active ones are harvested, up to their end dates, and the inactive one is not
+        assert [(r[0], r[2]) for r in results] == [('one', None), ('two', None)]
+        assert results[0][1] == 35 * 20
+        assert results[1][1] == 25 * 20
+        assert len(self.db.indexes[TEMPORARY_INDEX_NAME]) == 60 * 20
+
+        # and each harvest is recorded, with its timings and counts
+        history = dict([(h['_source']['name_ws'], h['_source']) for h in self.db.indexes[HISTORY_INDEX_NAME]])
+        assert sorted(history.keys()) == ['one', 'two']
+        for name, found in [('one', 700), ('two', 500)]:
+            assert history[name]['num_files_received'] == found
+            assert history[name]['num_files_found'] == found
+            assert history[name]['finished'] >= history[name]['started']
+            assert history[name]['duration'] >= 0
+            assert 'error' not in history[name]
+
+    def test_02_frequency(self):
+        self.db.add(WEBSERVICES_INDEX_NAME, 'ws1', self.webservice('daily'))
+        self.db.add(WEBSERVICES_INDEX_NAME, 'ws2', self.webservice('weekly', frequency='weekly'))
+        runner = H_HarvesterRunner(self.db, poll=60)
+        try:
+            assert len(runner.run_once()) == 2
+            # nothing is due straight away
+            assert runner.run_once() == []
+            # the next day, only the daily one is
+            tomorrow = time.time() + 86400
+            assert [r[0] for r in runner.run_once(now=tomorrow)] == ['daily']
+            # and a week later, both
+            assert sorted([r[0] for r in runner.run_once(now=time.time() + 7 * 86400)]) == ['daily', 'weekly']
+        finally:
+            runner.close()
+
+    def test_03_wait_window(self):
+        self.db.add(WEBSERVICES_INDEX_NAME, 'ws1', self.webservice('slow', wait_window=0.2))
+        runner = H_HarvesterRunner(self.db)
+        try:
+            runner.run_once()
+        finally:
+            runner.close()
+        times = sorted(self.standin.request_times)
+        assert len(times) > 3
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        assert min(gaps) >= 0.15
+
+    def test_04_retry_after_failure(self):
+        self.db.add(WEBSERVICES_INDEX_NAME, 'ws1', self.webservice('failing'))
+        self.standin.fail_every = 1
+        retries = config.WS_RETRIES
+        config.WS_RETRIES = 0
+        runner = H_HarvesterRunner(self.db, poll=60)
+        try:
+            results = runner.run_once()
+            assert len(results) == 1 and results[0][2] is not None
+            failed = time.time()
+
+            # a failed harvest isn't tried again straight away, but after HARVEST_RETRY_DELAY
+            assert runner.run_once() == []
+            assert runner.run_once(now=failed + HARVEST_RETRY_DELAY / 2) == []
+            results = runner.run_once(now=failed + HARVEST_RETRY_DELAY + 1)
+            assert len(results) == 1 and results[0][2] is not None
+            failed = time.time()
+
+            # and after twice as long once it has failed again
+            assert runner.run_once(now=failed + HARVEST_RETRY_DELAY + 1) == []
+            self.standin.fail_every = 0
+            results = runner.run_once(now=failed + 2 * HARVEST_RETRY_DELAY + 1)
+            assert len(results) == 1 and results[0][2] is None
+
+            # and once it has worked, it is due by its frequency again
+            assert runner.run_once(now=time.time() + HARVEST_RETRY_DELAY + 1) == []
+        finally:
+            config.WS_RETRIES = retries
+            runner.close()
+
+    def test_05_past_end_date(self):
+        # once a webservice has been harvested up to its end date, it is never due again
+        self.db.add(WEBSERVICES_INDEX_NAME, 'ws1', self.webservice('ended', end_date=self.yesterday - timedelta(days=10)))
+        self.db.add(WEBSERVICES_INDEX_NAME, 'ws2', self.webservice('current'))
+        runner = H_HarvesterRunner(self.db, poll=60)
+        try:
+            assert sorted([r[0] for r in runner.run_once()]) == ['current', 'ended']
+            for days in [1, 2, 30]:
+                assert [r[0] for r in runner.run_once(now=time.time() + days * 86400)] == ['current']
+        finally:
+            runner.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+'''
+Tests of the multi page query engine's date slicing and cursor paging, harvesting
+from the local EPMC stand-in into an in-memory DB
+
+    cd API/src
+    PYTHONPATH=../../OAUtils/src python -m unittest engine.tests.test_query_engine_multipage
+
+'''
+import unittest
+import utils.exception.handler as EH
+from datetime import date, timedelta
+from threading import Lock
+from engine.query.QueryEngineMultiPage import H_QueryEngineMultiPage
+from engine.query.Watermark import H_Watermark
+from engine.tests.EPMCStandIn import H_EPMCStandIn
+
+
+class _ListDB(object):
+    """Collects the inserted records"""
+
+    def __init__(self):
+        self.records = []
+        self.batches = 0
+        self.fail_batch = None
+        self._lock = Lock()
+
+    def execute_bulk_insert_query(self, index, docType, body, docId=None, raise_on_error=True, refresh=True):
+        with self._lock:
+            self.batches += 1
+            if self.batches == self.fail_batch:
+                # as the connector reports failures when asked not to raise
+                return {'indexed': len(body) - 1, 'failed': 1, 'errors': ['mapper_parsing_exception']}
+            self.records.extend(body)
+        return {'indexed': len(body), 'failed': 0, 'errors': []}
+
+
+class TestQueryEngineMultiPage(unittest.TestCase):
+
+    def setUp(self):
+        self.standin = H_EPMCStandIn(records_per_day=30).start()
+        self.db = _ListDB()
+        self.start = date(2015, 1, 1)
+
+    def tearDown(self):
+        self.standin.stop()
+
+    def engine(self, days, slice_days=7, concurrency=1, page_size=1000):
+        engine = H_QueryEngineMultiPage(self.db, self.standin.search_url(), self.start, self.start + timedelta(days=days - 1))
+        engine.slice_days = slice_days
+        engine.concurrency = concurrency
+        engine._H_QueryEngineMultiPage__pageSize = page_size
+        return engine
+
+    def test_01_slices(self):
+        # consecutive slices, which neither overlap nor leave gaps, the last one cut short at the end date
+        slices = self.engine(17, slice_days=7)._slices()
+        assert slices == [(date(2015, 1, 1), date(2015, 1, 7)),
+                          (date(2015, 1, 8), date(2015, 1, 14)),
+                          (date(2015, 1, 15), date(2015, 1, 17))]
+
+        # a range shorter than a slice is a single slice
+        assert self.engine(3, slice_days=7)._slices() == [(date(2015, 1, 1), date(2015, 1, 3))]
+
+        # as is a single day
+        assert self.engine(1, slice_days=7)._slices() == [(date(2015, 1, 1), date(2015, 1, 1))]
+
+        # and slices of less than a day are taken as a day
+        assert len(self.engine(5, slice_days=0)._slices()) == 5
+
+    def test_02_cursor_paging(self):
+        # 3 days of 30 records, in pages of 25
+        engine = self.engine(3, page_size=25)
+        assert engine.execute() == 90
+        # which is as many as the stand-in said it had
+        assert engine.hits == 90
+
+        # every record is inserted, once
+        ids = [r['id'] for r in self.db.records]
+        assert len(ids) == 90
+        assert len(set(ids)) == 90
+
+        # by walking the cursor: 4 pages of results, and the empty one which ends them
+        assert self.standin.requests == 5
+
+    def test_03_concurrent_slices(self):
+        # 10 days, in 5 slices of 2 days, harvested 3 at a time
+        engine = self.engine(10, slice_days=2, concurrency=3, page_size=25)
+        assert engine.execute() == 300
+        assert engine.hits == 300
+
+        ids = [r['id'] for r in self.db.records]
+        assert len(ids) == 300
+        assert len(set(ids)) == 300
+        assert sorted(set([i[:8] for i in ids])) == [(self.start + timedelta(days=d)).strftime("%Y%m%d") for d in range(10)]
+
+        # each slice of 60 records takes 3 pages, and an empty one
+        assert self.standin.requests == 5 * 4
+
+
+    def test_04_resume(self):
+        # carrying on from a cursor part way through the slice, only the rest of it is harvested, and counted
+        engine = self.engine(3, page_size=25)
+        engine.resume = H_Watermark(date=self.start - timedelta(days=1), cursor="AoE50",
+                                    cursor_start=self.start, cursor_end=self.start + timedelta(days=2))
+        assert engine.execute() == 40
+        assert engine.received == 40
+        # out of the whole slice
+        assert engine.hits == 90
+        assert len(self.db.records) == 40
+        assert engine.watermark().date == self.start + timedelta(days=2)
+
+    def test_05_failed_insert(self):
+        # a batch which isn't inserted stops the harvest, without the progress moving past it
+        self.db.fail_batch = 3
+        engine = self.engine(3, page_size=25)
+        with self.assertRaises(EH.GenericError):
+            engine.execute()
+        assert engine.received == 50
+        watermark = engine.watermark()
+        assert watermark.date == self.start - timedelta(days=1)
+        assert watermark.cursor == "AoE50"
+        assert watermark.resumes((self.start, self.start + timedelta(days=2)))
+
+    def test_06_failed_insert_closes_pages(self):
+        # the page being read when the harvest stops, and the next one already being fetched, are closed
+        self.db.fail_batch = 1
+        engine = self.engine(3, page_size=25)
+        pages = []
+        fetch = engine._fetch
+
+        def _fetch(*args):
+            pages.append(fetch(*args))
+            return pages[-1]
+        engine._fetch = _fetch
+
+        with self.assertRaises(EH.GenericError):
+            engine.execute()
+        assert len(pages) == 2
+        assert all([p.closed for p in pages])
+
+    def test_07_no_duplicate_check(self):
+        # harvesting a range again (as a backfill does) inserts its records again: the temporary index is
+        # not checked for duplicates, which are only caught when the records are sent on as notifications
+        assert self.engine(3, page_size=25).execute() == 90
+        assert self.engine(3, page_size=25).execute() == 90
+        ids = [r['id'] for r in self.db.records]
+        assert len(ids) == 180
+        assert len(set(ids)) == 90
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -59,6 +59,39 @@ WEBSERVICES_MAPPING = {
     }
 }
 
+# Harvester runner: the most webservices harvested at once, how often (seconds) to check which
+# are due, and the days between the harvests of each frequency
+HARVEST_WEBSERVICE_CONCURRENCY = 4
+HARVEST_POLL_INTERVAL = 300
+HARVEST_FREQUENCY_DAYS = {
+    FREQUENCY_DAILY: 1,
+    FREQUENCY_WEEKLY: 7,
+    FREQUENCY_MONTHLY: 30
+}
+# Seconds to wait before trying again after a harvest of a webservice fails, doubled after each
+# further failure in a row (but never longer than its frequency)
+HARVEST_RETRY_DELAY = 3600
+
+# Web service requests: connect and read timeouts (seconds); number of retries of failed
+# requests, with exponential backoff from WS_RETRY_BACKOFF up to WS_RETRY_BACKOFF_MAX seconds;
+# and the most requests made to any one host at once (counting streamed responses until they are closed)
+WS_CONNECT_TIMEOUT = 10
+WS_READ_TIMEOUT = 120
+WS_RETRIES = 5
+WS_RETRY_BACKOFF = 1
+WS_RETRY_BACKOFF_MAX = 60
+WS_HOST_CONCURRENCY = 4
+# Bytes read at a time from responses which are parsed as they arrive
+WS_STREAM_CHUNK = 65536
+
+# Harvests are split into slices of this many days, which are harvested independently,
+# up to HARVEST_CONCURRENCY slices at once
+HARVEST_SLICE_DAYS = 7
+HARVEST_CONCURRENCY = 4
+# Harvested records are inserted in batches of this many, as each page arrives; a multiple of
+# BULK_CHUNK_DOCS, so that each batch is sent as several chunks at once
+HARVEST_BULK_CHUNK = 1000
+
 TEMPORARY_INDEX_NAME = "h_temporary"
 TEMPORARY_DOCTYPE_NAME = "document"
 TEMPORARY_MAPPING = ""
@@ -75,8 +108,17 @@ HISTORY_MAPPING = {
             "start_date": {"type": "date"},
             "end_date": {"type": "date"},
             "num_files_received": {"type": "integer"},
+            "num_files_found": {"type": "integer"},
             "num_files_sent": {"type": "integer"},
-            "error": {"type": "string"}
+            "error": {"type": "string"},
+            "backfill": {"type": "boolean"},
+            "started": {"type": "date"},
+            "finished": {"type": "date"},
+            "duration": {"type": "double"},
+            "watermark_date": {"type": "date"},
+            "watermark_cursor": {"type": "string", "index": "not_analyzed"},
+            "watermark_cursor_start": {"type": "date"},
+            "watermark_cursor_end": {"type": "date"}
         }
     }
 }
@@ -109,4 +151,17 @@ configMySQL = {
                'raise_on_warnings': True,
                }
 
+# Scans of the DB read this many hits at a time (per shard), keeping the search open this long between reads
+SCAN_SIZE = 500
+SCAN_SCROLL = '5m'
+
+# Bulk inserts are sent in chunks of at most BULK_CHUNK_DOCS documents and BULK_CHUNK_BYTES bytes,
+# BULK_THREADS chunks at once; documents rejected because the DB is busy are retried up to
+# BULK_RETRIES times, with exponential backoff from BULK_RETRY_BACKOFF seconds
+BULK_CHUNK_DOCS = 500
+BULK_CHUNK_BYTES = 5 * 1024 * 1024
+BULK_THREADS = 4
+BULK_RETRIES = 3
+BULK_RETRY_BACKOFF = 1
+
 configES = [{'host': 'gateway', 'port': 9200, 'timeout': 60}]
@@ -9,7 +9,10 @@ their functionalities
 from six import with_metaclass
 import utils.config as config
 import sys
+import json
+import time
 import contextlib
+from multiprocessing.pool import ThreadPool
 import urllib3
 import elasticsearch as ES
 from elasticsearch import helpers
@@ -101,6 +104,30 @@ class U_AbstractConnector(with_metaclass(ABCMeta)):
         """
         raise NotImplementedError
 
+    @abstractmethod
+    def execute_search_query_scan(self, index, docType, body, size, scroll, source):
+        """ Abstract method for searching on a DB, handing back the results
+        one at a time as they are read
+
+        :param index -- table to run the query to
+        :param docType -- type of document target of the query
+        :param body -- query to execute
+        :param size -- number of results read at a time
+        :param scroll -- how long to keep the search open between reads
+        :param source -- fields of each document to return
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def execute_get_query(self, index, docType, docId):
+        """ Abstract method for getting a single document by ID
+
+        :param index -- table to get the document from
+        :param docType -- type of document
+        :param docId -- ID of the document
+        """
+        raise NotImplementedError
+
     @abstractmethod
     def execute_create_table(self, index):
         """ Abstract method for creating a new table
@@ -237,21 +264,43 @@ class _U_ElasticSearchV1(U_AbstractConnector):
 
         :returns: elastic search response object
         """
-        LH.logger.info("Executing search query on index {index}".format(index=index))
+        response = {}
+        response['hits'] = []
+        response['total'] = 0
+        for item in self.execute_search_query_scan(index, docType, body, scroll='15m'):
+            response['hits'].append(item)
+            response['total'] += 1
+        return response
+
+    def execute_search_query_scan(self, index, docType=None, body="", size=None, scroll=None, source=None):
+        """ Method for executing a search on the DB, handing back the hits
+        one at a time as they are read, so that the results never need to be
+        held all at once
+
+        :param index -- table to run the query to
+        :param docType -- type of document target of the query
+        :param body -- query to execute
+        :param size -- number of hits read at a time (per shard); default config.SCAN_SIZE
+        :param scroll -- how long to keep the search open between reads; default config.SCAN_SCROLL
+        :param source -- list of the fields of each document to return, or None for all of them
+
+        :returns: generator of elastic search hits
+        """
+        LH.logger.info("Executing scan query on index {index}".format(index=index))
+        kwargs = {}
+        if source is not None:
+            kwargs['_source'] = ",".join(source)
         try:
             result = helpers.scan(client=self.connector,
                                   query=body,
                                   raise_on_error=True,
                                   index=index,
                                   doc_type=docType,
-                                  scroll='15m')
-            response = {}
-            response['hits'] = []
-            response['total'] = 0
+                                  scroll=scroll or config.SCAN_SCROLL,
+                                  size=size or config.SCAN_SIZE,
+                                  **kwargs)
             for item in result:
-                response['hits'].append(item)
-                response['total'] += 1
-            return response
+                yield item
         except ES.ConnectionTimeout as err:
             raise EH.DBConnectionError(message="Connection timeout error",
                                        error=str(err.info))
@@ -262,6 +311,30 @@ class _U_ElasticSearchV1(U_AbstractConnector):
             raise EH.GenericError(message="Exception while searching",
                                   error=str(err))
 
+    def execute_get_query(self, index, docType, docId):
+        """ Method for getting a single document by ID
+
+        :param index -- table to get the document from
+        :param docType -- type of document
+        :param docId -- ID of the document
+
+        :returns: elastic search hit, or None if there is no such document
+        """
+        LH.logger.info("Getting {type} document {id} from {index}".format(type=docType, id=docId, index=index))
+        try:
+            return self.connector.get(index=index, doc_type=docType, id=docId)
+        except ES.NotFoundError:
+            return None
+        except ES.ConnectionTimeout as err:
+            raise EH.DBConnectionError(message="Connection timeout error",
+                                       error=str(err.info))
+        except ES.ConnectionError as err:
+            raise EH.DBConnectionError(message="Generic connection error",
+                                       error=str(err.info))
+        except ES.ElasticsearchException as err:
+            raise EH.GenericError(message="Exception while getting a document",
+                                  error=str(err))
+
     def execute_create_table(self, index):
         """ Method for creating a table (index) on ES DB
 
@@ -347,30 +420,47 @@ class _U_ElasticSearchV1(U_AbstractConnector):
             raise EH.GenericError(message="Exception while inserting",
                                   error=str(err.info))
 
-    def execute_bulk_insert_query(self, index, docType, body, docId=None):
+    def execute_bulk_insert_query(self, index, docType, body, docId=None, raise_on_error=True, refresh=True):
         """ Method for executing a insert on the DB
 
+        The documents are sent in chunks of at most BULK_CHUNK_DOCS documents
+        and BULK_CHUNK_BYTES bytes, up to BULK_THREADS chunks at once.
+        Documents the DB rejects because it is too busy (429) are sent again,
+        with exponential backoff, up to BULK_RETRIES times.
+
         :param index -- table to run the query to
         :param docType -- type of document target of the query
         :param body -- documents list of content
         :param docId -- id to save the document
+        :param raise_on_error -- raise if any of the documents could not be
+                                 inserted, rather than only reporting them
+        :param refresh -- refresh the index afterwards, so the documents can
+                          be searched straight away
 
-        :returns: elastic search response object
+        :raises: GenericError if any documents failed and raise_on_error
+
+        :returns: dict of the number of documents "indexed" and "failed", and
+                  the "errors" for the ones which failed
         """
         LH.logger.info("Inserting new '{type}' document into {index}".format(type=docType, index=index))
+        summary = {"indexed": 0, "failed": 0, "errors": []}
         try:
-            actions = []
-            for document in body:
-                action = {
-                    "_index": index,
-                    "_type": docType,
-                    "_source": document
-                    }
-                actions.append(action)
-            if len(actions) > 0:
-                response = helpers.bulk(self.connector, actions)
-            self.connector.indices.refresh(index=index)
-            return response
+            chunks = self.__bulk_chunks(index, docType, body)
+            if config.BULK_THREADS > 1 and len(chunks) > 1:
+                pool = ThreadPool(min(config.BULK_THREADS, len(chunks)))
+                try:
+                    results = pool.map(self.__bulk_send, chunks)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [self.__bulk_send(chunk) for chunk in chunks]
+            for indexed, errors in results:
+                summary["indexed"] += indexed
+                summary["failed"] += len(errors)
+                summary["errors"].extend(errors)
+            if refresh and len(chunks) > 0:
+                self.connector.indices.refresh(index=index)
         except ES.ConnectionTimeout as err:
             raise EH.DBConnectionError(message="Connection timeout error",
                                        error=str(err.info))
@@ -382,7 +472,68 @@ class _U_ElasticSearchV1(U_AbstractConnector):
                                   error=str(err.info))
         except ES.ElasticsearchException as err:
             raise EH.GenericError(message="Exception while inserting",
-                                  error=str(err.info))
+                                  error=str(err))
+        if summary["failed"] > 0:
+            message = "{failed} of {total} documents could not be inserted into {index}".format(failed=summary["failed"], total=summary["failed"] + summary["indexed"], index=index)
+            if raise_on_error:
+                raise EH.GenericError(message=message, error=str(summary["errors"][0]))
+            LH.logger.warning(message)
+        return summary
+
+    def __bulk_chunks(self, index, docType, body):
+        """ Split documents into chunks of bulk actions (each action line and
+        its document kept together), within the count and size limits
+        """
+        action = json.dumps({"index": {"_index": index, "_type": docType}}) + "\n"
+        chunks = []
+        chunk = []
+        size = 0
+        for document in body:
+            pair = action + json.dumps(document) + "\n"
+            if len(chunk) > 0 and (len(chunk) >= config.BULK_CHUNK_DOCS or size + len(pair) > config.BULK_CHUNK_BYTES):
+                chunks.append(chunk)
+                chunk = []
+                size = 0
+            chunk.append(pair)
+            size += len(pair)
+        if len(chunk) > 0:
+            chunks.append(chunk)
+        return chunks
+
+    def __bulk_send(self, chunk):
+        """ Send one chunk of bulk actions, retrying the ones rejected because
+        the DB is busy
+
+        :returns: tuple of the number of documents indexed, and the list of
+                  errors for the ones that failed
+        """
+        indexed = 0
+        errors = []
+        attempt = 0
+        while True:
+            retry = []
+            try:
+                response = self.connector.bulk(body="".join(chunk))
+                for pair, item in zip(chunk, response["items"]):
+                    result = item.values()[0]
+                    status = result.get("status", 200)
+                    if status < 300:
+                        indexed += 1
+                    elif status == 429 and attempt < config.BULK_RETRIES:
+                        retry.append(pair)
+                    else:
+                        errors.append(result.get("error"))
+            except ES.TransportError as err:
+                if err.status_code != 429 or attempt >= config.BULK_RETRIES:
+                    raise
+                retry = chunk
+            if len(retry) == 0:
+                return indexed, errors
+            wait = config.BULK_RETRY_BACKOFF * (2 ** attempt)
+            LH.logger.warning("{n} documents rejected as the DB is busy, retrying in {wait}s".format(n=len(retry), wait=wait))
+            time.sleep(wait)
+            chunk = retry
+            attempt += 1
 
     def execute_update_query(self, index, docType, docId, body):
         """ Method for executing an update on the DB
@@ -6,24 +6,147 @@ Created on 26 Oct 2015
 @Description: Module created for web services invocation.
 '''
 import json
+import time
+import codecs
+import threading
+import urlparse
 import requests
+from email.utils import parsedate_tz, mktime_tz
+import utils.config as config
 import utils.exception.handler as EH
 import utils.logger.handler as LH
 import xml.etree.ElementTree as ET
 
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+"""http statuses which are worth retrying, as they are usually temporary"""
+
+
+class _U_Session(object):
+    """Shared http session, pooling connections to each host, limiting how
+    many requests are made to any one host at once, and spacing out the
+    requests to hosts which have a wait window
+    """
+
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=config.WS_HOST_CONCURRENCY)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+        self._hosts = {}
+        self._windows = {}
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def host_limit(self, url):
+        """Get the semaphore limiting the requests made at once to the host of the url"""
+        host = urlparse.urlparse(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(config.WS_HOST_CONCURRENCY)
+            return self._hosts[host]
+
+    def set_wait_window(self, url, seconds):
+        """Leave at least this many seconds between the starts of requests to
+        the host of the url"""
+        host = urlparse.urlparse(url).netloc
+        with self._lock:
+            self._windows[host] = seconds
+
+    def wait_turn(self, url):
+        """Wait until the wait window since the last request to the host of
+        the url has passed, and claim the next turn"""
+        host = urlparse.urlparse(url).netloc
+        with self._lock:
+            window = self._windows.get(host, 0)
+            if window <= 0:
+                return
+            now = time.time()
+            turn = max(now, self._next.get(host, 0))
+            self._next[host] = turn + window
+        if turn > now:
+            time.sleep(turn - now)
+
+_session = _U_Session()
+
+
+def set_wait_window(url, seconds):
+    """Leave at least this many seconds between the starts of requests to the
+    host of the url, from all invokers
+
+    Attributes:
+        url -- any url on the host
+        seconds -- the wait window, or 0 not to wait
+    """
+    _session.set_wait_window(url, seconds)
+
+
+def _retry_after(response):
+    """Get the number of seconds a response asks us to wait before trying again, if it says
+
+    Attributes:
+        response -- the http response
+    """
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        when = parsedate_tz(value)
+        if when is None:
+            return None
+        return max(mktime_tz(when) - time.time(), 0)
+
 
 class U_WSInvoker (object):
     """Web services invoker to retrieve all information from a specific source
     and with specific conditions.
     """
 
-    def __retrieve_information(self, query):
+    def __retrieve_information(self, query, stream=False):
         """Generic function which runs the query previously created
 
+        Connection failures, timeouts and temporary error statuses are retried
+        up to WS_RETRIES times, with exponential backoff (or as long as the
+        Retry-After header asks). The last failure is handed back.
+
+        A streamed response still counts against the host's limit until it
+        is closed, which is left to _U_ResponseChunks.
+
         Attributes:
             query -- query to execute to the ws system
+            stream -- leave the body to be read as it arrives
         """
-        return requests.get(query)
+        limit = _session.host_limit(query)
+        attempt = 0
+        while True:
+            wait = min(config.WS_RETRY_BACKOFF * (2 ** attempt), config.WS_RETRY_BACKOFF_MAX)
+            try:
+                _session.wait_turn(query)
+                limit.acquire()
+                try:
+                    response = _session.session.get(query, stream=stream,
+                                                    timeout=(config.WS_CONNECT_TIMEOUT, config.WS_READ_TIMEOUT))
+                except Exception:
+                    limit.release()
+                    raise
+                if response.status_code not in RETRY_STATUSES or attempt >= config.WS_RETRIES:
+                    if not stream:
+                        limit.release()
+                    return response
+                response.close()
+                limit.release()
+                asked = _retry_after(response)
+                if asked is not None:
+                    wait = min(asked, config.WS_RETRY_BACKOFF_MAX)
+                LH.logger.warning("Got {status} from {query}, retrying in {wait}s".format(status=response.status_code, query=query, wait=wait))
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+                if attempt >= config.WS_RETRIES:
+                    raise
+                LH.logger.warning("Request to {query} failed ({err}), retrying in {wait}s".format(query=query, err=str(err), wait=wait))
+            time.sleep(wait)
+            attempt += 1
 
     def retrieve_information_xml(self, query):
         """Returns the information obtained from the specific source and
@@ -68,3 +191,190 @@ class U_WSInvoker (object):
             return json.loads(returnRequest.text)
         except Exception as err:
             raise EH.IncorrectFormatError("Not well-formed", str(err))
+
+    def retrieve_information_json_stream(self, query, path=("resultList", "result")):
+        """Returns the information obtained from the specific source and
+        according to the parameters, as a U_JSONStream which parses the
+        response as it arrives, handing out the items of the (possibly very
+        long) list at path one by one.
+
+        Attributes:
+            query -- query to execute to the ws system
+            path -- keys leading from the top of the response to the list
+        """
+        LH.logger.info("Retrieving json information as a stream")
+        try:
+            returnRequest = self.__retrieve_information(query, stream=True)
+        except requests.exceptions.Timeout as err:
+            raise EH.GenericError("Timeout", str(err))
+        except requests.exceptions.RequestException as err:
+            raise EH.GenericError("Request exception", str(err))
+        chunks = _U_ResponseChunks(returnRequest, _session.host_limit(query))
+        try:
+            returnRequest.raise_for_status()
+        except requests.exceptions.HTTPError as err:
+            chunks.close()
+            raise EH.GenericError("Invalid HTTP response", str(err))
+        return U_JSONStream(chunks, path)
+
+
+class _U_ResponseChunks(object):
+    """The body of a streamed response, in pieces, closing the response once
+    it has all been read, or when closed early, and only then letting another
+    request to the host start in its place
+    """
+
+    def __init__(self, response, limit):
+        """
+        Attributes:
+            response -- the streamed response
+            limit -- the host's semaphore, held for the response
+        """
+        self._response = response
+        self._limit = limit
+
+    def __iter__(self):
+        try:
+            for chunk in self._response.iter_content(config.WS_STREAM_CHUNK):
+                yield chunk
+        except requests.exceptions.RequestException as err:
+            raise EH.GenericError("Request exception", str(err))
+        finally:
+            self.close()
+
+    def close(self):
+        self._response.close()
+        if self._limit is not None:
+            limit, self._limit = self._limit, None
+            limit.release()
+
+
+class U_JSONStream(object):
+    """Incremental parser for a json object holding one long list, which
+    hands out the items of the list as they are read, without ever holding
+    the whole document.
+
+    The other members of the top level object are collected in header as
+    they are passed (so, for EPMC, hitCount and nextCursorMark are there
+    before the first result is handed out).
+
+    A stream which is given up on before the end should be closed, to let go
+    of the response it is reading.
+    """
+
+    def __init__(self, chunks, path):
+        """
+        Attributes:
+            chunks -- iterable of the bytes of the document, in pieces
+            path -- keys leading from the top of the document to the list
+        """
+        self.header = {}
+        self.closed = False
+        self._source = chunks
+        self._chunks = iter(chunks)
+        self._path = path
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self._buf = u""
+        self._pos = 0
+        self._eof = False
+
+    def results(self):
+        """Generator of the items of the list, closing the stream once the
+        document has been read (or can't be)"""
+        try:
+            for item in self._object(self._path, self.header):
+                yield item
+        except ValueError as err:
+            raise EH.IncorrectFormatError("Not well-formed", str(err))
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop reading the document, closing what it is read from"""
+        self.closed = True
+        self._eof = True
+        for chunks in [self._chunks, self._source]:
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+    def _more(self):
+        # read the next piece of the document onto the end of the buffer, dropping what has been parsed
+        if self._eof:
+            return False
+        try:
+            text = self._text.decode(next(self._chunks))
+        except StopIteration:
+            self._eof = True
+            text = self._text.decode(b"", True)
+        self._buf = self._buf[self._pos:] + text
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        # the next character which isn't whitespace
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in u" \t\r\n":
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._more():
+                raise ValueError("Unexpected end of document")
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError("Expected '%s' but found '%s'" % (char, self._buf[self._pos]))
+        self._pos += 1
+
+    def _value(self):
+        # the next complete value; a value which runs to the end of the buffer may be cut short, so
+        # read on until it is followed by something
+        self._peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if not self._more():
+                    raise
+                continue
+            if end == len(self._buf) and self._more():
+                continue
+            self._pos = end
+            return value
+
+    def _object(self, path, into):
+        self._expect(u"{")
+        if self._peek() == u"}":
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(u":")
+            if key == path[0] and len(path) == 1:
+                for item in self._list():
+                    yield item
+            elif key == path[0]:
+                for item in self._object(path[1:], None):
+                    yield item
+            else:
+                value = self._value()
+                if into is not None:
+                    into[key] = value
+            if self._peek() == u",":
+                self._pos += 1
+            else:
+                self._expect(u"}")
+                return
+
+    def _list(self):
+        self._expect(u"[")
+        if self._peek() == u"]":
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._peek() == u",":
+                self._pos += 1
+            else:
+                self._expect(u"]")
+                return
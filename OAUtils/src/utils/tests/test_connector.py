@@ -0,0 +1,230 @@
+'''
+Tests of the elastic search connector, against a stand-in for the elastic search
+client
+
+    cd OAUtils/src
+    python -m unittest utils.tests.test_connector
+
+'''
+import unittest
+import json
+import threading
+import elasticsearch as ES
+import utils.config as config
+import utils.exception.handler as EH
+from utils.connector.connector import _U_ElasticSearchV1
+
+
+class _Client(object):
+    """Just enough of the elastic search client, holding the documents of one index in memory"""
+
+    def __init__(self, documents=None):
+        self.documents = documents or {}
+        self.calls = []
+        self.down = False
+        self.busy = 0
+        self.busy_items = 0
+        self.bad = set()
+        self.refreshed = 0
+        self.indices = self
+        self._lock = threading.Lock()
+
+    def _check(self):
+        if self.down:
+            raise ES.ConnectionError("N/A", "connection refused", Exception("connection refused"))
+
+    def search(self, body=None, scroll=None, size=10, **kwargs):
+        self._check()
+        self.calls.append(("search", scroll, size, kwargs))
+        self._hits = [{"_id": key, "_source": self.documents[key]} for key in sorted(self.documents)]
+        return self._page(size)
+
+    def scroll(self, scroll_id=None, scroll=None, **kwargs):
+        self._check()
+        self.calls.append(("scroll", scroll))
+        return self._page(self._size)
+
+    def _page(self, size):
+        self._size = size
+        page, self._hits = self._hits[:size], self._hits[size:]
+        return {"_scroll_id": "scroll", "_shards": {"total": 1, "successful": 1}, "hits": {"hits": page}}
+
+    def clear_scroll(self, **kwargs):
+        self.calls.append(("clear_scroll",))
+
+    def get(self, index=None, doc_type=None, id=None):
+        self._check()
+        if id not in self.documents:
+            raise ES.NotFoundError(404, "not found", {})
+        return {"_index": index, "_type": doc_type, "_id": id, "found": True, "_source": self.documents[id]}
+
+
+    def bulk(self, body=None):
+        self._check()
+        lines = body.strip("\n").split("\n")
+        documents = [json.loads(line) for line in lines[1::2]]
+        with self._lock:
+            self.calls.append(("bulk", len(documents)))
+            if self.busy > 0:
+                # the whole request is turned away
+                self.busy -= 1
+                raise ES.TransportError(429, "es_rejected_execution_exception", {})
+            items = []
+            for document in documents:
+                if document["n"] in self.bad:
+                    items.append({"index": {"status": 400, "error": "mapper_parsing_exception"}})
+                elif self.busy_items > 0:
+                    self.busy_items -= 1
+                    items.append({"index": {"status": 429, "error": "es_rejected_execution_exception"}})
+                else:
+                    self.documents[str(document["n"])] = document
+                    items.append({"index": {"status": 201}})
+        return {"errors": True, "items": items}
+
+    def refresh(self, index=None):
+        self.refreshed += 1
+
+
+def _connector(client):
+    """A connector using the client, without connecting to a DB"""
+    conn = _U_ElasticSearchV1.__new__(_U_ElasticSearchV1)
+    conn.connector = client
+    return conn
+
+
+class TestConnector(unittest.TestCase):
+
+    def test_01_scan(self):
+        client = _Client(dict([("%03d" % i, {"n": i}) for i in range(25)]))
+        hits = list(_connector(client).execute_search_query_scan("index", "doc", {"query": {"match_all": {}}}, size=10, scroll="1m"))
+        assert [h["_source"]["n"] for h in hits] == range(25)
+
+        # read 10 at a time (until an empty page), keeping the scroll open for as long as asked, and closed at the end
+        assert client.calls[0][:3] == ("search", "1m", 10)
+        assert [c[0] for c in client.calls] == ["search", "scroll", "scroll", "scroll", "clear_scroll"]
+        assert client.calls[1] == ("scroll", "1m")
+
+    def test_02_scan_defaults_and_source(self):
+        client = _Client({"a": {"n": 1, "big": "x" * 100}})
+        hits = list(_connector(client).execute_search_query_scan("index", body={}, source=["n", "id"]))
+        assert len(hits) == 1
+        assert client.calls[0][1:3] == (config.SCAN_SCROLL, config.SCAN_SIZE)
+        assert client.calls[0][3]["_source"] == "n,id"
+
+    def test_03_scan_is_lazy(self):
+        client = _Client(dict([("%03d" % i, {"n": i}) for i in range(25)]))
+        hits = _connector(client).execute_search_query_scan("index", body={}, size=10)
+        assert client.calls == []
+        assert next(hits)["_source"]["n"] == 0
+        # only the first page has been read
+        assert [c[0] for c in client.calls] == ["search"]
+
+    def test_04_scroll_uses_scan(self):
+        client = _Client(dict([("%03d" % i, {"n": i}) for i in range(25)]))
+        response = _connector(client).execute_search_query_scroll("index", "doc", {})
+        assert response["total"] == 25
+        assert len(response["hits"]) == 25
+
+    def test_05_scan_connection_error(self):
+        client = _Client()
+        client.down = True
+        with self.assertRaises(EH.DBConnectionError):
+            list(_connector(client).execute_search_query_scan("index", body={}))
+
+    def test_06_get(self):
+        client = _Client({"a": {"n": 1}})
+        conn = _connector(client)
+        assert conn.execute_get_query("index", "doc", "a")["_source"] == {"n": 1}
+        # a missing document is None rather than an error
+        assert conn.execute_get_query("index", "doc", "b") is None
+        client.down = True
+        with self.assertRaises(EH.DBConnectionError):
+            conn.execute_get_query("index", "doc", "a")
+
+
+class TestBulkInsert(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (config.BULK_CHUNK_DOCS, config.BULK_CHUNK_BYTES, config.BULK_THREADS, config.BULK_RETRIES, config.BULK_RETRY_BACKOFF)
+        config.BULK_CHUNK_DOCS = 10
+        config.BULK_CHUNK_BYTES = 1024 * 1024
+        config.BULK_THREADS = 3
+        config.BULK_RETRIES = 2
+        config.BULK_RETRY_BACKOFF = 0.01
+        self.client = _Client()
+        self.conn = _connector(self.client)
+
+    def tearDown(self):
+        config.BULK_CHUNK_DOCS, config.BULK_CHUNK_BYTES, config.BULK_THREADS, config.BULK_RETRIES, config.BULK_RETRY_BACKOFF = self.saved
+
+    def documents(self, count, size=0):
+        return [{"n": i, "text": "x" * size} for i in range(count)]
+
+    def test_01_chunks(self):
+        summary = self.conn.execute_bulk_insert_query("index", "doc", self.documents(25))
+        assert summary == {"indexed": 25, "failed": 0, "errors": []}
+        assert len(self.client.documents) == 25
+        # in chunks of BULK_CHUNK_DOCS
+        assert sorted([c[1] for c in self.client.calls]) == [5, 10, 10]
+        assert self.client.refreshed == 1
+
+    def test_02_chunk_bytes(self):
+        # no chunk bigger than BULK_CHUNK_BYTES, unless it is a single document
+        config.BULK_CHUNK_BYTES = 2500
+        self.conn.execute_bulk_insert_query("index", "doc", self.documents(6, size=1000) + self.documents(1, size=5000))
+        assert len(self.client.documents) == 6
+        assert sorted([c[1] for c in self.client.calls]) == [1, 2, 2, 2]
+
+    def test_03_single_thread(self):
+        config.BULK_THREADS = 1
+        self.conn.execute_bulk_insert_query("index", "doc", self.documents(25))
+        assert [c[1] for c in self.client.calls] == [10, 10, 5]
+
+    def test_04_no_refresh(self):
+        self.conn.execute_bulk_insert_query("index", "doc", self.documents(5), refresh=False)
+        assert len(self.client.documents) == 5
+        assert self.client.refreshed == 0
+
+    def test_05_retry_busy(self):
+        # documents turned away because the DB is busy are sent again, on their own
+        self.client.busy_items = 3
+        config.BULK_THREADS = 1
+        summary = self.conn.execute_bulk_insert_query("index", "doc", self.documents(10))
+        assert summary["indexed"] == 10 and summary["failed"] == 0
+        assert [c[1] for c in self.client.calls] == [10, 3]
+
+        # as are whole requests
+        self.client.calls = []
+        self.client.busy = 2
+        summary = self.conn.execute_bulk_insert_query("index", "doc", self.documents(10))
+        assert summary["indexed"] == 10
+        assert [c[1] for c in self.client.calls] == [10, 10, 10]
+
+    def test_06_failures_raise(self):
+        self.client.bad = set([3, 17])
+        with self.assertRaises(EH.GenericError):
+            self.conn.execute_bulk_insert_query("index", "doc", self.documents(20))
+
+        # unless they are only to be reported
+        summary = self.conn.execute_bulk_insert_query("index", "doc", self.documents(20), raise_on_error=False)
+        assert summary["indexed"] == 18
+        assert summary["failed"] == 2
+        assert summary["errors"] == ["mapper_parsing_exception"] * 2
+
+    def test_07_gives_up_when_busy(self):
+        # documents still turned away after BULK_RETRIES retries have failed
+        self.client.busy_items = 100
+        config.BULK_THREADS = 1
+        summary = self.conn.execute_bulk_insert_query("index", "doc", self.documents(5), raise_on_error=False)
+        assert summary["failed"] == 5
+        assert len(self.client.calls) == 3
+
+        # and a request still turned away is an error
+        self.client.busy_items = 0
+        self.client.busy = 3
+        with self.assertRaises(EH.GenericError):
+            self.conn.execute_bulk_insert_query("index", "doc", self.documents(5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+'''
+Tests of the web services invoker's retries, against a local http server
+
+    cd OAUtils/src
+    python -m unittest utils.tests.test_invoker
+
+'''
+import unittest
+import json
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from threading import Thread
+from email.utils import formatdate
+import utils.config as config
+import utils.exception.handler as EH
+import utils.invoker.invoker as invoker
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Server(object):
+    """Answers each request with the next of a list of (status, headers) responses, and then with 200
+    and a small json document"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                status, headers = server.responses.pop(0) if len(server.responses) > 0 else (200, {})
+                body = json.dumps({"ok": status == 200}) if status == 200 else ""
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%s/search" % self._server.server_address[1]
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _Response(object):
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class TestInvoker(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (config.WS_RETRIES, config.WS_RETRY_BACKOFF, config.WS_RETRY_BACKOFF_MAX, config.WS_HOST_CONCURRENCY)
+        config.WS_RETRIES = 3
+        config.WS_RETRY_BACKOFF = 0.01
+        config.WS_RETRY_BACKOFF_MAX = 1
+        self.server = None
+
+    def tearDown(self):
+        config.WS_RETRIES, config.WS_RETRY_BACKOFF, config.WS_RETRY_BACKOFF_MAX, config.WS_HOST_CONCURRENCY = self.saved
+        if self.server is not None:
+            self.server.stop()
+
+    def test_01_retry_after(self):
+        # in seconds, or as a date, and never negative
+        assert invoker._retry_after(_Response({"Retry-After": "7"})) == 7
+        assert invoker._retry_after(_Response({"Retry-After": "-3"})) == 0
+        assert 8 <= invoker._retry_after(_Response({"Retry-After": formatdate(time.time() + 10, usegmt=True)})) <= 10
+        assert invoker._retry_after(_Response({"Retry-After": formatdate(time.time() - 10, usegmt=True)})) == 0
+        # and nothing if it isn't given, or can't be read
+        assert invoker._retry_after(_Response({})) is None
+        assert invoker._retry_after(_Response({"Retry-After": "soon"})) is None
+
+    def test_02_retry_temporary_failures(self):
+        self.server = _Server([(503, {}), (429, {}), (502, {})])
+        assert invoker.U_WSInvoker().retrieve_information_json(self.server.url) == {"ok": True}
+        assert self.server.requests == 4
+
+    def test_03_waits_as_asked(self):
+        self.server = _Server([(429, {"Retry-After": "1"})])
+        started = time.time()
+        assert invoker.U_WSInvoker().retrieve_information_json(self.server.url) == {"ok": True}
+        assert self.server.requests == 2
+        assert time.time() - started >= 1
+
+        # but never longer than WS_RETRY_BACKOFF_MAX
+        config.WS_RETRY_BACKOFF_MAX = 0.1
+        self.server.responses = [(503, {"Retry-After": "30"})]
+        started = time.time()
+        assert invoker.U_WSInvoker().retrieve_information_json(self.server.url) == {"ok": True}
+        assert time.time() - started < 5
+
+    def test_04_gives_up(self):
+        # after WS_RETRIES retries, the last failure is handed back
+        self.server = _Server([(500, {})] * 10)
+        with self.assertRaises(EH.GenericError):
+            invoker.U_WSInvoker().retrieve_information_json(self.server.url)
+        assert self.server.requests == 4
+
+    def test_05_no_retry_of_other_failures(self):
+        self.server = _Server([(404, {}), (404, {})])
+        with self.assertRaises(EH.GenericError):
+            invoker.U_WSInvoker().retrieve_information_json(self.server.url)
+        assert self.server.requests == 1
+
+    def test_06_stream_holds_host(self):
+        # a streamed response counts against the host's limit until it is read to the end, or closed
+        config.WS_HOST_CONCURRENCY = 1
+        self.server = _Server([])
+        stream = invoker.U_WSInvoker().retrieve_information_json_stream(self.server.url)
+        waiting = Thread(target=invoker.U_WSInvoker().retrieve_information_json, args=(self.server.url,))
+        waiting.start()
+        time.sleep(0.5)
+        assert self.server.requests == 1
+        stream.close()
+        waiting.join(5)
+        assert not waiting.is_alive()
+        assert self.server.requests == 2
+
+        stream = invoker.U_WSInvoker().retrieve_information_json_stream(self.server.url)
+        assert list(stream.results()) == []
+        assert invoker.U_WSInvoker().retrieve_information_json(self.server.url) == {"ok": True}
+        # and closing it afterwards doesn't let go of the host twice
+        stream.close()
+        assert self.server.requests == 4
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+'''
+Tests of the incremental json parser used for harvested pages
+
+    cd OAUtils/src
+    python -m unittest utils.tests.test_json_stream
+
+'''
+import unittest
+import json
+import utils.exception.handler as EH
+from utils.invoker.invoker import U_JSONStream
+
+PATH = ("resultList", "result")
+
+
+def _pieces(text, size):
+    """The utf-8 bytes of the text, in pieces of size bytes"""
+    data = text.encode("utf-8")
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestJSONStream(unittest.TestCase):
+
+    def page(self, results, **header):
+        doc = dict(header)
+        doc["resultList"] = {"result": results}
+        return json.dumps(doc, ensure_ascii=False)
+
+    def test_01_results_and_header(self):
+        results = [{"id": str(i), "title": u"Title %s" % i, "authors": [{"name": "A"}, {"name": "B"}]} for i in range(50)]
+        text = self.page(results, version="5.0", hitCount=50, nextCursorMark="AoE50")
+        stream = U_JSONStream([text], PATH)
+        assert list(stream.results()) == results
+        assert stream.header == {"version": "5.0", "hitCount": 50, "nextCursorMark": "AoE50"}
+
+    def test_02_split_anywhere(self):
+        # the same items, however the document is cut up, including in the middle of numbers, strings,
+        # escapes and multi-byte characters
+        results = [{"id": i, "title": u"Caf\xe9 \u2013 \"quoted\" \\ %s" % i, "score": 12345.678 * i} for i in range(20)]
+        text = self.page(results, hitCount=20, nextCursorMark="AoE20")
+        for size in [1, 2, 3, 7, 64, 1000, len(text) * 4]:
+            stream = U_JSONStream(_pieces(text, size), PATH)
+            assert list(stream.results()) == results, size
+            assert stream.header["hitCount"] == 20
+            assert stream.header["nextCursorMark"] == "AoE20"
+
+    def test_03_header_before_results(self):
+        # members before the list are in the header by the time the first item is handed out
+        text = '{"hitCount": 2, "nextCursorMark": "AoE2", "resultList": {"result": [{"id": 1}, {"id": 2}]}, "after": true}'
+        stream = U_JSONStream(_pieces(text, 5), PATH)
+        items = stream.results()
+        assert next(items) == {"id": 1}
+        assert stream.header == {"hitCount": 2, "nextCursorMark": "AoE2"}
+        assert list(items) == [{"id": 2}]
+        # and the ones after it once it has been read
+        assert stream.header["after"] is True
+
+    def test_04_empty(self):
+        for text in ['{"hitCount": 0, "resultList": {"result": []}}', '{"hitCount": 0, "resultList": {}}', '{}']:
+            stream = U_JSONStream(_pieces(text, 3), PATH)
+            assert list(stream.results()) == []
+
+    def test_05_lazy(self):
+        # pieces are only read as the items are needed
+        read = []
+
+        def chunks():
+            for piece in _pieces(self.page([{"id": i} for i in range(100)]), 10):
+                read.append(piece)
+                yield piece
+
+        items = U_JSONStream(chunks(), PATH).results()
+        assert next(items) == {"id": 0}
+        assert len(read) < 10
+        assert len(list(items)) == 99
+
+    def test_06_not_well_formed(self):
+        for text in ['{"resultList": {"result": [{"id": 1}, {"id": 2}', '{"resultList": {"result": [{"id": 1} {"id": 2}]}}', '<html></html>']:
+            with self.assertRaises(EH.IncorrectFormatError):
+                list(U_JSONStream(_pieces(text, 4), PATH).results())
+
+    def test_07_close(self):
+        # a stream given up on part way closes what it reads from, whether or not it was started
+        class Chunks(object):
+            closed = False
+
+            def __iter__(self):
+                return iter(_pieces('{"resultList": {"result": [{"id": 1}, {"id": 2}]}}', 5))
+
+            def close(self):
+                self.closed = True
+
+        for started in [True, False]:
+            chunks = Chunks()
+            stream = U_JSONStream(chunks, PATH)
+            items = stream.results()
+            if started:
+                assert next(items) == {"id": 1}
+            stream.close()
+            assert stream.closed and chunks.closed
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -60,6 +60,9 @@ ESDAO_TIME_BOX_ROUTED = "month"
 ESDAO_TIME_BOX_LOOKBACK_ROUTED = 3
 """number of time-boxes to use for lookback when retrieving/deleting routed notifications"""
 
+ROUTED_BOX_CACHE_SIZE = 50000
+"""number of routed notification ids for which each process remembers the time-box they are in, so they can be retrieved from that box directly"""
+
 ###########################################
 # Email configuration
 MAIL_FROM_ADDRESS = "us@cottagelabs.com"    # FIXME: actual from address
@@ -77,6 +80,39 @@ ACCOUNT_ENABLE = True
 SECRET_KEY = "super-secret-key"
 """secret key for session management"""
 
+OUTGOING_CACHE_SIZE = 5000
+"""number of serialised outgoing notifications to keep in each process, for serving the notification list and retrieval API quickly; 0 turns the cache off"""
+
+ACCOUNT_CACHE_TTL = 60
+"""seconds for which accounts looked up in bulk (e.g. while routing and reporting) are cached in each process; 0 turns the cache off"""
+
+ACCOUNT_CACHE_SIZE = 10000
+"""maximum number of accounts each process keeps in that cache, the least recently used being dropped first"""
+
+API_KEY_CACHE_TTL = 10
+"""seconds for which each process remembers the account an API key belongs to. Saving or deleting an account removes it at once from the process which did so, but a change made in another process (e.g. a new API key, or a change of role) only takes effect there once this time has passed; 0 turns the cache off"""
+
+API_KEY_CACHE_SIZE = 10000
+"""maximum number of API keys each process remembers"""
+
+CONTENTLOG_BATCH = 100
+"""number of content retrieval log entries to collect before writing them to the index together"""
+
+CONTENTLOG_FLUSH_INTERVAL = 5
+"""maximum seconds a content retrieval log entry waits before being written, if the batch doesn't fill first"""
+
+CONTENTLOG_BUFFER_MAX = 10000
+"""maximum number of content retrieval log entries each process holds waiting to be written; any more are dropped (and counted in /api/v1/stats)"""
+
+CONTENTLOG_FLUSH_TIMEOUT = 10
+"""seconds to wait for the index when writing a batch of content retrieval log entries, before giving up and dropping them"""
+
+DUPLICATE_CHECK = True
+"""whether to recognise incoming notifications which have already been received (by DOI, PMCID, PMID or content package hash) and not route them again. This applies to notifications created through the API and from FTP deposits; the harvester's temporary index is not checked"""
+
+DUPLICATE_WINDOW_DAYS = 30
+"""number of days for which a received notification's identifiers and package hash are used to recognise duplicates of it"""
+
 ############################################
 # Service-specific config
 
@@ -110,6 +146,18 @@ TMP_DIR = "/home/mark/ftptmp"
 RUN_SCHEDULE = False
 MOVEFTP_SCHEDULE = 10
 PROCESSFTP_SCHEDULE = 10
+PROCESSFTP_DIRECT = True
+"""submit FTP packages directly through the python API; set False to POST them to API_URL instead (e.g. if the API runs on another machine)"""
+PROCESSFTP_WORKERS = 4
+"""number of FTP packages to process at once, shared round-robin between the accounts that have deposits waiting"""
+PROCESSFTP_MAX_ATTEMPTS = 3
+"""number of runs on which an FTP deposit may fail before it is moved aside to PROCESSFTP_FAILED_DIR rather than tried again"""
+PROCESSFTP_FAILED_DIR = "/home/mark/ftpfailed"
+"""directory to which FTP deposits which keep failing are moved, into a subdirectory for each account"""
+FTP_WATCH = True
+"""watch the sftp jails with inotify (needs pyinotify, Linux only) and pick up deposits as soon as they are complete. The MOVEFTP/PROCESSFTP schedules still run as a fallback"""
+FTP_WATCH_QUIET = 30
+"""seconds an ftp account must go without upload activity before the watcher picks up its completed uploads"""
 CHECKUNROUTED_SCHEDULE = 10
 DELETE_ROUTED = True
 DELETE_UNROUTED = True
@@ -118,6 +166,16 @@ DELETE_UNROUTED = True
 REPORTSDIR = '/home/mark/jper_reports'
 SCHEDULE_MONTHLY_REPORTING = False
 
+# delivery counters, kept up to date as notifications are routed, so reports outlive the routed indexes
+DELIVERY_COUNTERS = True
+"""count each routed notification against its repositories and month in the delivery counters"""
+DELIVERY_COUNTER_BATCH = 100
+"""number of routed notifications to count up before writing the delivery counters out (they are also written at the end of each routing run)"""
+REPORT_FROM_COUNTERS = False
+"""build the delivery report from the delivery counters rather than the routed index. Reconcile the counters first (see SCHEDULE_RECONCILE_COUNTERS), so that they hold the counts from before they were introduced"""
+SCHEDULE_RECONCILE_COUNTERS = False
+"""rebuild the delivery counters each night from the routed notifications still in the index, correcting any counts that were lost"""
+
 # Scheduler can also remove old routed indexes
 SCHEDULE_DELETE_OLD_ROUTED = True
 SCHEDULE_KEEP_ROUTED_MONTHS = 3
@@ -135,6 +193,12 @@ STORE_JPER_URL = 'http://store'
 """StoreJper's base url"""
 #STORE_JPER_URL = 'http://localhost:5999'
 
+STORE_HEAD_TIMEOUT = 10
+"""seconds to wait for StoreJper to describe a file (its size and date) before content is requested from it, and to connect to it when it is"""
+
+STORE_READ_TIMEOUT = 60
+"""seconds to wait for each part of a file's content from StoreJper before giving up on it"""
+
 from octopus.lib import paths
 STORE_LOCAL_DIR = paths.rel2abs(__file__, "..", "service", "tests", "local_store", "live")
 """path to local directory for local file store (principally used for testing) - specified relative to this file"""
@@ -142,6 +206,13 @@ STORE_LOCAL_DIR = paths.rel2abs(__file__, "..", "service", "tests", "local_store
 STORE_TMP_DIR = paths.rel2abs(__file__, "..", "service", "tests", "local_store", "tmp")
 """path to local directory for temp file store - specified relative to this file"""
 
+STORE_JPER_LOCAL_DIR = None
+"""directory where StoreJper's files can be read directly (e.g. a mount of the store's disk), if they can; content is then served from there rather than fetched from STORE_JPER_URL"""
+
+CONTENT_ACCEL_REDIRECT = None
+#CONTENT_ACCEL_REDIRECT = "/protected_store/"
+"""nginx internal location (see deployment/jper_nginx) aliased to the local store directory; if set, content held on the local filesystem is sent by nginx via X-Accel-Redirect instead of through the app"""
+
 ############################################
 # Configuration for when the app is operated in functional testing mode
 
@@ -9,11 +9,12 @@ Go around it at your own risk!
 """
 
 from flask.ext.login import current_user
-from service import models, packages
+from service import models, packages, content
+from service.models import duplicates
 from octopus.lib import dates, dataobj, http
 from octopus.core import app
 from octopus.modules.store import store
-import uuid, json
+import uuid, json, base64
 
 
 class ValidationException(Exception):
@@ -176,6 +177,10 @@ class JPER(object):
         If creation succeeds, a new notification will appear in the "unrouted" notifications list in the system, and a
         copy of the created object will be returned.  If there is a problem, an appropriate Exception will be raised.
 
+        If the notification is a duplicate of one received within the last DUPLICATE_WINDOW_DAYS (see
+        models.DuplicateKey.claim), nothing is created, and the returned object carries the id of the
+        earlier notification.
+
         :param account: user Account object as which this action will be carried out
         :param notification: raw notification dict object (e.g. as pulled from a POST to the web API)
         :param file_handle: File handle to binary content associated with the notification
@@ -224,17 +229,32 @@ class JPER(object):
         # record the provider's account id against the notification
         note.provider_id = account.id
 
-        # if we've been given a file handle, save it
+        # if we've been given a file handle, serialise it to the Temporary Store, and hash it so we can
+        # recognise the same package if it is sent again
+        local_id = None
+        package_hash = None
         if file_handle is not None:
-            # get the format of the package
-            format = note.packaging_format
-
-            # generate ids for putting it into the store
             local_id = uuid.uuid4().hex
-
-            # get the Temporary Store implementation, and serialise the file handle to the local id
             tmp = store.StoreFactory.tmp()
             tmp.store(local_id, "incoming.zip", source_stream=file_handle)
+            package_hash = duplicates.package_hash(tmp.path(local_id, "incoming.zip"))
+
+        # if we have already received this notification recently (through the API, FTP or the harvester), don't
+        # ingest and route it again; the provider is given the id of the one we already have.  Otherwise its keys
+        # are claimed now, so that a copy of it which arrives while it is being ingested is recognised too
+        keys = models.DuplicateKey.keys(note.identifiers, package_hash)
+        dup = models.DuplicateKey.claim(keys, note.id, account.id, content=file_handle is not None)
+        if dup is not None:
+            if local_id is not None:
+                tmp.delete(local_id)
+            app.logger.info("Request:{z} - Create request from Account:{x} is a duplicate of Notification:{y}".format(z=magic, x=account.id, y=dup.notification))
+            note.id = dup.notification
+            return note
+
+        # if we've been given a file handle, ingest it
+        if file_handle is not None:
+            # get the format of the package
+            format = note.packaging_format
 
             # now try ingesting the temporarily stored package, using the note's id to store it
             # in the remote storage
@@ -247,6 +267,7 @@ class JPER(object):
             except packages.PackageException as e:
                 tmp.delete(local_id)
                 remote.delete(note.id)
+                models.DuplicateKey.release(keys)
                 app.logger.error("Request:{z} - Create request from Account:{x} failed with error '{y}'".format(z=magic, x=account.id, y=e.message))
                 raise ValidationException("Problem reading from the zip file: {x}".format(x=e.message))
 
@@ -259,7 +280,11 @@ class JPER(object):
 
         # if we get to here there was either no package, or the package saved successfully, so we can store the
         # note
-        note.save()
+        try:
+            note.save()
+        except:
+            models.DuplicateKey.release(keys)
+            raise
         app.logger.debug("Request:{z} - Create request from Account:{x} succeeded; Notification:{y}".format(z=magic, x=account.id, y=note.id))
         return note
 
@@ -273,6 +298,38 @@ class JPER(object):
         :param notification_id: identifier of the notification to be retrieved
         :return:
         """
+        note, provider = cls._find_notification(account, notification_id)
+        if note is None:
+            return None
+        return note.make_outgoing(provider=provider)
+
+    @classmethod
+    def get_notification_json(cls, account, notification_id):
+        """
+        Retrieve the notification as identified by the supplied notification_id, on behalf of the supplied Account,
+        as get_notification does, but already serialised to JSON.  Routed notifications are served from the cache
+        of outgoing notifications where possible.
+
+        :param account: user Account as which this action will be carried out
+        :param notification_id: identifier of the notification to be retrieved
+        :return: JSON string, or None if there is no such notification available to the account
+        """
+        note, provider = cls._find_notification(account, notification_id)
+        if note is None:
+            return None
+        if isinstance(note, models.RoutedNotification):
+            return models.RoutedNotification.outgoing_json(note.data, provider=provider)
+        return note.make_outgoing(provider=provider).json()
+
+    @classmethod
+    def _find_notification(cls, account, notification_id):
+        """
+        Find the notification as identified by the supplied notification_id, if it is available to the supplied Account
+
+        :param account: user Account as which this action will be carried out
+        :param notification_id: identifier of the notification to be retrieved
+        :return: tuple of the notification (or None if it is not found) and whether the account should see the provider's version
+        """
         try:
             accid = account.id
         except:
@@ -286,22 +343,22 @@ class JPER(object):
         if rn is not None:
             if accid == rn.provider_id:
                 app.logger.debug("Request:{z} - Retrieve request from Account:{x} on Notification:{y}; returns the provider's version of the routed notification".format(z=magic, x=accid, y=notification_id))
-                return rn.make_outgoing(provider=True)
+                return rn, True
             else:
                 app.logger.debug("Request:{z} - Retrieve request from Account:{x} on Notification:{y}; returns the public version of the routed notification".format(z=magic, x=accid, y=notification_id))
-                return rn.make_outgoing()
+                return rn, False
         if accid is not None and (account.has_role('publisher') or current_user.is_super):
             urn = models.UnroutedNotification.pull(notification_id)
             if urn is not None:
                 if accid == urn.provider_id:
                     app.logger.debug("Request:{z} - Retrieve request from Account:{x} on Notification:{y}; returns the provider's version of the unrouted notification".format(z=magic, x=accid, y=notification_id))
-                    return urn.make_outgoing(provider=True)
+                    return urn, True
                 else:
                     app.logger.debug("Request:{z} - Retrieve request from Account:{x} on Notification:{y}; returns the public version of the unrouted notification".format(z=magic, x=accid, y=notification_id))
-                    return urn.make_outgoing()
+                    return urn, False
 
         app.logger.debug("Request:{z} - Retrieve request from Account:{x} on Notification:{y}; no distributable notification of that id found".format(z=magic, x=accid, y=notification_id))
-        return None
+        return None, False
 
     @classmethod
     def get_content(cls, account, notification_id, filename=None):
@@ -316,6 +373,31 @@ class JPER(object):
         :param filename: filename of content to be retrieved
         :return:
         """
+        loc = cls._content_location(account, notification_id, filename)
+        if loc is None:
+            return None
+        sm = store.StoreFactory.get()
+        return sm.get(*loc) # returns None if not found
+
+    @classmethod
+    def get_stored_content(cls, account, notification_id, filename=None):
+        """
+        Find the content associated with the requested notification_id, on behalf of the supplied user account, as
+        for get_content, but rather than opening it, return a description of it from which any part of it may be read.
+
+        :param account: user Account as which to carry out this request
+        :param notification_id: id of the notification whose content to retrieve
+        :param filename: filename of content to be retrieved
+        :return: content.StoredContent, or None if not found
+        """
+        loc = cls._content_location(account, notification_id, filename)
+        if loc is None:
+            return None
+        return content.StoredContent.locate(*loc)
+
+    @classmethod
+    def _content_location(cls, account, notification_id, filename=None):
+        # work out which container and file in the store hold the requested content, if the account may have it
         magic = uuid.uuid4().hex
         urn = models.UnroutedNotification.pull(notification_id)
         if urn is not None and (account.has_role('publisher') or current_user.is_super):
@@ -324,9 +406,8 @@ class JPER(object):
             else:
                 pm = packages.PackageFactory.incoming(urn.packaging_format)
                 store_filename = pm.zip_name()
-            sm = store.StoreFactory.get()
             app.logger.debug("Request:{z} - Retrieve request from Account:{x} on Notification:{y} Content:{a}; returns unrouted notification stored file {b}".format(z=magic, x=account.id, y=notification_id, a=filename, b=store_filename))
-            return sm.get(urn.id, store_filename) # returns None if not found
+            return urn.id, store_filename
         else:
             rn = models.RoutedNotification.pull(notification_id)
             if rn is not None:
@@ -338,9 +419,8 @@ class JPER(object):
                     else:
                         pm = packages.PackageFactory.incoming(rn.packaging_format)
                         store_filename = pm.zip_name()
-                    sm = store.StoreFactory.get()
                     app.logger.debug("Request:{z} - Retrieve request from Account:{x} on Notification:{y} Content:{a}; returns routed notification stored file {b}".format(z=magic, x=account.id, y=notification_id, a=filename, b=store_filename))
-                    return sm.get(rn.id, store_filename)
+                    return rn.id, store_filename
                 else:
                     app.logger.debug("Request:{z} - Retrieve request from Account:{x} on Notification:{y} Content:{a}; not authorised to receive this content".format(z=magic, x=account.id, y=notification_id, a=filename))
                     raise UnauthorisedException()
@@ -374,23 +454,32 @@ class JPER(object):
                 return None
 
     @classmethod
-    def list_notifications(cls, account, since, page=None, page_size=None, repository_id=None):
+    def list_notifications(cls, account, since, page=None, page_size=None, repository_id=None, cursor=None):
         """
         List notification which meet the criteria specified by the parameters
 
+        Results can be paged through either by page number, or by passing back the "next" cursor from the previous
+        list.  The cursor carries on from the last notification in that list, so it does not get slower the further
+        through the results it goes, and does not skip or repeat notifications when new ones arrive.
+
         :param account: user Account as which to carry out this action (all users can request notifications, so this is primarily for logging purposes)
-        :param since: date string for the earliest notification date requested.  Should be of the form YYYY-MM-DDTHH:MM:SSZ, though other sensible formats may also work
-        :param page: page number in result set to return (which results appear will also depend on the page_size parameter)
+        :param since: date string for the earliest notification date requested.  Should be of the form YYYY-MM-DDTHH:MM:SSZ, though other sensible formats may also work.  Not needed with a cursor, which carries the since date with it
+        :param page: page number in result set to return (which results appear will also depend on the page_size parameter).  Ignored if a cursor is given
         :param page_size: number of results to return in this page of results
         :param repository_id: the id of the repository whose notifications to return.  If no id is provided, all notifications for all repositories will be queried.
+        :param cursor: the "next" value from a previous list, to carry on from the end of that list
         :return: models.NotificationList containing the parameters and results
         """
+        after = None
+        if cursor is not None:
+            since, after = cls._decode_cursor(cursor)
+
         try:
             since = dates.parse(since)
         except ValueError as e:
             raise ParameterException("Unable to understand since date '{x}'".format(x=since))
 
-        if page == 0:
+        if after is None and page == 0:
             raise ParameterException("'page' parameter must be greater than or equal to 1")
 
         if page_size == 0 or page_size > app.config.get("MAX_LIST_PAGE_SIZE"):
@@ -398,7 +487,6 @@ class JPER(object):
 
         nl = models.NotificationList()
         nl.since = dates.format(since)
-        nl.page = page
         nl.page_size = page_size
         nl.timestamp = dates.now()
         qr = {
@@ -419,10 +507,29 @@ class JPER(object):
                     }
                 }
             },
-            "sort": [{"analysis_date":{"order":"asc"}}],
-            "from": (page - 1) * page_size,
+            # the id breaks ties between notifications analysed in the same second, so the order is always the same
+            "sort": [{"analysis_date":{"order":"asc"}}, {"id.exact":{"order":"asc"}}],
             "size": page_size
         }
+
+        if after is None:
+            nl.page = page
+            qr["from"] = (page - 1) * page_size
+        else:
+            # carry on from the last notification of the previous list: anything analysed later, or at the
+            # same time but with a later id
+            last_date, last_id = after
+            qr['query']['filtered']['filter']['bool']['must'].append({
+                "bool": {
+                    "should": [
+                        {"range": {"analysis_date": {"gt": last_date}}},
+                        {"bool": {"must": [
+                            {"term": {"analysis_date": last_date}},
+                            {"range": {"id.exact": {"gt": last_id}}}
+                        ]}}
+                    ]
+                }
+            })
         
         if repository_id is not None:
             qr['query']['filtered']['filter']['bool']['must'].append( { "term": { "repositories.exact": repository_id } })
@@ -430,11 +537,36 @@ class JPER(object):
         else:
             app.logger.debug('List all notifications for query ' + json.dumps(qr))
 
-        res = models.RoutedNotification.query(q=qr)
+        # only the boxes from the since date (or the cursor's position, if later) onwards can hold anything to list
+        earliest = nl.since
+        if after is not None and after[0] is not None and after[0] > earliest:
+            earliest = after[0]
+        res = models.RoutedNotification.query_since(earliest, qr)
         app.logger.debug('List all notifications query resulted ' + json.dumps(res))
-        nl.notifications = [models.RoutedNotification(i['_source']).make_outgoing().data for i in res.get('hits',{}).get('hits',[])]
+        hits = res.get('hits',{}).get('hits',[])
+        nl.set_rendered_notifications([models.RoutedNotification.outgoing_json(i['_source']) for i in hits])
         nl.total = res.get('hits',{}).get('total',0)
+
+        # the cursor for the next list carries on from the last notification in this one; if there wasn't one, the
+        # cursor we were given still marks the place, for when more notifications arrive
+        if len(hits) > 0:
+            last = hits[-1]['_source']
+            nl.next = cls._encode_cursor(nl.since, last.get("analysis_date"), last.get("id"))
+        elif cursor is not None:
+            nl.next = cursor
         return nl
 
+    @classmethod
+    def _encode_cursor(cls, since, analysis_date, id):
+        return base64.urlsafe_b64encode(json.dumps([since, analysis_date, id]))
+
+    @classmethod
+    def _decode_cursor(cls, cursor):
+        try:
+            since, analysis_date, id = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        except:
+            raise ParameterException("Unable to understand 'next' cursor '{x}'".format(x=cursor))
+        return since, (analysis_date, id)
+
 
 
@@ -0,0 +1,171 @@
+"""
+Access to the content files held in the main store for delivery to API clients: their size, modification time and
+a strong validator, and the ability to read any byte range of them, so that downloads can be resumed and conditional
+requests answered without re-sending the file.
+
+Stored content is never modified once written (a new notification gets a new container), so the validators are
+derived from the container, name, size and modification time rather than by hashing the bytes.
+"""
+
+from octopus.core import app
+from octopus.modules.store import store
+from email.utils import parsedate_tz, mktime_tz
+import os, hashlib, requests, urllib
+
+CHUNK_SIZE = 65536
+"""bytes read from the store at a time when streaming content out"""
+
+class StoredContent(object):
+    """
+    A single file in the main store
+    """
+
+    def __init__(self, container_id, filename, size=None, last_modified=None, path=None, url=None):
+        """
+        :param container_id: the store container (notification id) holding the file
+        :param filename: the name of the file in the container
+        :param size: size of the file in bytes, or None if the store can't say
+        :param last_modified: modification time as seconds since the epoch, or None if the store can't say
+        :param path: the file's path on the local filesystem, if it can be read directly
+        :param url: the file's url, if it is read over http
+        """
+        self.container_id = container_id
+        self.filename = filename
+        self.size = size
+        self.last_modified = last_modified
+        self.path = path
+        self.url = url
+
+    @classmethod
+    def locate(cls, container_id, filename):
+        """
+        Find a file in the main store
+
+        :param container_id: the store container (notification id) holding the file
+        :param filename: the name of the file in the container
+        :return: StoredContent for the file, or None if there is no such file
+        """
+        sm = store.StoreFactory.get()
+        if isinstance(sm, store.StoreLocal):
+            return cls._local(app.config.get("STORE_LOCAL_DIR"), container_id, filename)
+        if isinstance(sm, store.StoreJper):
+            local_dir = app.config.get("STORE_JPER_LOCAL_DIR")
+            if local_dir is not None:
+                found = cls._local(local_dir, container_id, filename)
+                if found is not None:
+                    return found
+            return cls._remote(app.config.get("STORE_JPER_URL"), container_id, filename)
+
+        # some other store, which can only hand back the whole file
+        if sm.get(container_id, filename) is None:
+            return None
+        return cls(container_id, filename)
+
+    @classmethod
+    def _local(cls, directory, container_id, filename):
+        path = os.path.join(directory, container_id, filename)
+        if not os.path.isfile(path):
+            return None
+        st = os.stat(path)
+        return cls(container_id, filename, size=st.st_size, last_modified=int(st.st_mtime), path=path)
+
+    @classmethod
+    def _remote(cls, base_url, container_id, filename):
+        url = base_url + '/' + urllib.quote(container_id) + '/' + urllib.quote(filename)
+        r = requests.head(url, timeout=app.config.get("STORE_HEAD_TIMEOUT", 10))
+        if r.status_code != 200:
+            return None
+        size = r.headers.get("content-length")
+        lm = r.headers.get("last-modified")
+        if lm is not None:
+            lm = parsedate_tz(lm)
+            lm = mktime_tz(lm) if lm is not None else None
+        return cls(container_id, filename, size=int(size) if size is not None else None, last_modified=lm, url=url)
+
+    @property
+    def etag(self):
+        """
+        Strong entity tag for the file, or None if there isn't enough known about it to make one
+
+        :return: the (unquoted) etag
+        """
+        if self.size is None or self.last_modified is None:
+            return None
+        key = u"{a}/{b}/{c}/{d}".format(a=self.container_id, b=self.filename, c=self.size, d=self.last_modified)
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    @property
+    def accel_redirect(self):
+        """
+        The internal location from which nginx can serve this file itself, if it is on the local filesystem and
+        CONTENT_ACCEL_REDIRECT is configured
+
+        :return: the location to send in the X-Accel-Redirect header, or None
+        """
+        prefix = app.config.get("CONTENT_ACCEL_REDIRECT")
+        if prefix is None or self.path is None:
+            return None
+        return prefix.rstrip("/") + "/" + urllib.quote(self.container_id) + "/" + urllib.quote(self.filename)
+
+    def stream(self, start=0, end=None):
+        """
+        Read the bytes of the file from start up to (but not including) end
+
+        :param start: the first byte to read
+        :param end: the byte to stop before, or None to read to the end of the file
+        :return: generator of chunks of the file
+        """
+        if self.path is not None:
+            return self._stream_local(start, end)
+        if self.url is not None:
+            return self._stream_remote(start, end)
+        return self._stream_store(start, end)
+
+    def _stream_local(self, start, end):
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            remaining = None if end is None else end - start
+            while remaining is None or remaining > 0:
+                chunk = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def _stream_remote(self, start, end):
+        headers = {}
+        if start > 0 or end is not None:
+            headers["Range"] = "bytes={a}-{b}".format(a=start, b="" if end is None else end - 1)
+        # connecting is bounded as the HEAD is, and then each wait between chunks of the body
+        timeout = (app.config.get("STORE_HEAD_TIMEOUT", 10), app.config.get("STORE_READ_TIMEOUT", 60))
+        r = requests.get(self.url, headers=headers, stream=True, timeout=timeout)
+        try:
+            skip = 0 if r.status_code == 206 else start
+            for chunk in self._window(r.iter_content(CHUNK_SIZE), skip, None if end is None else end - start):
+                yield chunk
+        finally:
+            r.close()
+
+    def _stream_store(self, start, end):
+        f = store.StoreFactory.get().get(self.container_id, self.filename)
+        chunks = iter(lambda: f.read(CHUNK_SIZE), "")
+        for chunk in self._window(chunks, start, None if end is None else end - start):
+            yield chunk
+
+    def _window(self, chunks, skip, length):
+        # pass on length bytes (or all of them, if length is None) of the chunks, after skipping the first skip
+        for chunk in chunks:
+            if skip > 0:
+                if len(chunk) <= skip:
+                    skip -= len(chunk)
+                    continue
+                chunk = chunk[skip:]
+                skip = 0
+            if length is not None:
+                chunk = chunk[:length]
+                length -= len(chunk)
+            if chunk:
+                yield chunk
+            if length is not None and length <= 0:
+                break
@@ -8,10 +8,168 @@ query methods as required
 """
 
 from octopus.modules.es import dao
+from octopus.core import app
+from threading import Lock
+from copy import deepcopy
+from collections import OrderedDict
+from datetime import datetime
+import requests, json, time, hashlib
+
+class LRUCache(object):
+    """
+    Small thread-safe least-recently-used cache, whose size is taken from the app config each time it is added to
+    """
+
+    def __init__(self, size_config, default_size):
+        """
+        :param size_config: name of the config setting holding the maximum number of entries (0 turns the cache off)
+        :param default_size: the maximum number of entries if there is no such setting
+        """
+        self.size_config = size_config
+        self.default_size = default_size
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """
+        :param key: the cache key
+        :return: the cached value, or None if it is not cached
+        """
+        with self._lock:
+            val = self._entries.pop(key, None)
+            if val is not None:
+                self._entries[key] = val
+            return val
+
+    def put(self, key, val):
+        """
+        Cache a value, dropping the least recently used if the cache is full
+
+        :param key: the cache key
+        :param val: the value
+        """
+        size = app.config.get(self.size_config, self.default_size)
+        if size <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = val
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+
+    def remove(self, key):
+        """
+        :param key: the cache key to forget
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def remove_where(self, match):
+        """
+        :param match: function which takes a key and value, and returns True if that entry should be forgotten
+        """
+        with self._lock:
+            for k in [k for k, v in self._entries.iteritems() if match(k, v)]:
+                del self._entries[k]
+
+    def clear(self):
+        """
+        Empty the cache
+        """
+        with self._lock:
+            self._entries.clear()
 
 class ContentLogDAO(dao.ESDAO):
     __type__ = 'contentlog'
 
+class DuplicateKeyDAO(dao.ESDAO):
+    """
+    DAO for DuplicateKeys, which are always looked up and written many at a time by id, and are only written if the
+    key in the index is as expected, so that two notifications can't both claim the same key
+    """
+
+    __type__ = 'duplicate_key'
+    """ The index type to use to store these objects """
+
+    @classmethod
+    def pull_many(cls, ids, versions=False):
+        """
+        Retrieve many keys at once, with a single (realtime) multi-get
+
+        :param ids: list of key ids
+        :param versions: also give the index version of each key, so that it can be replaced only if it is unchanged
+        :return: dict of key id to key object (or to a tuple of key object and version), for each of the ids which exists
+        """
+        if len(ids) == 0:
+            return {}
+        r = requests.post(app.config['ELASTIC_SEARCH_HOST'] + '/' + app.config['ELASTIC_SEARCH_INDEX'] + '/' + cls.__type__ + '/_mget',
+                          data=json.dumps({"ids" : list(ids)}))
+        docs = [doc for doc in r.json().get("docs", []) if doc.get("found")]
+        if versions:
+            return dict([(doc["_id"], (cls(doc["_source"]), doc.get("_version"))) for doc in docs])
+        return dict([(doc["_id"], cls(doc["_source"])) for doc in docs])
+
+    @classmethod
+    def create_many(cls, keys):
+        """
+        Write many keys at once, with a single bulk request, each only if there is no key with its id already
+
+        :param keys: list of key objects, each with its id set
+        :return: list of the ids of the keys which were not written because they already exist
+        """
+        return cls._bulk([({"create" : {"_id" : k.id}}, k.data) for k in keys])
+
+    @classmethod
+    def replace_many(cls, keys):
+        """
+        Write many keys at once, with a single bulk request, each replacing the existing key only if that is unchanged
+
+        :param keys: list of tuples of key object and the version of the key it replaces (from pull_many), or None
+            if there is no key to replace
+        :return: list of the ids of the keys which were not written because the key they replace has changed
+        """
+        actions = []
+        for k, version in keys:
+            if version is None:
+                actions.append(({"create" : {"_id" : k.id}}, k.data))
+            else:
+                actions.append(({"index" : {"_id" : k.id, "_version" : version}}, k.data))
+        return cls._bulk(actions)
+
+    @classmethod
+    def delete_many(cls, ids):
+        """
+        Delete many keys at once, with a single bulk request
+
+        :param ids: list of key ids
+        """
+        cls._bulk([({"delete" : {"_id" : id}}, None) for id in ids])
+
+    @classmethod
+    def _bulk(cls, actions):
+        # send the actions (each a tuple of the action line and the document, if it has one), and give back the ids
+        # of those which conflicted with the key in the index
+        if len(actions) == 0:
+            return []
+        data = ''
+        for action, source in actions:
+            data += json.dumps(action) + '\n'
+            if source is not None:
+                data += json.dumps(source) + '\n'
+        r = requests.post(app.config['ELASTIC_SEARCH_HOST'] + '/' + app.config['ELASTIC_SEARCH_INDEX'] + '/' + cls.__type__ + '/_bulk', data=data)
+        if r.status_code != 200:
+            app.logger.error(u"Duplicate keys - could not write {x} keys to the index, bulk request returned {y}".format(x=len(actions), y=r.status_code))
+            return []
+        conflicts = []
+        for item in r.json().get("items", []):
+            result = item.values()[0]
+            status = result.get("status", 200)
+            if status == 409:
+                conflicts.append(result.get("_id"))
+            elif status >= 300 and not (status == 404 and "delete" in item):
+                app.logger.error(u"Duplicate keys - could not write key {x}, returned {y}".format(x=result.get("_id"), y=status))
+        return conflicts
+
 class UnroutedNotificationDAO(dao.ESDAO):
     """
     DAO for UnroutedNotifications
@@ -40,6 +198,9 @@ class RoutedNotificationDAO(dao.TimeBoxedTypeESDAO):
     __type__ = 'routed'
     """ The base index type to use to store these objects - this will be appended by the time-boxing features of the DAO with the creation timestamp """
 
+    _boxes = LRUCache("ROUTED_BOX_CACHE_SIZE", 50000)
+    """ which time-boxed type each recently seen notification id is in """
+
     @classmethod
     def example(cls):
         """
@@ -48,6 +209,75 @@ class RoutedNotificationDAO(dao.TimeBoxedTypeESDAO):
         from service.tests import fixtures
         return cls(fixtures.NotificationFactory.routed_notification())
 
+    @classmethod
+    def read_types_since(cls, since):
+        """
+        The read types which could hold notifications created on or after the since date.
+
+        A notification is written to the box for the time it was saved, which is never before it was created, so
+        any box which ends before the since date can be left out.  The type names end with the box's start time as
+        YYYYMM (or longer, for shorter boxes), which is compared with the same part of the since date.
+
+        :param since: the since date, as a datetime or a YYYY-MM-DDThh:mm:ssZ string
+        :return: list of type names
+        """
+        if not isinstance(since, datetime):
+            since = datetime.strptime(since, "%Y-%m-%dT%H:%M:%SZ")
+        stamp = since.strftime("%Y%m%d%H%M%S")
+        types = []
+        for t in cls.get_read_types():
+            box = t[len(cls.__type__):]
+            if box.isdigit() and box < stamp[:len(box)]:
+                continue
+            types.append(t)
+        return types
+
+    @classmethod
+    def query_since(cls, since, q):
+        """
+        Query just the read types which could hold notifications created on or after the since date, and remember
+        which type each notification found is in
+
+        :param since: the since date, as a datetime or a YYYY-MM-DDThh:mm:ssZ string
+        :param q: the query
+        :return: the raw query response
+        """
+        res = cls.query(q=q, types=cls.read_types_since(since))
+        for hit in res.get("hits", {}).get("hits", []):
+            cls._boxes.put(hit.get("_id"), hit.get("_type"))
+        return res
+
+    @classmethod
+    def pull(cls, id_):
+        """
+        Retrieve a notification by id.  If we know which type it is in it is got from there directly, otherwise
+        all the read types are tried in one multi-get.
+
+        :param id_: the notification id
+        :return: the notification, or None if it is not found
+        """
+        if id_ is None:
+            return None
+        box = cls._boxes.get(id_)
+        types = [box] if box is not None else cls.get_read_types()
+        r = requests.post(app.config['ELASTIC_SEARCH_HOST'] + '/' + app.config['ELASTIC_SEARCH_INDEX'] + '/_mget',
+                          data=json.dumps({"docs" : [{"_type" : t, "_id" : id_} for t in types]}))
+        for doc in r.json().get("docs", []):
+            if doc.get("found"):
+                cls._boxes.put(id_, doc["_type"])
+                return cls(doc["_source"])
+
+        # if it wasn't where we thought it was (e.g. its box has been deleted), forget that, and look everywhere
+        if box is not None:
+            cls._boxes.remove(id_)
+            return cls.pull(id_)
+        return None
+
+    def save(self, *args, **kwargs):
+        box = self.get_write_type()
+        super(RoutedNotificationDAO, self).save(*args, **kwargs)
+        self._boxes.put(self.id, box)
+
 class FailedNotificationDAO(dao.ESDAO):
     """
     DAO for FailedNotifications
@@ -111,6 +341,81 @@ class MatchProvNotificationQuery(object):
             "size" : self.size
         }
 
+class DeliveryCounterDAO(dao.ESDAO):
+    """
+    DAO for DeliveryCounter
+    """
+
+    __type__ = "delivery_counter"
+    """ The index type to use to store these objects """
+
+    MAPPING = {
+        "date_detection" : False,
+        "properties" : {
+            "month" : {
+                "type" : "string",
+                "index" : "not_analyzed",
+                "fields" : {"exact" : {"type" : "string", "index" : "not_analyzed"}}
+            },
+            "repository" : {
+                "type" : "string",
+                "index" : "not_analyzed",
+                "fields" : {"exact" : {"type" : "string", "index" : "not_analyzed"}}
+            }
+        }
+    }
+    """ Explicit mapping for the counters - left to itself, ES would take the YYYY-MM months for dates """
+
+    @classmethod
+    def ensure_mapping(cls):
+        """
+        Put the explicit mapping for the counters in place, if the type does not exist yet
+        """
+        base = app.config['ELASTIC_SEARCH_HOST'] + '/' + app.config['ELASTIC_SEARCH_INDEX']
+        r = requests.get(base + '/_mapping/' + cls.__type__)
+        if r.status_code == 200 and len(r.json()) > 0:
+            return
+        r = requests.put(base + '/' + cls.__type__ + '/_mapping', data=json.dumps({cls.__type__ : cls.MAPPING}))
+        if r.status_code != 200:
+            app.logger.error(u"Delivery counters - could not put the mapping in place: {x}".format(x=r.text))
+
+    @classmethod
+    def pull_by_months(cls, months):
+        """
+        List all of the delivery counters for the requested months
+
+        :param months: list of months, as YYYY-MM strings
+        """
+        q = DeliveryCounterMonthQuery(months)
+        return cls.object_query(q=q.query())
+
+class DeliveryCounterMonthQuery(object):
+    """
+    Query wrapper which generates an ES query for retrieving the delivery counters for a set of months
+    """
+    def __init__(self, months, size=10000):
+        """
+        Set the parameters of the query
+
+        :param months: list of months, as YYYY-MM strings
+        :param size: the maximum number to return - there is one counter per repository per month, plus the unique counters
+        """
+        self.months = months
+        self.size = size
+
+    def query(self):
+        """
+        generate the query as a python dictionary object
+
+        :return: a python dictionary containing the ES query, ready for JSON serialisation
+        """
+        return {
+            "query" : {
+                "terms" : {"month.exact" : self.months}
+            },
+            "size" : self.size
+        }
+
 class RetrievalRecordDAO(dao.ESDAO):
     """
     DAO for RetrievalRecord
@@ -122,7 +427,115 @@ class RetrievalRecordDAO(dao.ESDAO):
 class AccountDAO(dao.ESDAO):
     """
     DAO for Account
+
+    Accounts fetched with pull_many are kept in a short-lived in-process cache (for ACCOUNT_CACHE_TTL seconds, and at
+    most ACCOUNT_CACHE_SIZE accounts), as the same few repository accounts are looked up over and over while routing
+    and reporting.  Likewise accounts looked up by API key are cached (for API_KEY_CACHE_TTL seconds) as every API
+    request does this.  Saving or deleting an account through this class removes it from both caches.
     """
 
     __type__ = "account"
     """ The index type to use to store these objects """
+
+    _cache = LRUCache("ACCOUNT_CACHE_SIZE", 10000)
+    """ accounts by id, with the time they were cached """
+
+    _api_keys = LRUCache("API_KEY_CACHE_SIZE", 10000)
+    """ accounts by hashed api key, with the time they were cached """
+
+    _api_key_stats = {"hits" : 0, "misses" : 0}
+    _api_key_stats_lock = Lock()
+
+    @classmethod
+    def pull_by_api_key(cls, api_key):
+        """
+        Retrieve the account with the given API key, from the cache if it was looked up in the last API_KEY_CACHE_TTL
+        seconds
+
+        Saving or deleting the account in this process removes it from the cache, so such a change takes effect at
+        once; a change made by another process takes effect once the cached account expires.
+
+        :param api_key: the API key
+        :return: the account, or None if no account (or more than one) has this key
+        """
+        hashed = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+        ttl = app.config.get("API_KEY_CACHE_TTL", 10)
+        now = time.time()
+        cached = cls._api_keys.get(hashed)
+        hit = cached is not None and now - cached[0] < ttl
+        with cls._api_key_stats_lock:
+            cls._api_key_stats["hits" if hit else "misses"] += 1
+        if hit:
+            return cls(deepcopy(cached[1]))
+        if cached is not None:
+            cls._api_keys.remove(hashed)
+
+        q = {"query" : {"query_string" : {"query" : 'api_key:"' + api_key + '"'}}}
+        res = cls.query(q=q).get('hits', {}).get('hits', [])
+        if len(res) != 1:
+            return None
+        source = res[0]['_source']
+        if ttl > 0:
+            cls._api_keys.put(hashed, (now, source))
+        return cls(deepcopy(source))
+
+    @classmethod
+    def api_key_cache_stats(cls):
+        """
+        :return: dict of the number of API key lookups answered from the cache ("hits") and from the index ("misses")
+        """
+        with cls._api_key_stats_lock:
+            return dict(cls._api_key_stats)
+
+    @classmethod
+    def pull_many(cls, ids):
+        """
+        Retrieve many accounts at once, from the cache where possible and with a single multi-get for the rest
+
+        :param ids: list of account ids
+        :return: dict of account id to account object, for each of the ids which exists
+        """
+        ttl = app.config.get("ACCOUNT_CACHE_TTL", 60)
+        now = time.time()
+        found = {}
+        missing = []
+        for i in set(ids):
+            cached = cls._cache.get(i)
+            if cached is not None and now - cached[0] < ttl:
+                found[i] = cached[1]
+            else:
+                missing.append(i)
+
+        if len(missing) > 0:
+            r = requests.post(app.config['ELASTIC_SEARCH_HOST'] + '/' + app.config['ELASTIC_SEARCH_INDEX'] + '/' + cls.__type__ + '/_mget',
+                              data=json.dumps({"ids" : missing}))
+            for doc in r.json().get("docs", []):
+                if doc.get("found"):
+                    found[doc["_id"]] = doc["_source"]
+                    if ttl > 0:
+                        cls._cache.put(doc["_id"], (now, doc["_source"]))
+
+        # each caller gets its own copy, so changes to one can't leak into the cache
+        return dict([(k, cls(deepcopy(v))) for k, v in found.iteritems()])
+
+    @classmethod
+    def uncache(cls, id=None):
+        """
+        Remove an account from the caches, or empty the caches entirely
+
+        :param id: the account id, or None to remove all accounts
+        """
+        if id is None:
+            cls._cache.clear()
+            cls._api_keys.clear()
+        else:
+            cls._cache.remove(id)
+            cls._api_keys.remove_where(lambda k, v: v[1].get("id") == id)
+
+    def save(self, *args, **kwargs):
+        super(AccountDAO, self).save(*args, **kwargs)
+        self.uncache(self.id)
+
+    def delete(self, *args, **kwargs):
+        super(AccountDAO, self).delete(*args, **kwargs)
+        self.uncache(self.id)
@@ -0,0 +1,143 @@
+"""
+Filesystem event watcher for the publishers' SFTP jails.
+
+Rather than waiting for the next moveftp/processftp tick, this watches each user's xfer directory with inotify
+and, once an account has finished uploading something and then gone quiet for a short time, hands that account
+to a callback (which in the scheduler moves and processes the deposit straight away).
+
+"Finished uploading" means a file was closed after being written, or moved into place (which is how clients
+that upload to a temporary name and then rename behave). Any write activity on the account resets its quiet
+period, so a second large file still being uploaded holds back the account until it too is complete.
+
+inotify is Linux only, and needs the optional pyinotify package. If it is not available, start() says so and
+returns False, and the scheduler's polling of the directories carries on as the only means of pick-up.
+"""
+
+from octopus.core import app
+from threading import Thread, Lock
+import os, time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+class FTPWatcher(object):
+    """
+    Keeps track of which accounts have completed uploads waiting, and when they were last active
+    """
+
+    def __init__(self, userdir, callback, quiet=30):
+        """
+        :param userdir: the directory containing a directory (with an xfer directory inside it) for each ftp user
+        :param callback: function to call with an account id when that account has uploads ready to be picked up
+        :param quiet: number of seconds an account must have been inactive before its uploads are picked up
+        """
+        self.userdir = os.path.abspath(userdir)
+        self.callback = callback
+        self.quiet = quiet
+        self._last_active = {}
+        self._completed = set()
+        self._lock = Lock()
+
+    def account_for(self, path):
+        """
+        Work out the account that a path in the user directory belongs to
+
+        :param path: path to a file or directory somewhere under userdir
+        :return: the account id, or None if the path is not inside an account's xfer directory
+        """
+        rel = os.path.relpath(os.path.abspath(path), self.userdir).split(os.sep)
+        if len(rel) < 3 or rel[0] == os.pardir or rel[1] != "xfer":
+            return None
+        return rel[0]
+
+    def activity(self, path, completed=False, now=None):
+        """
+        Record activity on a path
+
+        :param path: the path on which the event happened
+        :param completed: True if the event means a file has finished arriving (closed after writing, or moved in)
+        :param now: the time of the event, defaults to now
+        """
+        account = self.account_for(path)
+        if account is None:
+            return
+        with self._lock:
+            self._last_active[account] = time.time() if now is None else now
+            if completed:
+                self._completed.add(account)
+
+    def ready(self, now=None):
+        """
+        Get, and forget about, the accounts which have completed uploads and have been quiet for long enough
+
+        :param now: the time to measure quietness against, defaults to now
+        :return: list of account ids
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            accounts = [a for a in self._completed if now - self._last_active.get(a, 0) >= self.quiet]
+            for a in accounts:
+                self._completed.discard(a)
+                del self._last_active[a]
+        return accounts
+
+    def dispatch(self, now=None):
+        """
+        Call the callback for each account that is ready.  Errors are logged, so one account can't stop the watcher
+        """
+        for account in self.ready(now):
+            try:
+                self.callback(account)
+            except Exception as e:
+                app.logger.error("FTP watcher - failed handling uploads for Account:{x} - '{y}'".format(x=account, y=e.message))
+
+    def watch(self):
+        """
+        Watch the user directory for events, and dispatch ready accounts, forever.  Requires pyinotify
+        """
+        wm = pyinotify.WatchManager()
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MODIFY | pyinotify.IN_CREATE
+        watcher = self
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_IN_CLOSE_WRITE(self, event):
+                watcher.activity(event.pathname, completed=True)
+
+            def process_IN_MOVED_TO(self, event):
+                watcher.activity(event.pathname, completed=True)
+
+            def process_IN_MODIFY(self, event):
+                watcher.activity(event.pathname)
+
+            def process_IN_CREATE(self, event):
+                # a whole directory being uploaded shows up as its files closing, so just note the activity
+                watcher.activity(event.pathname)
+
+        # auto_add picks up new account directories, and directories uploaded into the jails, as they appear
+        notifier = pyinotify.Notifier(wm, Handler(), timeout=1000)
+        wm.add_watch(self.userdir, mask, rec=True, auto_add=True)
+        app.logger.info("FTP watcher - watching " + self.userdir + " with a quiet period of " + str(self.quiet) + "s")
+        while True:
+            if notifier.check_events():
+                notifier.read_events()
+                notifier.process_events()
+            self.dispatch()
+
+    def start(self):
+        """
+        Start watching in a background thread
+
+        :return: True if the watcher started, False if inotify is not available here
+        """
+        if pyinotify is None:
+            app.logger.info("FTP watcher - pyinotify is not available, FTP deposits will only be picked up by the scheduled polling")
+            return False
+        if not os.path.isdir(self.userdir):
+            app.logger.error("FTP watcher - " + self.userdir + " does not exist, FTP deposits will only be picked up by the scheduled polling")
+            return False
+        thread = Thread(target=self.watch)
+        thread.daemon = True
+        thread.start()
+        return True
@@ -5,6 +5,7 @@ Model objects which are used in providing the Python API to JPER
 from octopus.lib import dataobj
 from service.models.notifications import NotificationMetadata, UnroutedNotification
 from copy import deepcopy
+import json
 
 class IncomingNotification(NotificationMetadata):
     """
@@ -216,6 +217,7 @@ class NotificationList(dataobj.DataObj):
             "pageSize" : "<number of results per page>,
             "timestamp" : "<timestamp of this request in the form YYYY-MM-DDThh:mm:ssZ>",
             "total" : "<total number of results at this time>",
+            "next" : "<cursor to pass back to carry on from the end of this list>",
             "notifications" : [
                 "<ordered list of OutgoingNotification JSON objects>"
             ]
@@ -317,6 +319,25 @@ class NotificationList(dataobj.DataObj):
         """
         self._set_single("total", val, coerce=self._int())
 
+    @property
+    def next(self):
+        """
+        The cursor which carries on from the last notification in this list
+
+        :return: the cursor
+        """
+        return self._get_single("next", coerce=self._utf8_unicode())
+
+    @next.setter
+    def next(self, val):
+        """
+        Set the cursor which carries on from the last notification in this list
+
+        :param val: the cursor
+        :return:
+        """
+        self._set_single("next", val, coerce=self._utf8_unicode())
+
     @property
     def notifications(self):
         """
@@ -324,6 +345,9 @@ class NotificationList(dataobj.DataObj):
 
         :return: the list of notifications
         """
+        rendered = getattr(self, "_rendered", None)
+        if rendered is not None:
+            return [json.loads(r) for r in rendered]
         return self._get_list("notifications")
 
     @notifications.setter
@@ -334,4 +358,31 @@ class NotificationList(dataobj.DataObj):
         :param val: the list of notifications
         :return:
         """
+        self._rendered = None
         self._set_list("notifications", val)
+
+    def set_rendered_notifications(self, rendered):
+        """
+        Set the list of notifications for this response as already serialised JSON strings, which are
+        spliced into the output of json() as they are
+
+        :param rendered: the list of notifications, each as a JSON string
+        :return:
+        """
+        if "notifications" in self.data:
+            del self.data["notifications"]
+        self._rendered = rendered
+
+    def json(self):
+        """
+        Serialise the list as JSON
+
+        :return: JSON string
+        """
+        rendered = getattr(self, "_rendered", None)
+        if rendered is None:
+            return json.dumps(self.data)
+        head = json.dumps(self.data)[:-1]
+        if len(self.data) > 0:
+            head += ", "
+        return head + '"notifications": [' + ", ".join(rendered) + ']}'
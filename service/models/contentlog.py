@@ -1,7 +1,9 @@
 
 from octopus.core import app
 from service import dao
-from octopus.lib import dataobj
+from octopus.lib import dataobj, dates
+from threading import Thread, Lock, Event
+import requests, json, uuid, time, os, atexit
 
 class ContentLog(dataobj.DataObj, dao.ContentLogDAO):
     '''
@@ -48,3 +50,120 @@ class ContentLog(dataobj.DataObj, dao.ContentLogDAO):
     @user.setter
     def delivered_from(self, delivered_from):
         self._set_single("delivered_from", delivered_from, coerce=self._utf8_unicode())
+
+    def queue(self):
+        """
+        Queue this log entry to be written to the index in the background, with others, rather than saving it now
+        """
+        buffer.add(self.data)
+
+class ContentLogBuffer(object):
+    """
+    Write-behind buffer for content log entries.
+
+    Entries are written to the index through the bulk API, by a background thread, once CONTENTLOG_BATCH of them are
+    waiting, or once the oldest has waited CONTENTLOG_FLUSH_INTERVAL seconds, and at shutdown; adding an entry never
+    waits for the index.  If the index can't be written to, the entries are dropped (and counted) rather than held
+    up or allowed to build up without limit; no more than CONTENTLOG_BUFFER_MAX are ever held.
+    """
+
+    def __init__(self):
+        self._entries = []
+        self._oldest = None
+        self._lock = Lock()
+        self._flushing = Lock()
+        self._wake = Event()
+        self._full = False
+        self._thread = None
+        self._pid = None
+        self.stats = {"queued" : 0, "written" : 0, "dropped" : 0}
+
+    def add(self, data):
+        """
+        Queue an entry
+
+        :param data: the raw content log record
+        """
+        now = dates.now()
+        rec = dict(data)
+        rec.setdefault("id", uuid.uuid4().hex)
+        rec.setdefault("created_date", now)
+        rec.setdefault("last_updated", now)
+        with self._lock:
+            if len(self._entries) >= app.config.get("CONTENTLOG_BUFFER_MAX", 10000):
+                self.stats["dropped"] += 1
+                # say so once each time the buffer fills, rather than for every entry
+                if not self._full:
+                    self._full = True
+                    app.logger.error(u"Content log - buffer is full, dropping entries until it has been written")
+                return
+            self._entries.append(rec)
+            self.stats["queued"] += 1
+            if self._oldest is None:
+                self._oldest = time.time()
+            batch = len(self._entries) >= app.config.get("CONTENTLOG_BATCH", 100)
+        self._start()
+        if batch:
+            self._wake.set()
+
+    def due(self, now=None):
+        """
+        :return: True if a full batch is waiting, or the oldest waiting entry has waited long enough to be written
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            if len(self._entries) >= app.config.get("CONTENTLOG_BATCH", 100):
+                return True
+            return self._oldest is not None and now - self._oldest >= app.config.get("CONTENTLOG_FLUSH_INTERVAL", 5)
+
+    def flush(self):
+        """
+        Write all the waiting entries to the index in one bulk request, dropping them if that fails
+        """
+        with self._flushing:
+            with self._lock:
+                entries = self._entries
+                self._entries = []
+                self._oldest = None
+                self._full = False
+            if len(entries) == 0:
+                return
+
+            data = ''
+            for e in entries:
+                data += json.dumps({"index" : {"_id" : e["id"]}}) + '\n'
+                data += json.dumps(e) + '\n'
+            try:
+                r = requests.post(app.config['ELASTIC_SEARCH_HOST'] + '/' + app.config['ELASTIC_SEARCH_INDEX'] + '/' + ContentLog.__type__ + '/_bulk',
+                                  data=data, timeout=app.config.get("CONTENTLOG_FLUSH_TIMEOUT", 10))
+                if r.status_code != 200:
+                    raise Exception("bulk request returned " + str(r.status_code))
+                failed = len([i for i in r.json().get("items", []) if i.values()[0].get("status", 200) >= 300])
+            except Exception as e:
+                failed = len(entries)
+                app.logger.error(u"Content log - dropped {x} entries, could not write to the index - '{y}'".format(x=failed, y=e.message))
+
+            with self._lock:
+                self.stats["written"] += len(entries) - failed
+                self.stats["dropped"] += failed
+
+    def _start(self):
+        # start the background flusher in this process, the first time it is needed (including after a fork)
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            # woken early when a batch fills, otherwise check every second whether the oldest entry is due
+            self._wake.wait(1)
+            self._wake.clear()
+            if self.due():
+                self.flush()
+
+buffer = ContentLogBuffer()
+atexit.register(buffer.flush)
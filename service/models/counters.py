@@ -0,0 +1,145 @@
+"""
+Model for the delivery counters, which keep a running count of the notifications delivered to each repository
+each month, so that the delivery reports do not depend on the routed notifications still being in the index
+"""
+
+from octopus.core import app
+from octopus.lib import dataobj, dates
+from service import dao
+import requests, json
+
+UNIQUE = "unique"
+"""the part of the id used for the counters of unique notifications, in place of the repository id"""
+
+class DeliveryCounter(dataobj.DataObj, dao.DeliveryCounterDAO):
+    '''
+    {
+        "id" : "<month>_<repository id, or 'unique' for the count of unique notifications>",
+        "last_updated" : "<date counter last modified>",
+
+        "month" : "<month the notifications were routed in, as YYYY-MM>",
+        "repository" : "<repository id; not present on the unique counters>",
+        "md" : <number of metadata-only notifications>,
+        "content" : <number of notifications with content>
+    }
+    '''
+
+    @classmethod
+    def counter_id(cls, month, repository=None):
+        """
+        Get the id of the counter for a repository (or the unique counter) in a month
+
+        :param month: the month, as YYYY-MM
+        :param repository: the repository id, or None for the unique counter
+        :return: the counter id
+        """
+        return month + "_" + (UNIQUE if repository is None else repository)
+
+    @property
+    def month(self):
+        return self._get_single("month", coerce=dataobj.to_unicode())
+
+    @month.setter
+    def month(self, val):
+        self._set_single("month", val, coerce=dataobj.to_unicode())
+
+    @property
+    def repository(self):
+        return self._get_single("repository", coerce=dataobj.to_unicode())
+
+    @repository.setter
+    def repository(self, val):
+        self._set_single("repository", val, coerce=dataobj.to_unicode())
+
+    @property
+    def md(self):
+        return self._get_single("md", coerce=dataobj.to_int(), default=0)
+
+    @md.setter
+    def md(self, val):
+        self._set_single("md", val, coerce=dataobj.to_int())
+
+    @property
+    def content(self):
+        return self._get_single("content", coerce=dataobj.to_int(), default=0)
+
+    @content.setter
+    def content(self, val):
+        self._set_single("content", val, coerce=dataobj.to_int())
+
+    @classmethod
+    def _url(cls, endpoint):
+        return app.config['ELASTIC_SEARCH_HOST'] + '/' + app.config['ELASTIC_SEARCH_INDEX'] + '/' + cls.__type__ + '/' + endpoint
+
+    @classmethod
+    def _record(cls, cid, counts):
+        month, rid = cid.split("_", 1)
+        rec = {"id" : cid, "month" : month, "md" : counts.get("md", 0), "content" : counts.get("content", 0), "last_updated" : dates.now()}
+        if rid != UNIQUE:
+            rec["repository"] = rid
+        return rec
+
+    @classmethod
+    def _write(cls, counts, add=True):
+        # read the current counters, and write them back with the changes, in one bulk request.  Each write is
+        # conditional on the counter not having changed since it was read (or not existing yet, for new ones), and
+        # any which did change in between are returned, to be tried again
+        cls.ensure_mapping()
+        r = requests.post(cls._url('_mget'), data=json.dumps({"ids" : counts.keys()}))
+        current = {}
+        for doc in r.json().get("docs", []):
+            if doc.get("found"):
+                current[doc["_id"]] = doc
+
+        data = ''
+        for cid, change in counts.iteritems():
+            doc = current.get(cid)
+            new = {"md" : change.get("md", 0), "content" : change.get("content", 0)}
+            if doc is None:
+                data += json.dumps({"create" : {"_id" : cid}}) + '\n'
+            else:
+                if add:
+                    new["md"] += doc["_source"].get("md", 0)
+                    new["content"] += doc["_source"].get("content", 0)
+                data += json.dumps({"index" : {"_id" : cid, "_version" : doc["_version"]}}) + '\n'
+            data += json.dumps(cls._record(cid, new)) + '\n'
+
+        r = requests.post(cls._url('_bulk'), data=data)
+        retry = {}
+        for item in r.json().get("items", []):
+            res = item.values()[0]
+            if res.get("status") == 409:
+                retry[res["_id"]] = counts[res["_id"]]
+            elif res.get("status", 200) >= 300:
+                app.logger.error(u"Delivery counter {x} could not be written: {y}".format(x=res.get("_id"), y=res.get("error")))
+        return retry
+
+    @classmethod
+    def bulk_add(cls, counts, attempts=3):
+        """
+        Add to the counters in one go, creating any that do not exist yet
+
+        :param counts: dict of counter id to a dict of the "md" and "content" numbers to add
+        :param attempts: number of times to try counters which were changed by something else while being updated
+        :return: dict of any counts that could not be added
+        """
+        for i in range(attempts):
+            if len(counts) == 0:
+                break
+            counts = cls._write(counts, add=True)
+        return counts
+
+    @classmethod
+    def bulk_set(cls, counts, attempts=3):
+        """
+        Set the counters in one go to the given values, creating any that do not exist yet
+
+        :param counts: dict of counter id to a dict of the "md" and "content" values
+        :param attempts: number of times to try counters which were changed by something else while being set
+        :return: dict of any counts that could not be set
+        """
+        for i in range(attempts):
+            if len(counts) == 0:
+                break
+            counts = cls._write(counts, add=False)
+        return counts
@@ -0,0 +1,229 @@
+"""
+Model for the duplicate keys, which let an incoming notification be recognised as one which has already been received
+before it is ingested and routed again.
+
+Keys are only claimed and checked by JPER.create_notification, so they cover notifications made through the API and from
+FTP deposits.  The harvester (API/src/engine) is a separate process which bulk inserts what it harvests into its own
+temporary index without consulting them, so a range it harvests again (e.g. a backfill) is inserted there again; its
+records are only recognised as duplicates if they are then sent on as notifications through create_notification.
+
+Each key is an identifier of the article (DOI, PMCID or PMID), or the hash of the content package, in a normalised form
+which is used as the id of the record, so that all the keys of a notification can be checked with a single multi-get.
+"""
+
+from octopus.core import app
+from octopus.lib import dataobj, dates
+from service import dao
+from datetime import datetime, timedelta
+import hashlib, re
+
+DOI_PREFIX = re.compile(r"^(doi:|https?://(dx\.)?doi\.org/)", re.IGNORECASE)
+"""prefixes which may be put in front of a DOI, which are removed before it is compared"""
+
+class DuplicateKey(dataobj.DataObj, dao.DuplicateKeyDAO):
+    '''
+    {
+        "id" : "<key type>:<normalised identifier or package hash>",
+        "created_date" : "<date the notification with this key was received>",
+
+        "notification" : "<id of the notification which was received with this key>",
+        "provider_id" : "<account id of the provider of that notification>",
+        "content" : <true if that notification came with a content package>
+    }
+    '''
+
+    @property
+    def created_date(self):
+        return self._get_single("created_date", coerce=dataobj.to_unicode())
+
+    @created_date.setter
+    def created_date(self, val):
+        self._set_single("created_date", val, coerce=dataobj.to_unicode())
+
+    @property
+    def notification(self):
+        return self._get_single("notification", coerce=dataobj.to_unicode())
+
+    @notification.setter
+    def notification(self, val):
+        self._set_single("notification", val, coerce=dataobj.to_unicode())
+
+    @property
+    def provider_id(self):
+        return self._get_single("provider_id", coerce=dataobj.to_unicode())
+
+    @provider_id.setter
+    def provider_id(self, val):
+        self._set_single("provider_id", val, coerce=dataobj.to_unicode())
+
+    @property
+    def content(self):
+        return bool(self._get_single("content", default=False))
+
+    @content.setter
+    def content(self, val):
+        self._set_single("content", bool(val))
+
+    @classmethod
+    def keys(cls, identifiers, package_hash=None):
+        """
+        Get the keys for a notification
+
+        :param identifiers: the notification's identifier objects, as in NotificationMetadata.identifiers
+        :param package_hash: hash of the notification's content package, if it has one
+        :return: list of key ids
+        """
+        keys = []
+        for ident in identifiers:
+            value = normalise(ident.get("type"), ident.get("id"))
+            if value is not None:
+                keys.append(ident.get("type").lower() + ":" + value)
+        if package_hash is not None:
+            keys.append("package:" + package_hash)
+        return sorted(set(keys))
+
+    @classmethod
+    def find_duplicate(cls, keys, content=False):
+        """
+        Find the notification, received within the last DUPLICATE_WINDOW_DAYS, of which a notification with the
+        given keys is a duplicate.
+
+        A notification with the same content package is always a duplicate.  One which shares an identifier is a
+        duplicate unless it brings a content package which the earlier one did not have, in which case it
+        supersedes the earlier one and is let through.
+
+        :param keys: the notification's keys, from DuplicateKey.keys
+        :param content: whether the notification comes with a content package
+        :return: the DuplicateKey of the earlier notification, or None if it is not a duplicate
+        """
+        if not app.config.get("DUPLICATE_CHECK", True) or len(keys) == 0:
+            return None
+        since = _window_start()
+        for kid, key in sorted(cls.pull_many(keys).iteritems()):
+            if key.is_duplicate_of(kid, content, since):
+                return key
+        return None
+
+    @classmethod
+    def claim(cls, keys, notification_id, provider_id, content=False):
+        """
+        Claim the keys of a new notification, before it is ingested and saved, unless it is a duplicate (as in
+        find_duplicate).
+
+        Each key is only created if it doesn't exist, or replaced if it is unchanged since it was read, so of two
+        copies of a notification which arrive at the same time only one can claim the keys; the other is found to
+        be a duplicate of it.  Keys left by a notification which was not a duplicate (they are out of the window,
+        or superseded) are taken over.
+
+        :param keys: the notification's keys, from DuplicateKey.keys
+        :param notification_id: the new notification's id
+        :param provider_id: the account id of the new notification's provider
+        :param content: whether the new notification comes with a content package
+        :return: the DuplicateKey of the earlier notification if it is a duplicate, or None if the keys were claimed
+        """
+        if not app.config.get("DUPLICATE_CHECK", True) or len(keys) == 0:
+            return None
+        dup = cls.find_duplicate(keys, content)
+        if dup is not None:
+            return dup
+
+        now = dates.now()
+        records = {}
+        for kid in keys:
+            key = cls()
+            key.id = kid
+            key.created_date = now
+            key.notification = notification_id
+            key.provider_id = provider_id
+            key.content = content
+            records[kid] = key
+
+        conflicts = cls.create_many([records[kid] for kid in keys])
+        if len(conflicts) == 0:
+            return None
+
+        # the keys which already exist are either another copy's, which got there first, or left by earlier
+        # notifications, which can be replaced as long as nothing else replaces them in the meantime
+        since = _window_start()
+        existing = cls.pull_many(conflicts, versions=True)
+        replace = []
+        for kid in sorted(conflicts):
+            key, version = existing.get(kid, (None, None))
+            if key is not None and key.is_duplicate_of(kid, content, since):
+                cls.delete_many([k for k in keys if k not in conflicts])
+                return key
+            replace.append((records[kid], version))
+        lost = cls.replace_many(replace)
+        if len(lost) == 0:
+            return None
+        cls.delete_many([k for k in keys if k not in lost])
+        return cls.pull_many(lost).get(sorted(lost)[0])
+
+    @classmethod
+    def release(cls, keys):
+        """
+        Give up the keys claimed by a notification which could not be created, so that later copies of it aren't
+        taken to be duplicates
+
+        :param keys: the notification's keys, as passed to claim
+        """
+        if not app.config.get("DUPLICATE_CHECK", True):
+            return
+        cls.delete_many(keys)
+
+    def is_duplicate_of(self, kid, content, since):
+        """
+        Whether a notification with this key is a duplicate of the one which holds it
+
+        :param kid: the key's id
+        :param content: whether the notification comes with a content package
+        :param since: the start of the window within which notifications are recognised as duplicates
+        """
+        if self.created_date is None or dates.parse(self.created_date) < since:
+            return False
+        return kid.startswith("package:") or self.content or not content
+
+def _window_start():
+    return datetime.utcnow() - timedelta(days=app.config.get("DUPLICATE_WINDOW_DAYS", 30))
+
+def normalise(type, id):
+    """
+    Normalise an identifier of one of the types used to recognise duplicates, so that different ways of writing
+    the same identifier compare equal
+
+    :param type: the identifier type (doi, pmcid or pmid)
+    :param id: the identifier
+    :return: the normalised identifier, or None if it is not of one of those types or is empty
+    """
+    if type is None or id is None:
+        return None
+    type = type.lower()
+    id = id.strip()
+    if type == "doi":
+        id = DOI_PREFIX.sub("", id).lower()
+    elif type == "pmcid":
+        id = id.upper()
+        if not id.startswith("PMC"):
+            id = "PMC" + id
+        if id == "PMC":
+            return None
+    elif type == "pmid":
+        id = id.lower()
+        if id.startswith("pmid:"):
+            id = id[len("pmid:"):].strip()
+    else:
+        return None
+    return id if id != "" else None
+
+def package_hash(path):
+    """
+    Hash the content of a package
+
+    :param path: path to the package file
+    :return: the sha256 hex digest of the file
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), ""):
+            sha.update(chunk)
+    return sha.hexdigest()
@@ -79,24 +79,15 @@ class HarvesterModel():
         get webservice with all data
         
         Return:
-            webservice object
+            list holding the webservice object, or empty if there is no such webservice
         '''
-        query = {
-            "query": {
-                "match": {
-                    '_id' : str(webservice_id)
-                              }
-            }
-        }
-        
-        result = self.__conn.execute_search_query_scroll(config.WEBSERVICES_INDEX_NAME,
-                                                         config.WEBSERVICES_DOCTYPE_NAME,
-                                                         query)
-        webservice = result['hits']
-        for idx,item in enumerate(webservice):
-            webservice[idx]['_source']['end_date'] = self.__timestamp_to_date(webservice[idx]['_source']['end_date'])
-        
-        return webservice
+        item = self.__conn.execute_get_query(config.WEBSERVICES_INDEX_NAME,
+                                             config.WEBSERVICES_DOCTYPE_NAME,
+                                             str(webservice_id))
+        if item is None:
+            return []
+        item['_source']['end_date'] = self.__timestamp_to_date(item['_source']['end_date'])
+        return [item]
     
     def save_webservice(self, webservice, webservice_id = None):
         '''
@@ -1,33 +1,46 @@
 #!/bin/bash
-# move all files of an ftp user from their jail to tmp, where they will be processed
-# set the owner and permissions to something that the scheduler will be allowed to move 
+# move all files of an ftp user from their jail to tmp, where they will be processed
+# set the owner and permissions to something that the scheduler will be allowed to move
 # e.g. same owner as the one that is going to be running the script would be good
 # ensure this script is executable can be run as sudo without password by the software
 # by doing visudo and adding this script to the commands that can be run without password, like:
 # mark ALL = (root) NOPASSWD:/home/mark/jper/src/jper/service/models/moveFTPfiles.sh
+#
+# every item in the user's xfer directory is moved in this one call, each into its own unique directory
+# under the tmp processing dir for the user (which is the layout processftp expects). For each item moved,
+# a manifest entry of the unique id, a tab, and the item name, terminated by a NUL, is written to stdout
 # -------------------------------------------------------------------------
 username=$1 # get from script params
 newowner=$2
 tmpdir=$3
-uniqueid=$4
-uniquedir=$5
-thefile=$6
-egrep "^$username" /etc/passwd >/dev/null
+userdir=${4:-/home/sftpusers}
+egrep "^$username:" /etc/passwd >/dev/null
 # only do if the username exists (just to check)
 if [ $? -eq 0 ]; then
 
 # TODO: could add a check for the username to see if matching user is logged in, by calling the w command
 # in which case do nothing on this iteration because the user is probably in the process of sending files
 
-# for time being copy everything to an ftp archive for this user first
-# so there is an original copy of everything received before processing by the system
-mkdir -p /home/mark/tmparchive/$username/$uniqueid
-cp -R $thefile /home/mark/tmparchive/$username/$uniqueid
+mkdir -p "$tmpdir/$username"
 
-# check that the tmp processing dir for this user and for this unique move process exists
-mkdir -p $uniquedir
-# move the specified file in the jail to the temp processing directory
-mv $thefile $uniquedir
-# set ownership from the user tmpdir down
-chown -R $newowner:$newowner $tmpdir
-fi
\ No newline at end of file
+find "$userdir/$username/xfer" -mindepth 1 -maxdepth 1 -print0 | while IFS= read -r -d '' thefile; do
+    uniqueid=$(tr -d '-' < /proc/sys/kernel/random/uuid)
+    uniquedir="$tmpdir/$username/$uniqueid"
+
+    # for time being copy everything to an ftp archive for this user first
+    # so there is an original copy of everything received before processing by the system
+    mkdir -p /home/mark/tmparchive/$username/$uniqueid
+    cp -R "$thefile" /home/mark/tmparchive/$username/$uniqueid
+
+    # move the file in the jail to its unique temp processing directory, and record it in the manifest
+    mkdir -p "$uniquedir"
+    if mv "$thefile" "$uniquedir"; then
+        printf '%s\t%s\0' "$uniqueid" "$(basename "$thefile")"
+    fi
+done
+
+# set ownership of the user tmpdir, once for everything that was moved
+chown $newowner:$newowner "$tmpdir"
+chown -R $newowner:$newowner "$tmpdir/$username"
+
+fi
@@ -9,7 +9,67 @@ from octopus.modules.identifiers import postcode
 import requests, json
 from octopus.core import app
 
-class NotificationMetadata(dataobj.DataObj):
+def _identifier_key(obj):
+    """
+    The key by which identifier objects ({"type" : ..., "id" : ...}) are told apart
+
+    :param obj: identifier object
+    :return: tuple of type and id
+    """
+    return (obj.get("type"), obj.get("id"))
+
+class UniqueListsMixin(object):
+    """
+    Mixin for model objects with lists of unique values, whose membership is checked against a set kept alongside
+    each list, rather than by scanning the list, so that building up (or merging) the metadata of papers with very
+    many authors stays linear.  The lists themselves are still plain lists in the data.
+    """
+
+    def _add_unique(self, path, val, coerce=None, key=None):
+        """
+        Add a value to one of the lists of unique values, unless it is already there.
+
+        The set is rebuilt whenever the list has been replaced or changed in length by anything else since it was
+        last used.
+
+        :param path: the dot-separated path to the list in the data
+        :param val: the value to add
+        :param coerce: the coerce function to apply to the value
+        :param key: function giving the hashable value to check membership by, if the values are not hashable
+        :return:
+        """
+        if val is None:
+            return
+        if coerce is not None:
+            val = self._coerce(val, coerce)
+        key = key if key is not None else lambda v: v
+
+        container = self.data
+        parts = path.split(".")
+        for p in parts[:-1]:
+            if container.get(p) is None:
+                container[p] = {}
+            container = container[p]
+        lst = container.get(parts[-1])
+        if lst is None:
+            lst = []
+            container[parts[-1]] = lst
+
+        index = getattr(self, "_unique", None)
+        if index is None:
+            index = {}
+            self._unique = index
+        entry = index.get(path)
+        if entry is None or entry[0] is not lst or entry[1] != len(lst):
+            entry = (lst, len(lst), set([key(v) for v in lst]))
+
+        k = key(val)
+        if k not in entry[2]:
+            lst.append(val)
+            entry[2].add(k)
+        index[path] = (lst, len(lst), entry[2])
+
+class NotificationMetadata(dataobj.DataObj, UniqueListsMixin):
     """
     Class to represent the standard bibliographic metadata that a notification may contain
 
@@ -320,8 +380,7 @@ class NotificationMetadata(dataobj.DataObj):
             return
         uc = dataobj.to_unicode()
         obj = {"id" : self._coerce(id, uc), "type" : self._coerce(type, uc)}
-        self._delete_from_list("metadata.identifier", matchsub=obj, prune=False)
-        self._add_to_list("metadata.identifier", obj)
+        self._add_unique("metadata.identifier", obj, key=_identifier_key)
 
     @property
     def authors(self):
@@ -616,8 +675,7 @@ class NotificationMetadata(dataobj.DataObj):
             return
         uc = dataobj.to_unicode()
         obj = {"id" : self._coerce(id, uc), "type" : self._coerce(type, uc)}
-        self._delete_from_list("metadata.source.identifier", matchsub=obj, prune=False)
-        self._add_to_list("metadata.source.identifier", obj)
+        self._add_unique("metadata.source.identifier", obj, key=_identifier_key)
 
 
 class BaseNotification(NotificationMetadata):
@@ -1009,6 +1067,10 @@ class UnroutedNotification(BaseNotification, dao.UnroutedNotificationDAO):
         else:
             return ProviderOutgoingNotification(d)
 
+# serialised outgoing versions of routed notifications, keyed on id and last_updated date, so that a notification
+# polled for again and again by repositories is only converted and serialised once
+outgoing_cache = dao.LRUCache("OUTGOING_CACHE_SIZE", 5000)
+
 class RoutedNotification(BaseNotification, RoutingInformation, dao.RoutedNotificationDAO):
     """
     Class which represents a notification that has been received into the system and successfully
@@ -1076,6 +1138,23 @@ class RoutedNotification(BaseNotification, RoutingInformation, dao.RoutedNotific
         else:
             return ProviderOutgoingNotification(d)
 
+    @classmethod
+    def outgoing_json(cls, raw, provider=False):
+        """
+        Get the serialised JSON of the outgoing version of a routed notification, as make_outgoing().json() would
+        give, but from the cache if it has been done before
+
+        :param raw: python dict object containing the routed notification data (e.g. the _source of a search hit)
+        :param provider: True for the provider's version of the notification
+        :return: JSON string
+        """
+        key = (raw.get("id"), raw.get("last_updated"), provider)
+        rendered = outgoing_cache.get(key)
+        if rendered is None:
+            rendered = cls(raw).make_outgoing(provider=provider).json()
+            outgoing_cache.put(key, rendered)
+        return rendered
+
 class FailedNotification(BaseNotification, RoutingInformation, dao.FailedNotificationDAO):
     """
     Class which represents a notification that has been received into the system but has not
@@ -1102,7 +1181,7 @@ class FailedNotification(BaseNotification, RoutingInformation, dao.FailedNotific
         """
         super(FailedNotification, self).__init__(raw=raw)
 
-class RoutingMetadata(dataobj.DataObj):
+class RoutingMetadata(dataobj.DataObj, UniqueListsMixin):
     """
     Class to represent the metadata that can be extracted from a notification (or associated
     binary content) which can be used to determine the routing to repository accounts (by comparison
@@ -1171,7 +1250,7 @@ class RoutingMetadata(dataobj.DataObj):
         :param val: a url
         :return:
         """
-        self._add_to_list("urls", val, coerce=dataobj.to_unicode(), unique=True)
+        self._add_unique("urls", val, coerce=dataobj.to_unicode())
 
     @property
     def author_ids(self):
@@ -1201,8 +1280,7 @@ class RoutingMetadata(dataobj.DataObj):
         """
         uc = dataobj.to_unicode()
         obj = {"id" : self._coerce(id, uc), "type" : self._coerce(type, uc)}
-        self._delete_from_list("author_ids", matchsub=obj, prune=False)
-        self._add_to_list("author_ids", obj)
+        self._add_unique("author_ids", obj, key=_identifier_key)
 
     def get_author_ids(self, type=None):
         """
@@ -1234,7 +1312,7 @@ class RoutingMetadata(dataobj.DataObj):
         :param aff: affiliation
         :return:
         """
-        self._add_to_list("affiliations", aff, coerce=dataobj.to_unicode(), unique=True)
+        self._add_unique("affiliations", aff, coerce=dataobj.to_unicode())
 
     @property
     def grants(self):
@@ -1252,7 +1330,7 @@ class RoutingMetadata(dataobj.DataObj):
         :param gid: grant id
         :return:
         """
-        self._add_to_list("grants", gid, coerce=dataobj.to_unicode(), unique=True)
+        self._add_unique("grants", gid, coerce=dataobj.to_unicode())
 
     @property
     def keywords(self):
@@ -1280,7 +1358,7 @@ class RoutingMetadata(dataobj.DataObj):
         :param kw: keyword
         :return:
         """
-        self._add_to_list("keywords", kw, coerce=dataobj.to_unicode(), unique=True)
+        self._add_unique("keywords", kw, coerce=dataobj.to_unicode())
 
     @property
     def emails(self):
@@ -1298,7 +1376,7 @@ class RoutingMetadata(dataobj.DataObj):
         :param email: email
         :return:
         """
-        self._add_to_list("emails", email, coerce=dataobj.to_unicode(), unique=True)
+        self._add_unique("emails", email, coerce=dataobj.to_unicode())
 
     @property
     def content_types(self):
@@ -1316,7 +1394,7 @@ class RoutingMetadata(dataobj.DataObj):
         :param val: content type
         :return:
         """
-        self._add_to_list("content_types", val, coerce=dataobj.to_unicode(), unique=True)
+        self._add_unique("content_types", val, coerce=dataobj.to_unicode())
 
     @property
     def postcodes(self):
@@ -1334,7 +1412,7 @@ class RoutingMetadata(dataobj.DataObj):
         :param val: postcodee
         :return:
         """
-        self._add_to_list("postcodes", val, coerce=dataobj.to_unicode(), unique=True)
+        self._add_unique("postcodes", val, coerce=dataobj.to_unicode())
 
     def has_data(self):
         """
@@ -3,23 +3,29 @@ Functions which generate reports from the JPER system
 
 """
 
-from service.models import RoutedNotification, Account
-import os
+from service.models import RoutedNotification, Account, DeliveryCounter
+from threading import Lock
+import os, atexit, requests, json
 from octopus.lib import clcsv
 from copy import deepcopy
 from datetime import datetime
 from octopus.core import app
 
-def delivery_report(from_date, to_date, reportfile):
+def delivery_report(from_date, to_date, reportfile, aggregate=None):
     """
     Generate the monthly report from from_date to to_date.  It is assumed that from_date is
     the start of a month, and to_date is the end of a month.
 
     Dates must be strings of the form YYYY-MM-DDThh:mm:ssZ
 
+    The counts are worked out by the index, using the aggregations in DeliveryReportQuery, rather than by
+    reading every notification in the date range.  If REPORT_FROM_COUNTERS is set, they are read from the
+    delivery counters instead, which also cover months whose routed notifications have since been deleted.
+
     :param from_date:   start of month date from which to generate the report
     :param to_date: end of month date up to which to generate the report (if this is not specified, it will default to datetime.utcnow())
     :param reportfile:  file path for existing/new report to be output
+    :param aggregate: function which takes the aggregation query and returns the aggregations from the response.  Defaults to asking the index of routed notifications, or if REPORT_FROM_COUNTERS is set, to reading the delivery counters
     :return:
     """
     # work out the whole months that we're operating over
@@ -30,42 +36,120 @@ def delivery_report(from_date, to_date, reportfile):
         tostamp = datetime.strptime(to_date, "%Y-%m-%dT%H:%M:%SZ")
     months = range(frstamp.month, tostamp.month + 1)
 
+    if aggregate is None and app.config.get("REPORT_FROM_COUNTERS", False):
+        result, uniques = counter_counts(frstamp.year, months)
+    else:
+        if aggregate is None:
+            aggregate = routed_aggregations
+        q = DeliveryReportQuery(from_date, to_date)
+        result, uniques = delivery_counts(aggregate(q.aggregation_query()), months)
+    write_delivery_report(result, uniques, reportfile)
+
+def routed_aggregations(query):
+    """
+    Run an aggregation query against the routed notifications
+
+    :param query: the query, which should have size 0 and an "aggs" section
+    :return: the aggregations part of the response
+    """
+    return RoutedNotification.query(q=query).get("aggregations", {})
+
+def delivery_counts(aggs, months):
+    """
+    Turn the aggregations from DeliveryReportQuery into the per-repository and unique counts of md-only vs with-content
+    notifications for each month
+
+    :param aggs: the aggregations, as returned by the index
+    :param months: the numbers of the months that the report covers
+    :return: a tuple of the counts by repository id then month, and the unique counts by month
+    """
     # prep the data structures where we're going to record the results
     result = {}
     uniques = {}
     for m in months:
         uniques[m] = {"md" : 0, "content" : 0}
-    heis = {}
 
-    # go through each routed notification and count against the repository ids whether something is
-    # a md-only or a with-content notification, and at the same time count the unique md-only vs with-content
-    # notifications that were routed
-    q = DeliveryReportQuery(from_date, to_date)
-    for note in RoutedNotification.scroll(q.query(), page_size=100, keepalive="5m"):
-        assert isinstance(note, RoutedNotification)
-        nm = note.analysis_datestamp.month
-
-        is_with_content = False
-        if len(note.links) > 0:
-            is_with_content = True
-            uniques[nm]["content"] += 1
-        else:
-            uniques[nm]["md"] += 1
+    # each month bucket has the number of notifications, and within that the number routed to each repository;
+    # the with-content filter has the same again for just the notifications which have links, and md-only is
+    # the difference between the two
+    for mb in aggs.get("months", {}).get("buckets", []):
+        nm = datetime.utcfromtimestamp(mb["key"] / 1000).month
 
-        for r in note.repositories:
+        content = mb.get("content", {})
+        uniques[nm]["content"] += content.get("doc_count", 0)
+        uniques[nm]["md"] += mb.get("doc_count", 0) - content.get("doc_count", 0)
+
+        with_content = {}
+        for b in content.get("repositories", {}).get("buckets", []):
+            with_content[b["key"]] = b["doc_count"]
+
+        for b in mb.get("repositories", {}).get("buckets", []):
+            r = b["key"]
             if r not in result:
                 result[r] = {}
                 for m in months:
                     result[r][m] = {"md" : 0, "content" : 0}
 
-            if is_with_content:
-                result[r][nm]["content"] += 1
-            else:
-                result[r][nm]["md"] += 1
+            ct = with_content.get(r, 0)
+            result[r][nm]["content"] += ct
+            result[r][nm]["md"] += b["doc_count"] - ct
+
+    return result, uniques
+
+def counter_counts(year, months):
+    """
+    Read the per-repository and unique counts of md-only vs with-content notifications for each month from
+    the delivery counters
+
+    :param year: the year the months are in
+    :param months: the numbers of the months that the report covers
+    :return: a tuple of the counts by repository id then month, and the unique counts by month, as delivery_counts
+    """
+    result = {}
+    uniques = {}
+    keys = {}
+    for m in months:
+        uniques[m] = {"md" : 0, "content" : 0}
+        keys[month_key(year, m)] = m
+
+    for c in DeliveryCounter.pull_by_months(keys.keys()):
+        m = keys.get(c.month)
+        if m is None:
+            continue
+        if c.repository is None:
+            uniques[m]["md"] += c.md
+            uniques[m]["content"] += c.content
+            continue
+
+        # a repository which received nothing in these months is left out, as it would be by the aggregations
+        if c.md + c.content == 0:
+            continue
+        r = c.repository
+        if r not in result:
+            result[r] = {}
+            for mon in months:
+                result[r][mon] = {"md" : 0, "content" : 0}
+        result[r][m]["md"] += c.md
+        result[r][m]["content"] += c.content
+
+    return result, uniques
+
+def write_delivery_report(result, uniques, reportfile):
+    """
+    Merge the counts into the report file, replacing any data already there for the months counted, and
+    recalculating the totals
+
+    :param result: counts of md-only and with-content notifications, by repository id then month
+    :param uniques: counts of unique md-only and with-content notifications, by month
+    :param reportfile:  file path for existing/new report to be output
+    :return:
+    """
+    heis = {}
 
     # now flesh out the report with account names and totals
+    accounts = Account.pull_many(result.keys())
     for k in result.keys():
-        acc = Account.pull(k)
+        acc = accounts.get(k)
         if acc is None:
             heis[k] = k
         else:
@@ -204,6 +288,172 @@ def delivery_report(from_date, to_date, reportfile):
 
     out.save()
 
+def month_key(year, month):
+    """
+    The month as used in the delivery counters
+
+    :param year: year number
+    :param month: month number
+    :return: YYYY-MM string
+    """
+    return str(year) + "-" + ("0" + str(month) if month < 10 else str(month))
+
+class DeliveryCounts(object):
+    """
+    Collects the counts of notifications as they are routed, and adds them to the delivery counters in batches
+    """
+
+    def __init__(self, batch=100):
+        """
+        :param batch: number of notifications to count up before writing the counters out
+        """
+        self.batch = batch
+        self.counts = {}
+        self.pending = 0
+        self._lock = Lock()
+
+    def add(self, note):
+        """
+        Count a routed notification against each of its repositories, and as a unique notification, for the month
+        it was routed in.  The counters are written out once enough notifications have been counted.
+
+        :param note: the RoutedNotification, with its links and repositories complete
+        """
+        ds = note.analysis_datestamp
+        if ds is None:
+            return
+        month = month_key(ds.year, ds.month)
+        kind = "content" if len(note.links) > 0 else "md"
+        with self._lock:
+            for r in [None] + note.repositories:
+                cid = DeliveryCounter.counter_id(month, r)
+                c = self.counts.setdefault(cid, {"md" : 0, "content" : 0})
+                c[kind] += 1
+            self.pending += 1
+            full = self.pending >= self.batch
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the counts collected so far out to the delivery counters
+        """
+        with self._lock:
+            counts = self.counts
+            n = self.pending
+            self.counts = {}
+            self.pending = 0
+        if len(counts) == 0:
+            return
+        try:
+            failed = DeliveryCounter.bulk_add(counts)
+            if len(failed) > 0:
+                app.logger.error(u"Delivery counters - {x} counters could not be updated, run the counter reconciliation to correct them".format(x=len(failed)))
+            else:
+                app.logger.debug(u"Delivery counters - counted {x} routed notifications".format(x=n))
+        except Exception as e:
+            app.logger.error(u"Delivery counters - failed to count {x} routed notifications, run the counter reconciliation to correct them - '{y}'".format(x=n, y=e.message))
+
+delivery_counter = DeliveryCounts(app.config.get("DELIVERY_COUNTER_BATCH", 100))
+atexit.register(delivery_counter.flush)
+
+def count_delivery(note):
+    """
+    Count a newly routed notification in the delivery counters
+
+    :param note: the RoutedNotification
+    """
+    delivery_counter.add(note)
+
+def flush_delivery_counts():
+    """
+    Write out any delivery counts which have not been written yet
+    """
+    delivery_counter.flush()
+
+def reconcile_counters():
+    """
+    Rebuild the delivery counters from the routed notifications which are still in the index.
+
+    Counters for months which are in the index are replaced with the counts from the index; counters for
+    earlier months, whose notifications have been deleted, are left as they are.
+
+    :return: the months which were reconciled, as YYYY-MM strings
+    """
+    flush_delivery_counts()
+
+    # the routed notifications are boxed into a type per month, so ask the index for all of them
+    base = app.config['ELASTIC_SEARCH_HOST'] + '/' + app.config['ELASTIC_SEARCH_INDEX']
+    mappings = requests.get(base + '/_mapping').json()
+    types = []
+    for idx in mappings.values():
+        types.extend([t for t in idx.get("mappings", {}).keys() if t.startswith(RoutedNotification.__type__)])
+    if len(types) == 0:
+        return []
+
+    q = {"query" : {"match_all" : {}}, "size" : 0, "aggs" : DeliveryReportQuery.aggregations()}
+    aggs = requests.post(base + '/' + ','.join(types) + '/_search', data=json.dumps(q)).json().get("aggregations", {})
+
+    counts = {}
+    months = []
+    for mb in aggs.get("months", {}).get("buckets", []):
+        ds = datetime.utcfromtimestamp(mb["key"] / 1000)
+        month = month_key(ds.year, ds.month)
+        months.append(month)
+
+        content = mb.get("content", {})
+        counts[DeliveryCounter.counter_id(month)] = {"content" : content.get("doc_count", 0), "md" : mb.get("doc_count", 0) - content.get("doc_count", 0)}
+
+        with_content = {}
+        for b in content.get("repositories", {}).get("buckets", []):
+            with_content[b["key"]] = b["doc_count"]
+        for b in mb.get("repositories", {}).get("buckets", []):
+            ct = with_content.get(b["key"], 0)
+            counts[DeliveryCounter.counter_id(month, b["key"])] = {"content" : ct, "md" : b["doc_count"] - ct}
+
+    # any counter in those months for a repository which no longer has anything routed to it goes back to zero
+    if len(months) > 0:
+        for c in DeliveryCounter.pull_by_months(months):
+            if c.id not in counts:
+                counts[c.id] = {"md" : 0, "content" : 0}
+
+    failed = DeliveryCounter.bulk_set(counts)
+    if len(failed) > 0:
+        app.logger.error(u"Delivery counters - {x} counters could not be reconciled".format(x=len(failed)))
+    return months
+
+def delivery_statistics(from_month, to_month, repository=None):
+    """
+    Get the delivery counts for the months from from_month to to_month inclusive
+
+    :param from_month: the first month, as YYYY-MM
+    :param to_month: the last month, as YYYY-MM
+    :param repository: the repository id to restrict the counts to.  If this is given, the unique counts are not included
+    :return: dict of the counts of md-only, with-content and total notifications by repository then month, and the unique counts by month
+    """
+    frstamp = datetime.strptime(from_month, "%Y-%m")
+    tostamp = datetime.strptime(to_month, "%Y-%m")
+    months = []
+    y, m = frstamp.year, frstamp.month
+    while (y, m) <= (tostamp.year, tostamp.month):
+        months.append(month_key(y, m))
+        y, m = (y + 1, 1) if m == 12 else (y, m + 1)
+
+    stats = {"from" : from_month, "to" : to_month, "repositories" : {}}
+    if repository is None:
+        stats["unique"] = {}
+    counters = DeliveryCounter.pull_by_months(months) if len(months) > 0 else []
+    for c in counters:
+        if repository is not None and c.repository != repository:
+            continue
+        counts = {"md" : c.md, "content" : c.content, "total" : c.md + c.content}
+        if c.repository is None:
+            if repository is None:
+                stats["unique"][c.month] = counts
+        else:
+            stats["repositories"].setdefault(c.repository, {})[c.month] = counts
+    return stats
+
 class DeliveryReportQuery(object):
     def __init__(self, from_date, to_date):
         self.from_date = from_date
@@ -228,4 +478,43 @@ class DeliveryReportQuery(object):
             "sort" : [
                 {"analysis_date" : {"order" :  "asc"}}
             ]
+        }
+
+    def aggregation_query(self):
+        """
+        The same range as query(), but asking only for the counts needed by the report: notifications by
+        month, and in each month by repository, both overall and for those which have links (i.e. with-content)
+
+        :return: the query, with no hits and an "aggs" section
+        """
+        q = self.query()
+        del q["sort"]
+        q["size"] = 0
+        q["aggs"] = self.aggregations()
+        return q
+
+    @classmethod
+    def aggregations(cls):
+        """
+        The aggregations which count the notifications by month, and by repository within each month, both overall
+        and for those which have links
+
+        :return: the "aggs" section of a query
+        """
+        by_repository = {
+            "terms" : {"field" : "repositories.exact", "size" : 0}
+        }
+        return {
+            "months" : {
+                "date_histogram" : {"field" : "analysis_date", "interval" : "month"},
+                "aggs" : {
+                    "repositories" : by_repository,
+                    "content" : {
+                        "filter" : {"exists" : {"field" : "links.url"}},
+                        "aggs" : {
+                            "repositories" : by_repository
+                        }
+                    }
+                }
+            }
         }
\ No newline at end of file
@@ -5,7 +5,7 @@ RoutedNotifications or FailedNotifications
 
 from octopus.lib import dates
 from octopus.modules.store import store
-from service import packages, models
+from service import packages, models, reports
 import esprit
 from service.web import app
 from flask import url_for
@@ -103,6 +103,8 @@ def route(unrouted):
             enhance(routed, metadata)
         links(routed)
         routed.save()
+        if app.config.get("DELIVERY_COUNTERS", True):
+            reports.count_delivery(routed)
         app.logger.debug(u"Routing - Notification:{y} successfully routed".format(y=unrouted.id))
         return True
     else:
@@ -260,34 +262,22 @@ def enhance(routed, metadata):
     # 1. If both authors have identifiers and one matches, they are equivalent and missing name/affiliation/identifiers should be added
     # 2. If one does not have identifiers, match by name.
     # 3. If name matches, add any missing affiliation/identifiers
-    mas = metadata.authors
-    ras = routed.authors
-    for ma in mas:
-        merged = False
-        # first run through all the existing authors, and see if any of them merge
-        for ra in ras:
-            merged = _merge_entities(ra, ma, "name", other_properties=["affiliation"])
-            # if one merges, don't continue
-            if merged:
-                break
-        # if we didn't get a merge, add the author from the metadata
-        if not merged:
-            routed.add_author(ma)
+    # The existing authors are indexed, so each one from the metadata is merged into the first it matches without
+    # trying each existing author in turn
+    authors = _EntityIndex(routed.authors, "name")
+    for ma in metadata.authors:
+        if not authors.merge(ma, other_properties=["affiliation"]):
+            authors.add(ma)
+    if authors.added:
+        routed.authors = authors.entities
 
     # merge project entities in with the same rule set as above
-    mps = metadata.projects
-    rps = routed.projects
-    for mp in mps:
-        merged = False
-        # first run through all the existing projects, and see if any of them merge
-        for rp in rps:
-            merged = _merge_entities(rp, mp, "name", other_properties=["grant_number"])
-            # if one merges, don't continue
-            if merged:
-                break
-        # if we didn't get a merge, add the project from the metadata
-        if not merged:
-            routed.add_project(mp)
+    projects = _EntityIndex(routed.projects, "name")
+    for mp in metadata.projects:
+        if not projects.merge(mp, other_properties=["grant_number"]):
+            projects.add(mp)
+    if projects.added:
+        routed.projects = projects.entities
 
     # add any new subjects
     for s in metadata.subjects:
@@ -321,24 +311,16 @@ def _merge_entities(e1, e2, primary_property, other_properties=None):
 
     # 1. If both entities have identifiers and one matches, they are equivalent and missing properties/identifiers should be added
     if e2.get("identifier") is not None and e1.get("identifier") is not None:
-        for maid in e2.get("identifier"):
-            for raid in e1.get("identifier"):
-                if maid.get("type") == raid.get("type") and maid.get("id") == raid.get("id"):
-                    # at this point we know that e1 is the same entity as e2
-                    if e1.get(primary_property) is None and e2.get(primary_property) is not None:
-                        e1[primary_property] = e2[primary_property]
-                    for op in other_properties:
-                        if e1.get(op) is None and e2.get(op) is not None:
-                            e1[op] = e2[op]
-                    for maid2 in e2.get("identifier"):
-                        match = False
-                        for raid2 in e1.get("identifier"):
-                            if maid2.get("type") == raid2.get("type") and maid2.get("id") == raid2.get("id"):
-                                match = True
-                                break
-                        if not match:
-                            e1["identifier"].append(maid2)
-                    return True
+        e1ids = set([_identifier_key(i) for i in e1.get("identifier")])
+        if any(_identifier_key(i) in e1ids for i in e2.get("identifier")):
+            # at this point we know that e1 is the same entity as e2
+            if e1.get(primary_property) is None and e2.get(primary_property) is not None:
+                e1[primary_property] = e2[primary_property]
+            for op in other_properties:
+                if e1.get(op) is None and e2.get(op) is not None:
+                    e1[op] = e2[op]
+            _merge_identifiers(e1, e2, e1ids)
+            return True
 
     # 2. If one does not have identifiers, match by primary property.
     # 3. If primary property matches, add any missing other properties/identifiers
@@ -346,21 +328,112 @@ def _merge_entities(e1, e2, primary_property, other_properties=None):
         for op in other_properties:
             if e1.get(op) is None and e2.get(op) is not None:
                 e1[op] = e2[op]
-        for maid2 in e2.get("identifier", []):
-            match = False
-            for raid2 in e1.get("identifier", []):
-                if maid2.get("type") == raid2.get("type") and maid2.get("id") == raid2.get("id"):
-                    match = True
-                    break
-            if not match:
-                if "identifier" not in e1:
-                    e1["identifier"] = []
-                e1["identifier"].append(maid2)
+        _merge_identifiers(e1, e2, set([_identifier_key(i) for i in e1.get("identifier", [])]))
         return True
 
     return False
 
 
+def _identifier_key(identifier):
+    return (identifier.get("type"), identifier.get("id"))
+
+
+def _merge_identifiers(e1, e2, e1ids):
+    # add the identifiers of e2 which e1 doesn't already have (e1ids) to e1
+    for maid2 in e2.get("identifier", []):
+        k = _identifier_key(maid2)
+        if k not in e1ids:
+            if "identifier" not in e1:
+                e1["identifier"] = []
+            e1["identifier"].append(maid2)
+            e1ids.add(k)
+
+
+class _EntityIndex(object):
+    """
+    A list of entities (authors or projects), indexed by their identifiers and by their primary property, so that
+    the entity which _merge_entities would merge a new entity into can be found directly.
+
+    As when trying each entity in turn, a new entity with identifiers matches the first entity which shares one of
+    them, or which has no identifiers and the same primary property; a new entity without identifiers matches the
+    first entity with the same primary property.
+    """
+
+    def __init__(self, entities, primary_property):
+        """
+        :param entities: the existing entities
+        :param primary_property: the property by which entities without matching identifiers are matched
+        """
+        self.entities = list(entities)
+        self.primary_property = primary_property
+        self.added = False
+        self._by_id = {}            # identifier key -> positions of the entities with identifiers
+        self._by_name = {}          # primary property -> positions of all the entities
+        self._by_name_no_ids = {}   # primary property -> positions of the entities without identifiers
+        self._indexed = []          # position -> what that entity is indexed under
+        for pos in range(len(self.entities)):
+            self._indexed.append(None)
+            self._index(pos)
+
+    def merge(self, entity, other_properties=None):
+        """
+        Merge the entity into the first existing entity it matches
+
+        :param entity: the new entity
+        :param other_properties: explicit list of properties to merge, as for _merge_entities
+        :return: True if the entity was merged, False if it matches none of them
+        """
+        ids = entity.get("identifier")
+        name = entity.get(self.primary_property)
+        if ids is not None:
+            candidates = set(self._by_name_no_ids.get(name, set()))
+            for i in ids:
+                candidates.update(self._by_id.get(_identifier_key(i), set()))
+        else:
+            candidates = self._by_name.get(name, set())
+        if len(candidates) == 0:
+            return False
+        pos = min(candidates)
+        merged = _merge_entities(self.entities[pos], entity, self.primary_property, other_properties=other_properties)
+        # the merge may have given the entity a name or new identifiers to be found by
+        self._index(pos)
+        return merged
+
+    def add(self, entity):
+        """
+        Add an entity which didn't merge with any of the existing ones
+
+        :param entity: the new entity
+        """
+        self.entities.append(entity)
+        self._indexed.append(None)
+        self._index(len(self.entities) - 1)
+        self.added = True
+
+    def _index(self, pos):
+        old = self._indexed[pos]
+        if old is not None:
+            name, keys = old
+            self._by_name[name].discard(pos)
+            if keys is None:
+                self._by_name_no_ids[name].discard(pos)
+            else:
+                for k in keys:
+                    self._by_id[k].discard(pos)
+
+        entity = self.entities[pos]
+        name = entity.get(self.primary_property)
+        ids = entity.get("identifier")
+        keys = None if ids is None else set([_identifier_key(i) for i in ids])
+        self._by_name.setdefault(name, set()).add(pos)
+        if keys is None:
+            self._by_name_no_ids.setdefault(name, set()).add(pos)
+        else:
+            for k in keys:
+                self._by_id.setdefault(k, set()).add(pos)
+        self._indexed[pos] = (name, keys)
+
+
 def repackage(unrouted, repo_ids):
     """
     Repackage any binary content associated with the notification for consumption by
@@ -388,8 +461,9 @@ def repackage(unrouted, repo_ids):
 
     pm = packages.PackageFactory.converter(unrouted.packaging_format)
     conversions = []
+    accounts = models.Account.pull_many(repo_ids)
     for rid in repo_ids:
-        acc = models.Account.pull(rid)
+        acc = accounts.get(rid)
         if acc is None:
             # realistically this shouldn't happen, but if it does just carry on
             app.logger.warn(u"Repackaging - no account with id {x}; carrying on regardless".format(x=rid))
@@ -20,162 +20,422 @@ all machines but some synchronisation would have to be added to that tasks were
 running the schedule would need access to any relevant directories.
 '''
 
-import schedule, time, os, shutil, requests, datetime, tarfile, zipfile, subprocess, getpass, uuid, json, csv
-from threading import Thread
+import schedule, time, os, shutil, requests, datetime, tarfile, zipfile, subprocess, getpass, json, csv, tempfile
+from threading import Thread, RLock
+from multiprocessing.pool import ThreadPool
 from octopus.core import app, initialise
-from service import reports
+from service import reports, ftpwatch
+from service.api import JPER, ValidationException
 
 import models, routing
 
-# functions for the checkftp to unzip and move stuff up then zip again in incoming packages
-def zip(src, dst):
-    zf = zipfile.ZipFile(dst, "w", zipfile.ZIP_DEFLATED)
-    abs_src = os.path.abspath(src)
-    for dirname, subdirs, files in os.walk(src):
-        for filename in files:
-            absname = os.path.abspath(os.path.join(dirname, filename))
-            arcname = absname[len(abs_src) + 1:]
-            zf.write(absname, arcname)
-    zf.close()
-
-def extract(fl,path):
-    app.logger.debug('Extracting ' + fl)
+# functions for the processftp to flatten incoming packages into a single zip
+# file extensions of content which is already compressed, so is stored in the package rather than deflated again
+STORED_EXTENSIONS = ['.pdf', '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.jpg', '.jpeg', '.png', '.gif', '.tif',
+                     '.tiff', '.mp3', '.mp4', '.m4a', '.m4v', '.mov', '.avi', '.mpg', '.mpeg', '.wmv', '.webm', '.ogg',
+                     '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub']
+
+# members of archives bigger than this are copied to a temporary file rather than held in memory while they are read
+SPOOL_MAX_SIZE = 50 * 1024 * 1024
+
+# zip can't hold dates before this, so anything older (e.g. a tar member with mtime 0) is given this date instead
+ZIP_MIN_DATE = (1980, 1, 1, 0, 0, 0)
+
+def safe_name(name):
+    # Path traversal defense copied from
+    # http://hg.python.org/cpython/file/tip/Lib/http/server.py#l789
+    words = []
+    for word in name.replace('\\', '/').split('/'):
+        drive, word = os.path.splitdrive(word)
+        head, word = os.path.split(word)
+        if word in (os.curdir, os.pardir, ''): continue
+        words.append(word)
+    return '/'.join(words)
+
+def archive_type(name):
+    n = name.lower()
+    if n.endswith('.zip'):
+        return 'zip'
+    if n.endswith('.tar') or n.endswith('.tar.gz') or n.endswith('.tgz') or n.endswith('.tar.bz2'):
+        return 'tar'
+    return None
+
+def compress_type(name):
+    if os.path.splitext(name.lower())[1] in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def flatten_to_zip(src, dst):
+    """
+    Write every file in src (a file or a directory), and every file inside any zip or tar archives found there
+    (however deeply nested), to the top level of a new zip at dst. Nothing is unpacked to disk along the way.
+
+    Returns the list of names written to the package.
+    """
+    zf = zipfile.ZipFile(dst, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+    written = []
     try:
-        # TODO the tar method has not yet been tested...
-        tar = tarfile.open(fl)
-        tar.extractall()
-        tar.close()
-        app.logger.debug('Extracted tar ' + fl)
-        return True
-    except:
-        try:
-            with zipfile.ZipFile(fl) as zf:
-                for member in zf.infolist():
-                    # Path traversal defense copied from
-                    # http://hg.python.org/cpython/file/tip/Lib/http/server.py#l789
-                    words = member.filename.split('/')
-                    for word in words[:-1]:
-                        drive, word = os.path.splitdrive(word)
-                        head, word = os.path.split(word)
-                        if word in (os.curdir, os.pardir, ''): continue
-                        path = os.path.join(path, word)
-                    zf.extract(member, path)
-            app.logger.debug('Extracted zip ' + fl)
-            return True
-        except:
-            app.logger.debug('Extraction could not be done for ' + fl)
-            return False
-
-def flatten(destination, depth=None):
-    if depth is None:
-        depth = destination
-    app.logger.debug('Flatten depth set ' + destination + ' ' + depth)
-    for fl in os.listdir(depth):
-        app.logger.debug('Flatten at ' + fl)
-        if '.zip' in fl: # or '.tar' in fl:
-            app.logger.debug('Flatten ' + fl + ' is an archive')
-            extracted = extract(depth + '/' + fl, depth)
-            if extracted:
-                app.logger.debug('Flatten ' + fl + ' is extracted')
-                os.remove(depth + '/' + fl)
-                flatten(destination,depth)
-        elif os.path.isdir(depth + '/' + fl):
-            app.logger.debug('Flatten ' + fl + ' is not a file, flattening')
-            flatten(destination, depth + '/' + fl)
+        if os.path.isdir(src):
+            for dirname, subdirs, files in os.walk(src):
+                for filename in files:
+                    absname = os.path.join(dirname, filename)
+                    with open(absname, "rb") as fh:
+                        _flatten_member(zf, written, os.path.relpath(absname, src), fh, path=absname)
         else:
-            try:
-                shutil.move(depth + '/' + fl, destination)
-            except:
-                pass
+            with open(src, "rb") as fh:
+                _flatten_member(zf, written, os.path.basename(src), fh, path=src)
+    finally:
+        zf.close()
+    return written
+
+def _flatten_member(zf, written, name, fh, path=None, date_time=None):
+    # fh must be seekable, so that we can check whether an archive is readable before we commit to reading from it
+    kind = archive_type(name)
+    if kind == 'zip' and zipfile.is_zipfile(fh):
+        fh.seek(0)
+        app.logger.debug('Flatten ' + name + ' is a zip archive')
+        with zipfile.ZipFile(fh) as inner:
+            for member in inner.infolist():
+                if member.filename.endswith('/'):
+                    continue
+                _flatten_stream(zf, written, member.filename, inner.open(member), member.date_time, member.file_size)
+        return
+    if kind == 'tar':
+        fh.seek(0)
+        try:
+            inner = tarfile.open(fileobj=fh, mode="r:*")
+        except tarfile.TarError:
+            inner = None
+        if inner is not None:
+            app.logger.debug('Flatten ' + name + ' is a tar archive')
+            for member in inner:
+                if member.isfile():
+                    _flatten_stream(zf, written, member.name, inner.extractfile(member), time.localtime(member.mtime)[:6], member.size)
+            inner.close()
+            return
+    if kind is not None:
+        app.logger.debug('Extraction could not be done for ' + name)
+    fh.seek(0)
 
+    arcname = _arcname(written, name)
+    if arcname is None:
+        return
+    if path is not None:
+        # zipfile takes the date from the file, and can't write one from before 1980
+        mtime = os.path.getmtime(path)
+        if mtime < time.mktime(ZIP_MIN_DATE + (0, 0, -1)):
+            mtime = time.mktime(ZIP_MIN_DATE + (0, 0, -1))
+            os.utime(path, (mtime, mtime))
+        zf.write(path, arcname, compress_type(arcname))
+    else:
+        zinfo = zipfile.ZipInfo(arcname, _zip_date(date_time if date_time is not None else time.localtime()[:6]))
+        zinfo.compress_type = compress_type(arcname)
+        zinfo.external_attr = 0644 << 16
+        zf.writestr(zinfo, fh.read())
+    written.append(arcname)
 
-def moveftp():
+def _flatten_stream(zf, written, name, stream, date_time, size):
+    # members of archives are only readable once, so copy them into something seekable first: small ones in
+    # memory, and anything bigger to a temporary file, which is then written to the package from disk in chunks
+    if size <= SPOOL_MAX_SIZE:
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    else:
+        spool = tempfile.NamedTemporaryFile()
     try:
-        # move any files in the jail of ftp users into the temp directory for later processing
-        tmpdir = app.config.get('TMP_DIR','/tmp')
-        userdir = app.config.get('USERDIR','/home/sftpusers')
-        userdirs = os.listdir(userdir)
-        app.logger.info("Scheduler - from FTP folders found " + str(len(userdirs)) + " user directories")
-        for dir in userdirs:
-            if len(os.listdir(userdir + '/' + dir + '/xfer')):
-                for thisitem in os.listdir(userdir + '/' + dir + '/xfer'):
-                    app.logger.info('Scheduler - moving file ' + thisitem + ' for Account:' + dir)
-                    fl = os.path.dirname(os.path.abspath(__file__)) + '/models/moveFTPfiles.sh'
-                    try:
-                        newowner = getpass.getuser()
-                    except:
-                        newowner = 'mark'
-                    uniqueid = uuid.uuid4().hex
-                    uniquedir = tmpdir + '/' + dir + '/' + uniqueid
-                    moveitem = userdir + '/' + dir + '/xfer/' + thisitem
-                    subprocess.call( [ 'sudo', fl, dir, newowner, tmpdir, uniqueid, uniquedir, moveitem ] )
-            else:
-                app.logger.debug('Scheduler - found nothing to move for Account:' + dir)
+        shutil.copyfileobj(stream, spool)
+        spool.flush()
+        spool.seek(0)
+        path = None
+        if size > SPOOL_MAX_SIZE:
+            path = spool.name
+            mtime = time.mktime(_zip_date(date_time) + (0, 0, -1))
+            os.utime(path, (mtime, mtime))
+        _flatten_member(zf, written, name, spool, path=path, date_time=date_time)
+    finally:
+        spool.close()
+        stream.close()
+
+def _zip_date(date_time):
+    return max(tuple(date_time), ZIP_MIN_DATE)
+
+def _arcname(written, name):
+    # everything goes to the top level of the package, unless a file of the same name is already there in which
+    # case it keeps its (sanitised) path so that nothing is overwritten
+    safe = safe_name(name)
+    if safe == '':
+        app.logger.debug('Flatten skipping unsafe name ' + name)
+        return None
+    arcname = safe.split('/')[-1]
+    if arcname in written:
+        arcname = safe
+    if arcname in written:
+        app.logger.debug('Flatten skipping duplicate ' + name)
+        return None
+    return arcname
+
+
+# moveftp and processftp can be triggered both by the schedule and by the ftp watcher, so they take turns
+ftp_lock = RLock()
+
+def parse_move_manifest(output, tmpdir, account):
+    # the move script writes one entry per item it moved, as the unique id and the item name separated by a
+    # tab, with each entry terminated by a NUL (so that any item name the publisher chose can be read back)
+    manifest = []
+    for entry in output.split('\0'):
+        if '\t' not in entry:
+            continue
+        uniqueid, item = entry.split('\t', 1)
+        manifest.append({"item" : item, "uniqueid" : uniqueid, "uniquedir" : tmpdir + '/' + account + '/' + uniqueid})
+    return manifest
+
+def moveftp_account(account, tmpdir, userdir):
+    # move everything waiting in the account's jail with one privileged call, and return the manifest of what moved
+    fl = os.path.dirname(os.path.abspath(__file__)) + '/models/moveFTPfiles.sh'
+    try:
+        newowner = getpass.getuser()
+    except:
+        newowner = 'mark'
+    proc = subprocess.Popen( [ 'sudo', fl, account, newowner, tmpdir, userdir ], stdout=subprocess.PIPE )
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        app.logger.error('Scheduler - move script exited with ' + str(proc.returncode) + ' for Account:' + account)
+    # anything in the manifest was moved, even if the script failed part way through
+    return parse_move_manifest(output, tmpdir, account)
+
+def moveftp(accounts=None):
+    manifest = []
+    try:
+        with ftp_lock:
+            # move any files in the jail of ftp users into the temp directory for later processing
+            tmpdir = app.config.get('TMP_DIR','/tmp')
+            userdir = app.config.get('USERDIR','/home/sftpusers')
+            userdirs = os.listdir(userdir) if accounts is None else accounts
+            app.logger.info("Scheduler - from FTP folders found " + str(len(userdirs)) + " user directories")
+            for dir in userdirs:
+                if len(os.listdir(userdir + '/' + dir + '/xfer')):
+                    moved = moveftp_account(dir, tmpdir, userdir)
+                    for m in moved:
+                        m["account"] = dir
+                        app.logger.info('Scheduler - moved file ' + m["item"] + ' to ' + m["uniquedir"] + ' for Account:' + dir)
+                    manifest.extend(moved)
+                else:
+                    app.logger.debug('Scheduler - found nothing to move for Account:' + dir)
     except:
         app.logger.error("Scheduler - move from FTP failed")
+    return manifest
         
 if app.config.get('MOVEFTP_SCHEDULE',10) != 0:
     schedule.every(app.config.get('MOVEFTP_SCHEDULE',10)).minutes.do(moveftp)
 
     
+def submit_direct(acc, notification, pkg):
+    # hand the package straight to the python API as the account that owns the ftp directory, rather than
+    # sending it back in to ourselves over http. There is no logged in user here, so the publisher check
+    # has to be done before the API would fall back to looking at the current user
+    if acc is None or not acc.has_role('publisher'):
+        app.logger.error('Scheduler - processing failed for ' + pkg + ' - owning account is not a publisher')
+        return False
+    try:
+        with open(pkg, "rb") as fh:
+            note = JPER.create_notification(acc, notification, fh)
+        app.logger.info('Scheduler - processing completed with direct submission of ' + pkg + ' as Notification:' + note.id)
+        return True
+    except ValidationException as e:
+        app.logger.error('Scheduler - processing completed with validation failure for ' + pkg + ' - ' + e.message)
+    except Exception as e:
+        app.logger.error("Scheduler - processing failed with direct submission of " + pkg + " - '{x}'".format(x=e.message))
+    return False
+
+def submit_http(acc, notification, pkg):
+    # POST the package to the web API, as we would have to if the API were running elsewhere
+    apiurl = app.config['API_URL'] + '?api_key=' + acc.data['api_key']
+    with open(pkg, "rb") as fh:
+        files = [
+            ("metadata", ("metadata.json", json.dumps(notification), "application/json")),
+            ("content", ("content.zip", fh, "application/zip"))
+        ]
+        app.logger.debug('Scheduler - processing POSTing ' + pkg + ' ' + json.dumps(notification))
+        resp = requests.post(apiurl, files=files, verify=False)
+    if str(resp.status_code).startswith('4') or str(resp.status_code).startswith('5'):
+        app.logger.error('Scheduler - processing completed with POST failure to ' + apiurl + ' - ' + str(resp.status_code) + ' - ' + resp.text)
+        return False
+    app.logger.info('Scheduler - processing completed with POST to ' + apiurl + ' - ' + str(resp.status_code))
+    return True
+
+# file kept in a deposit directory which could not be fully processed, recording what has been submitted from it
+# so far and how many times it has been tried
+PROCESSFTP_STATE = '.processftp.json'
+
+def processftp_dir(acc, thisdir, direct=True):
+    """
+    Process one uuid directory moved from an ftp user's jail, submitting each publication in it as a notification.
+
+    Any exception is caught and logged here so that one bad package cannot stop the rest of the run. If that
+    happens, or any of the submissions fails, the directory is left in place to be tried again on the next run,
+    when only the publications which have not yet been submitted are tried. After PROCESSFTP_MAX_ATTEMPTS runs
+    the directory is moved aside to PROCESSFTP_FAILED_DIR for someone to look at.
+
+    Returns a dict of counts for the run stats.
+    """
+    stats = {"packages" : 0, "submitted" : 0, "failed" : 0, "bytes" : 0}
+    app.logger.debug('Scheduler - processing ' + thisdir + ' for Account:' + (acc.id if acc is not None else 'unknown'))
+    state = _read_state(thisdir)
+    try:
+        for pub in sorted(os.listdir(thisdir)):
+            if pub == PROCESSFTP_STATE or pub in state["submitted"]:
+                continue
+            # should be a dir per publication notification - that is what they are told to provide
+            # and at this point there should just be one pub in here, whether it be a file or directory or archive
+            # by now this should look like this:
+            # /Incoming/ftptmp/<useruuid>/<transactionuuid>/<uploadeddirORfile>
+
+            # they should provide a directory of files or a zip, but it could just be one file
+            # but we don't know the hierarchy of the content, so we have to flatten it all.
+            # everything, including the contents of any archives, is written to the top level of
+            # a single zip (outside the directory, so it is never mistaken for a publication). Should be jats file at top now
+            fd, pkg = tempfile.mkstemp(suffix='.zip')
+            os.close(fd)
+            try:
+                flatten_to_zip(thisdir + '/' + pub, pkg)
+                stats["packages"] += 1
+                stats["bytes"] += os.path.getsize(pkg)
+
+                # create a notification and send to the API to join the unroutednotification index
+                notification = {
+                    "content": {"packaging_format": "https://pubrouter.jisc.ac.uk/FilesAndJATS"}
+                }
+                if direct:
+                    ok = submit_direct(acc, notification, pkg)
+                else:
+                    ok = submit_http(acc, notification, pkg)
+            finally:
+                os.remove(pkg)
+            if ok:
+                stats["submitted"] += 1
+                state["submitted"].append(pub)
+            else:
+                stats["failed"] += 1
+
+        # a deposit is only removed once everything in it has been submitted; if anything could not be (e.g. the
+        # owning account is no longer a publisher) the files are kept so the deposit is not lost
+        if stats["failed"] == 0:
+            shutil.rmtree(thisdir)
+            return stats
+        app.logger.error('Scheduler - ' + str(stats["failed"]) + ' submissions failed from ' + thisdir)
+    except Exception as e:
+        stats["failed"] += 1
+        app.logger.error("Scheduler - failed processing " + thisdir + ": '{x}'".format(x=e.message))
+
+    state["attempts"] += 1
+    try:
+        if state["attempts"] >= app.config.get('PROCESSFTP_MAX_ATTEMPTS', 3):
+            failed = os.path.join(app.config.get('PROCESSFTP_FAILED_DIR', '/tmp/ftpfailed'), os.path.basename(os.path.dirname(thisdir)))
+            if not os.path.exists(failed):
+                os.makedirs(failed)
+            _write_state(thisdir, state)
+            shutil.move(thisdir, failed)
+            app.logger.error('Scheduler - giving up on ' + thisdir + ' after ' + str(state["attempts"]) + ' attempts, moved it to ' + failed)
+        else:
+            _write_state(thisdir, state)
+            app.logger.info('Scheduler - leaving ' + thisdir + ' for the next run, after ' + str(state["attempts"]) + ' attempts')
+    except Exception as e:
+        app.logger.error("Scheduler - could not record the failure of " + thisdir + ": '{x}'".format(x=e.message))
+    return stats
+
+def _read_state(thisdir):
+    try:
+        with open(os.path.join(thisdir, PROCESSFTP_STATE)) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        state = {}
+    state.setdefault("submitted", [])
+    state.setdefault("attempts", 0)
+    return state
+
+def _write_state(thisdir, state):
+    with open(os.path.join(thisdir, PROCESSFTP_STATE), "w") as f:
+        json.dump(state, f)
+
+def ftp_jobs(userdir):
+    """
+    List the work waiting in the ftp temp directory as (account, uuid dir) pairs.
+
+    Each account's directories are taken oldest first, and the accounts are interleaved round-robin, so that one
+    publisher dropping a large batch does not hold up everyone else's deposits.
+    """
+    queues = []
+    for dir in os.listdir(userdir):
+        if not os.path.isdir(userdir + '/' + dir):
+            continue
+        udirs = [userdir + '/' + dir + '/' + udir for udir in os.listdir(userdir + '/' + dir)]
+        if len(udirs) == 0:
+            continue
+        udirs.sort(key=os.path.getmtime)
+        # configure for sending anything for the user of this dir
+        acc = models.Account().pull(dir)
+        queues.append((acc, udirs))
+
+    jobs = []
+    longest = max([len(q[1]) for q in queues]) if len(queues) > 0 else 0
+    for i in range(longest):
+        for acc, udirs in queues:
+            if i < len(udirs):
+                jobs.append((acc, udirs[i]))
+    return jobs, len(queues)
+
 def processftp():
+    with ftp_lock:
+        return _processftp()
+
+def _processftp():
+    stats = {"accounts" : 0, "dirs" : 0, "packages" : 0, "submitted" : 0, "failed" : 0, "bytes" : 0}
     try:
-        # list all directories in the temp dir - one for each ftp user for whom files have been moved from their jail
+        # list all directories in the temp dir - one for each ftp user for whom files have been moved from their jail.
+        # there is a uuid dir for each item moved in a given operation from the user jail
+        started = time.time()
         userdir = app.config.get('TMP_DIR','/tmp')
-        userdirs = os.listdir(userdir)
-        app.logger.debug("Scheduler - processing for FTP found " + str(len(userdirs)) + " temp user directories")
-        for dir in userdirs:
-            # configure for sending anything for the user of this dir
-            apiurl = app.config['API_URL']
-            acc = models.Account().pull(dir)
-            apiurl += '?api_key=' + acc.data['api_key']
-            # there is a uuid dir for each item moved in a given operation from the user jail
-            for udir in os.listdir(userdir + '/' + dir):
-                thisdir = userdir + '/' + dir + '/' + udir
-                app.logger.debug('Scheduler - processing ' + thisdir + ' for Account:' + dir)
-                for pub in os.listdir(thisdir):
-                    # should be a dir per publication notification - that is what they are told to provide
-                    # and at this point there should just be one pub in here, whether it be a file or directory or archive
-                    # if just a file, even an archive, dump it into a directory so it can be zipped easily
-                    if os.path.isfile(thisdir + '/' + pub):
-                        nf = uuid.uuid4().hex
-                        os.makedirs(thisdir + '/' + nf)
-                        shutil.move(thisdir + '/' + pub, thisdir + '/' + nf + '/')
-                        pub = nf
-                    
-                    # by now this should look like this:
-                    # /Incoming/ftptmp/<useruuid>/<transactionuuid>/<uploadeddirORuuiddir>/<thingthatwasuploaded>
-
-                    # they should provide a directory of files or a zip, but it could just be one file
-                    # but we don't know the hierarchy of the content, so we have to unpack and flatten it all
-                    # unzip and pull all docs to the top level then zip again. Should be jats file at top now
-                    flatten(thisdir + '/' + pub)
-                    pkg = thisdir + '/' + pub + '.zip'
-                    zip(thisdir + '/' + pub, pkg)
-
-                    # create a notification and send to the API to join the unroutednotification index
-                    notification = {
-                        "content": {"packaging_format": "https://pubrouter.jisc.ac.uk/FilesAndJATS"}
-                    }
-                    files = [
-                        ("metadata", ("metadata.json", json.dumps(notification), "application/json")),
-                        ("content", ("content.zip", open(pkg, "rb"), "application/zip"))
-                    ]
-                    app.logger.debug('Scheduler - processing POSTing ' + pkg + ' ' + json.dumps(notification))
-                    resp = requests.post(apiurl, files=files, verify=False)
-                    if str(resp.status_code).startswith('4') or str(resp.status_code).startswith('5'):
-                        app.logger.error('Scheduler - processing completed with POST failure to ' + apiurl + ' - ' + str(resp.status_code) + ' - ' + resp.text)
-                    else:
-                        app.logger.info('Scheduler - processing completed with POST to ' + apiurl + ' - ' + str(resp.status_code))
-                                            
-                shutil.rmtree(userdir + '/' + dir + '/' + udir)
+        direct = app.config.get('PROCESSFTP_DIRECT', True)
+        jobs, stats["accounts"] = ftp_jobs(userdir)
+        app.logger.debug("Scheduler - processing for FTP found " + str(len(jobs)) + " directories for " + str(stats["accounts"]) + " accounts")
+        if len(jobs) == 0:
+            return stats
+
+        workers = max(1, min(app.config.get('PROCESSFTP_WORKERS', 4), len(jobs)))
+        pool = ThreadPool(workers)
+        try:
+            for result in pool.imap_unordered(lambda job: processftp_dir(job[0], job[1], direct), jobs):
+                stats["dirs"] += 1
+                for k, v in result.iteritems():
+                    stats[k] += v
+        finally:
+            pool.close()
+            pool.join()
+
+        elapsed = time.time() - started
+        app.logger.info("Scheduler - processing for FTP handled {p} packages ({s} submitted, {f} failed, {b} bytes) from {d} directories for {a} accounts with {w} workers in {t:.1f}s ({r:.2f} packages/s)".format(
+            p=stats["packages"], s=stats["submitted"], f=stats["failed"], b=stats["bytes"], d=stats["dirs"], a=stats["accounts"],
+            w=workers, t=elapsed, r=stats["packages"] / elapsed if elapsed > 0 else 0.0))
     except Exception as e:
         app.logger.error("Scheduler - failed scheduled process for FTP temp directories: '{x}'".format(x=e.message))
+    return stats
 
 if app.config.get('PROCESSFTP_SCHEDULE',10) != 0:
     schedule.every(app.config.get('PROCESSFTP_SCHEDULE',10)).minutes.do(processftp)
 
 
+def intakeftp(account):
+    # called by the ftp watcher as soon as an account's uploads are complete, rather than waiting for the schedule
+    app.logger.info('Scheduler - FTP watcher found completed uploads for Account:' + account)
+    moveftp([account])
+    processftp()
+
+def watchftp():
+    if not app.config.get('FTP_WATCH', True):
+        return False
+    watcher = ftpwatch.FTPWatcher(app.config.get('USERDIR','/home/sftpusers'), intakeftp, quiet=app.config.get('FTP_WATCH_QUIET', 30))
+    return watcher.start()
+
+
 def checkunrouted():
     urobjids = []
     robjids = []
@@ -200,6 +460,8 @@ def checkunrouted():
             models.UnroutedNotification.bulk_delete(urobjids)
     except Exception as e:
         app.logger.error("Scheduler - Failed scheduled check for unrouted notifications: '{x}'".format(x=e.message))
+    # write out the delivery counts for whatever was routed, even if the run failed part way through
+    reports.flush_delivery_counts()
 
 if app.config.get('CHECKUNROUTED_SCHEDULE',10) != 0:
     schedule.every(app.config.get('CHECKUNROUTED_SCHEDULE',10)).minutes.do(checkunrouted)
@@ -304,12 +566,26 @@ if app.config.get('SCHEDULE_DELETE_OLD_ROUTED',False):
     schedule.every().day.at("03:00").do(delete_old_routed)
 
     
+def reconcile_counters():
+    app.logger.info('Scheduler - reconciling delivery counters with the routed indexes')
+    try:
+        months = reports.reconcile_counters()
+        app.logger.info('Scheduler - reconciled delivery counters for ' + str(len(months)) + ' months')
+    except Exception as e:
+        app.logger.error("Scheduler - Failed delivery counter reconciliation: '{x}'".format(x=e.message))
+
+if app.config.get('SCHEDULE_RECONCILE_COUNTERS',False):
+    schedule.every().day.at("02:00").do(reconcile_counters)
+
+
 def cheep():
     app.logger.debug("Scheduled cheep")
     print "Scheduled cheep"
 #schedule.every(1).minutes.do(cheep)
 
 def run():
+    # the polling schedule keeps running alongside the watcher, to catch anything it misses
+    watchftp()
     while True:
         schedule.run_pending()
         time.sleep(1)
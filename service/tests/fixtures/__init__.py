@@ -18,4 +18,5 @@ you can do
 from service.tests.fixtures.notifications import NotificationFactory
 from service.tests.fixtures.repository import RepositoryFactory
 from service.tests.fixtures.api import APIFactory
-from service.tests.fixtures.packages import TestPackageHandler, PackageFactory
\ No newline at end of file
+from service.tests.fixtures.packages import TestPackageHandler, PackageFactory
+from service.tests.fixtures.aggregations import LocalAggregations
\ No newline at end of file
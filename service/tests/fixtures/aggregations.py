@@ -0,0 +1,128 @@
+"""
+A local stand-in for the index which can answer aggregation queries over a list of records, so that code which
+asks the index for aggregations can be run and checked without one.
+
+It understands as much of the query DSL as the reports use: match_all, bool/must, range, term and exists in
+queries and filters, and date_histogram (by month), terms and filter aggregations, nested to any depth.
+"""
+
+from datetime import datetime
+import calendar
+
+class LocalAggregations(object):
+    """
+    Callable which answers an aggregation query the way the index would, returning the "aggregations"
+    part of the response
+    """
+
+    def __init__(self, records):
+        """
+        :param records: the records to aggregate over; either raw dicts or objects with their dict in .data
+        """
+        self.records = [r.data if hasattr(r, "data") else r for r in records]
+
+    def __call__(self, query):
+        docs = [d for d in self.records if self._matches(d, query.get("query"))]
+        return self._aggregate(docs, query.get("aggs", query.get("aggregations", {})))
+
+    def _values(self, doc, field):
+        # the .exact fields hold the same values as their parent, just unanalysed
+        if field.endswith(".exact"):
+            field = field[:-len(".exact")]
+        vals = [doc]
+        for part in field.split("."):
+            nxt = []
+            for v in vals:
+                if isinstance(v, list):
+                    v = [x.get(part) for x in v if isinstance(x, dict)]
+                    nxt.extend(v)
+                elif isinstance(v, dict):
+                    nxt.append(v.get(part))
+            vals = nxt
+        flat = []
+        for v in vals:
+            if isinstance(v, list):
+                flat.extend(v)
+            elif v is not None:
+                flat.append(v)
+        return flat
+
+    def _matches(self, doc, q):
+        if q is None or "match_all" in q:
+            return True
+        if "bool" in q:
+            must = q["bool"].get("must", [])
+            if isinstance(must, dict):
+                must = [must]
+            return all([self._matches(doc, m) for m in must])
+        if "filtered" in q:
+            return self._matches(doc, q["filtered"].get("query")) and self._matches(doc, q["filtered"].get("filter"))
+        if "range" in q:
+            field, bounds = q["range"].items()[0]
+            for v in self._values(doc, field):
+                if "gte" in bounds and not v >= bounds["gte"]:
+                    continue
+                if "gt" in bounds and not v > bounds["gt"]:
+                    continue
+                if "lte" in bounds and not v <= bounds["lte"]:
+                    continue
+                if "lt" in bounds and not v < bounds["lt"]:
+                    continue
+                return True
+            return False
+        if "term" in q:
+            field, val = q["term"].items()[0]
+            return val in self._values(doc, field)
+        if "exists" in q:
+            return len(self._values(doc, q["exists"]["field"])) > 0
+        raise ValueError("LocalAggregations does not understand the query " + str(q.keys()))
+
+    def _aggregate(self, docs, aggs):
+        result = {}
+        for name, agg in aggs.iteritems():
+            subs = agg.get("aggs", agg.get("aggregations", {}))
+            if "filter" in agg:
+                matched = [d for d in docs if self._matches(d, agg["filter"])]
+                res = {"doc_count" : len(matched)}
+                res.update(self._aggregate(matched, subs))
+            elif "terms" in agg:
+                res = {"buckets" : self._terms(docs, agg["terms"], subs)}
+            elif "date_histogram" in agg:
+                res = {"buckets" : self._date_histogram(docs, agg["date_histogram"], subs)}
+            else:
+                raise ValueError("LocalAggregations does not understand the aggregation " + name)
+            result[name] = res
+        return result
+
+    def _terms(self, docs, terms, subs):
+        groups = {}
+        for d in docs:
+            # a document is counted once in each bucket, however many times the value appears in it
+            for v in set(self._values(d, terms["field"])):
+                groups.setdefault(v, []).append(d)
+        size = terms.get("size", 10)
+        keys = sorted(groups.keys(), key=lambda k: (-len(groups[k]), k))
+        if size > 0:
+            keys = keys[:size]
+        return [self._bucket(k, groups[k], subs) for k in keys]
+
+    def _date_histogram(self, docs, hist, subs):
+        if hist.get("interval") != "month":
+            raise ValueError("LocalAggregations only supports date histograms by month")
+        groups = {}
+        for d in docs:
+            for v in self._values(d, hist["field"]):
+                ds = datetime.strptime(v, "%Y-%m-%dT%H:%M:%SZ")
+                key = calendar.timegm((ds.year, ds.month, 1, 0, 0, 0)) * 1000
+                groups.setdefault(key, []).append(d)
+        buckets = []
+        for k in sorted(groups.keys()):
+            b = self._bucket(k, groups[k], subs)
+            b["key_as_string"] = datetime.utcfromtimestamp(k / 1000).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+            buckets.append(b)
+        return buckets
+
+    def _bucket(self, key, docs, subs):
+        b = {"key" : key, "doc_count" : len(docs)}
+        b.update(self._aggregate(docs, subs))
+        return b
@@ -0,0 +1,41 @@
+"""
+Script which times building up and merging the routing metadata of a paper with very many authors, as happens when
+the match data is extracted from a large consortium paper's package and merged with that from its metadata.
+
+Run it with the number of authors (1000 by default):
+
+::
+
+    python service/tests/functional/benchmark_routing_metadata.py 1000
+
+It does not touch the index.
+"""
+
+from service import models
+import sys, time
+
+def build(authors):
+    md = models.RoutingMetadata()
+    for i in range(authors):
+        md.add_email(u"author{x}@example.ac.uk".format(x=i))
+        md.add_affiliation(u"Department {x}, University of Somewhere".format(x=i % 300))
+        md.add_author_id(u"0000-0000-{x:04d}".format(x=i), u"orcid")
+        md.add_author_id(u"Author {x}".format(x=i), u"name")
+        md.add_postcode(u"AB{x} 1CD".format(x=i % 200))
+        md.add_url(u"http://example.com/{x}".format(x=i % 50))
+    return md
+
+if __name__ == "__main__":
+    authors = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    start = time.time()
+    md = build(authors)
+    built = time.time() - start
+
+    other = build(authors)
+    start = time.time()
+    md.merge(other)
+    merged = time.time() - start
+
+    print "{a} authors: built in {b:.3f}s, merged in {c:.3f}s; {d} emails, {e} author ids, {f} affiliations".format(
+        a=authors, b=built, c=merged, d=len(md.emails), e=len(md.author_ids), f=len(md.affiliations))
@@ -5,13 +5,13 @@ This test suite will work fine against a standard JPER install on the local mach
 
 If you want to run it in a different environment you will need to modify some of the constants used in this test.
 """
-import requests, json, os
+import requests, json, os, time
 
 from octopus.modules.es.testindex import ESTestCase
 from octopus.modules.test.helpers import get_first_free_port, TestServer, make_config
 from service.tests import fixtures
 from octopus.core import app
-from service import web
+from service import web, models
 from octopus.lib import paths
 from octopus.modules.store import store
 
@@ -475,4 +475,50 @@ class TestAPI(ESTestCase):
         assert resp.headers["content-type"] == "application/json"
         j = resp.json()
         assert "error" in j
-        assert "pageSize" in j["error"]
\ No newline at end of file
+        assert "pageSize" in j["error"]
+
+    def test_19_get_store_content_ranges(self):
+        notification = fixtures.APIFactory.incoming()
+        example_package = fixtures.APIFactory.example_package_path()
+        url = self.api_base + "notification?api_key=" + API_KEY
+        files = [
+            ("metadata", ("metadata.json", json.dumps(notification), "application/json")),
+            ("content", ("content.zip", open(example_package, "rb"), "application/zip"))
+        ]
+        resp = requests.post(url, files=files)
+        loc = resp.headers["location"]
+        content_url = loc + "/content?api_key=" + API_KEY
+
+        resp = requests.get(content_url)
+        assert resp.status_code == 200
+        etag = resp.headers["etag"]
+        size = len(resp.content)
+
+        # a single range
+        resp = requests.get(content_url, headers={"Range" : "bytes=0-9"})
+        assert resp.status_code == 206
+        assert resp.headers["content-range"] == "bytes 0-9/" + str(size)
+        assert len(resp.content) == 10
+
+        # the rest of the content, as a later part of the same download
+        resp = requests.get(content_url, headers={"Range" : "bytes=10-"})
+        assert resp.status_code == 206
+        assert len(resp.content) == size - 10
+
+        # a range beyond the end of the content
+        resp = requests.get(content_url, headers={"Range" : "bytes=" + str(size + 10) + "-"})
+        assert resp.status_code == 416
+        assert resp.headers["content-range"] == "bytes */" + str(size)
+
+        # a conditional request for content which hasn't changed
+        resp = requests.get(content_url, headers={"If-None-Match" : etag})
+        assert resp.status_code == 304
+        assert resp.content == ""
+
+        # only the full download and the first range are logged as deliveries
+        time.sleep(app.config.get("CONTENTLOG_FLUSH_INTERVAL", 5) + 3)
+        nid = loc.split("/")[-1]
+        logs = models.ContentLog.object_query(q={"query" : {"match_all" : {}}, "size" : 100})
+        logs = [l for l in logs if l.notification == nid]
+        assert len(logs) == 2
+        assert len([l for l in logs if l.delivered_from == "store"]) == 2
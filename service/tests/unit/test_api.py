@@ -6,9 +6,11 @@ from octopus.modules.es.testindex import ESTestCase
 from octopus.lib import http, paths
 from octopus.core import app
 from service.tests import fixtures
-from service import api, models
+from service import api, models, content
 from octopus.modules.store import store
-import os
+import os, time
+from StringIO import StringIO
+from copy import deepcopy
 
 class MockResponse(object):
     def __init__(self, status_code):
@@ -214,3 +216,123 @@ class TestAPI(ESTestCase):
         with open(self.custom_zip_path) as f:
             with self.assertRaises(api.ValidationException):
                 api.JPER.validate(acc1, notification, f)
+
+    def test_07_list_cursor(self):
+        # some notifications analysed in the same second, and some later
+        source = fixtures.NotificationFactory.routed_notification()
+        ids = []
+        for i in range(7):
+            s = deepcopy(source)
+            del s["id"]
+            rn = models.RoutedNotification(s)
+            rn.analysis_date = "2015-06-01T00:00:00Z" if i < 4 else "2015-06-0" + str(i) + "T00:00:00Z"
+            rn.save()
+            ids.append(rn.id)
+
+        time.sleep(2)
+
+        # page through with the cursor, and we get everything once, in the same order as by page number
+        paged = []
+        for page in range(1, 4):
+            nl = api.JPER.list_notifications(None, "2001-01-01T00:00:00Z", page=page, page_size=3)
+            paged += [n["id"] for n in nl.notifications]
+
+        cursored = []
+        nl = api.JPER.list_notifications(None, "2001-01-01T00:00:00Z", page=1, page_size=3)
+        while len(nl.notifications) > 0:
+            cursored += [n["id"] for n in nl.notifications]
+            nl = api.JPER.list_notifications(None, None, page_size=3, cursor=nl.next)
+
+        assert sorted(cursored) == sorted(ids)
+        assert cursored == paged
+
+        # at the end, the cursor we gave is handed back, so it can be used again later
+        last = nl.next
+        assert last is not None
+        s = deepcopy(source)
+        del s["id"]
+        rn = models.RoutedNotification(s)
+        rn.analysis_date = "2015-07-01T00:00:00Z"
+        rn.save()
+        time.sleep(2)
+        nl = api.JPER.list_notifications(None, None, page_size=3, cursor=last)
+        assert [n["id"] for n in nl.notifications] == [rn.id]
+
+        with self.assertRaises(api.ParameterException):
+            api.JPER.list_notifications(None, None, page_size=3, cursor="notacursor")
+
+    def test_08_stored_content(self):
+        app.config["STORE_IMPL"] = "octopus.modules.store.store.StoreLocal"
+        s = store.StoreFactory.get()
+        s.store("content1", "file.txt", source_stream=StringIO("0123456789" * 10000))
+        self.stored_ids.append("content1")
+
+        sc = content.StoredContent.locate("content1", "file.txt")
+        assert sc.size == 100000
+        assert sc.last_modified is not None
+        assert sc.etag is not None
+        assert sc.etag == content.StoredContent.locate("content1", "file.txt").etag
+
+        # the whole file, or any range of it, across the chunk boundaries
+        assert "".join(sc.stream()) == "0123456789" * 10000
+        assert "".join(sc.stream(5, 15)) == "5678901234"
+        part = "".join(sc.stream(65530, 65540))
+        assert part == ("0123456789" * 10000)[65530:65540]
+        assert "".join(sc.stream(99995)) == "56789"
+
+        assert content.StoredContent.locate("content1", "missing.txt") is None
+
+    def test_09_accel_redirect(self):
+        app.config["STORE_IMPL"] = "octopus.modules.store.store.StoreLocal"
+        s = store.StoreFactory.get()
+        s.store("content2", "my file.zip", source_stream=StringIO("abc"))
+        self.stored_ids.append("content2")
+
+        accel = app.config.get("CONTENT_ACCEL_REDIRECT")
+        try:
+            # files are only handed to nginx if it has been set up to serve them
+            app.config["CONTENT_ACCEL_REDIRECT"] = None
+            assert content.StoredContent.locate("content2", "my file.zip").accel_redirect is None
+
+            app.config["CONTENT_ACCEL_REDIRECT"] = "/protected_store/"
+            sc = content.StoredContent.locate("content2", "my file.zip")
+            assert sc.accel_redirect == "/protected_store/content2/my%20file.zip"
+
+            # and only if they are on the local filesystem
+            sc.path = None
+            assert sc.accel_redirect is None
+        finally:
+            app.config["CONTENT_ACCEL_REDIRECT"] = accel
+
+    def test_10_create_duplicate(self):
+        acc1 = models.Account()
+        acc1.add_role('publisher')
+        acc1.save()
+
+        # the same metadata-only notification sent twice is only created once
+        notification = fixtures.APIFactory.incoming()
+        note1 = api.JPER.create_notification(acc1, notification)
+        time.sleep(2)
+        note2 = api.JPER.create_notification(acc1, fixtures.APIFactory.incoming())
+        assert note2.id == note1.id
+
+        # but the same article with content is created, as it has more to deliver
+        notification = fixtures.APIFactory.incoming()
+        del notification["links"]
+        filepath = fixtures.PackageFactory.example_package_path()
+        with open(filepath) as f:
+            note3 = api.JPER.create_notification(acc1, notification, f)
+        self.stored_ids.append(note3.id)
+        assert note3.id != note1.id
+        time.sleep(2)
+
+        # after which the same package, even with different metadata, is a duplicate of it
+        notification = fixtures.APIFactory.incoming()
+        del notification["links"]
+        notification["metadata"]["identifier"] = [{"type" : "doi", "id" : "10.pp/other"}]
+        with open(filepath) as f:
+            note4 = api.JPER.create_notification(acc1, notification, f)
+        assert note4.id == note3.id
+
+        time.sleep(2)
+        assert len(models.UnroutedNotification.object_query(q={"query" : {"match_all" : {}}})) == 2
@@ -215,3 +215,36 @@ class TestDAO(ESTestCase):
         assert len(rts) == 1
         assert "retrieval" in rts
 
+
+    def test_08_routed_box_targeting(self):
+        timebox = app.config.get("ESDAO_TIME_BOX_ROUTED")
+        lookback = app.config.get("ESDAO_TIME_BOX_LOOKBACK_ROUTED")
+        app.config["ESDAO_TIME_BOX_ROUTED"] = "month"
+        app.config["ESDAO_TIME_BOX_LOOKBACK_ROUTED"] = 3
+        try:
+            now = datetime.utcnow()
+
+            # a recent since date only needs the current month
+            rts = dao.RoutedNotificationDAO.read_types_since(now)
+            assert rts == [dao.RoutedNotificationDAO.get_write_type()]
+
+            # an old one needs all of them
+            rts = dao.RoutedNotificationDAO.read_types_since("2001-01-01T00:00:00Z")
+            assert rts == dao.RoutedNotificationDAO.get_read_types()
+
+            # a notification can be found with an empty locator, and then straight from its box
+            d = dao.RoutedNotificationDAO()
+            d.save()
+            time.sleep(2)
+
+            dao.RoutedNotificationDAO._boxes.clear()
+            assert dao.RoutedNotificationDAO.pull(d.id) is not None
+            assert dao.RoutedNotificationDAO._boxes.get(d.id) == dao.RoutedNotificationDAO.get_write_type()
+            assert dao.RoutedNotificationDAO.pull(d.id) is not None
+
+            # and a wrong box in the locator is recovered from
+            dao.RoutedNotificationDAO._boxes.put(d.id, "routed200101")
+            assert dao.RoutedNotificationDAO.pull(d.id) is not None
+        finally:
+            app.config["ESDAO_TIME_BOX_ROUTED"] = timebox
+            app.config["ESDAO_TIME_BOX_LOOKBACK_ROUTED"] = lookback
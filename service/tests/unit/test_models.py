@@ -7,6 +7,9 @@ from octopus.core import app
 from service import models
 from service.tests import fixtures
 from octopus.lib import dataobj
+import time, requests, json
+from threading import Thread
+from copy import deepcopy
 
 class TestModels(ESTestCase):
     def setUp(self):
@@ -244,3 +247,241 @@ class TestModels(ESTestCase):
 
 
 
+
+    def test_15_account_pull_many(self):
+        models.Account.uncache()
+
+        a1 = models.Account()
+        a1.repository_name = "Uni A"
+        a1.save(blocking=True)
+        a2 = models.Account()
+        a2.repository_name = "Uni B"
+        a2.save(blocking=True)
+
+        accs = models.Account.pull_many([a1.id, a2.id, a1.id, "notanaccount"])
+        assert len(accs) == 2
+        assert accs[a1.id].repository_name == "Uni A"
+        assert accs[a2.id].repository_name == "Uni B"
+
+        # changing what we got back doesn't change what is cached
+        accs[a1.id].repository_name = "Changed"
+        accs = models.Account.pull_many([a1.id])
+        assert accs[a1.id].repository_name == "Uni A"
+
+        # but saving an account means the next lookup gets the new version
+        a2.repository_name = "Uni B Renamed"
+        a2.save(blocking=True)
+        accs = models.Account.pull_many([a2.id])
+        assert accs[a2.id].repository_name == "Uni B Renamed"
+
+    def test_16_outgoing_json(self):
+        import json
+        source = fixtures.NotificationFactory.routed_notification()
+        rn = models.RoutedNotification(source)
+
+        # the pre-rendered json is the same as the outgoing notification's
+        rendered = models.RoutedNotification.outgoing_json(source)
+        assert json.loads(rendered) == rn.make_outgoing().data
+        assert json.loads(models.RoutedNotification.outgoing_json(source, provider=True)) == rn.make_outgoing(provider=True).data
+
+        # and is served from the cache the next time
+        assert models.RoutedNotification.outgoing_json(source) is rendered
+
+        # a list built from rendered notifications serialises the same as one built from the data
+        nl1 = models.NotificationList()
+        nl1.page = 1
+        nl1.notifications = [rn.make_outgoing().data]
+        nl2 = models.NotificationList()
+        nl2.page = 1
+        nl2.set_rendered_notifications([rendered])
+        assert json.loads(nl1.json()) == json.loads(nl2.json())
+        assert nl2.notifications == nl1.notifications
+
+    def test_17_account_pull_by_api_key(self):
+        models.Account.uncache()
+        acc = models.Account()
+        acc.set_api_key("key-one")
+        acc.add_role("repository")
+        acc.save(blocking=True)
+
+        before = models.Account.api_key_cache_stats()
+        a1 = models.Account.pull_by_api_key("key-one")
+        a2 = models.Account.pull_by_api_key("key-one")
+        after = models.Account.api_key_cache_stats()
+        assert a1.id == acc.id and a2.id == acc.id
+        assert after["misses"] == before["misses"] + 1
+        assert after["hits"] == before["hits"] + 1
+
+        assert models.Account.pull_by_api_key("not-a-key") is None
+
+        # changing the key and role takes effect straight away in this process
+        acc.set_api_key("key-two")
+        acc.add_role("admin")
+        acc.save(blocking=True)
+        assert models.Account.pull_by_api_key("key-one") is None
+        assert models.Account.pull_by_api_key("key-two").has_role("admin")
+
+        # a change made by another process, which can't clear this process's cache, takes effect once the cached
+        # account expires
+        ttl = app.config.get("API_KEY_CACHE_TTL")
+        app.config["API_KEY_CACHE_TTL"] = 1
+        try:
+            assert models.Account.pull_by_api_key("key-two") is not None
+            raw = deepcopy(acc.data)
+            raw["api_key"] = "key-three"
+            raw["role"] = ["repository"]
+            requests.put(app.config["ELASTIC_SEARCH_HOST"] + "/" + app.config["ELASTIC_SEARCH_INDEX"] + "/account/" + acc.id,
+                         data=json.dumps(raw), params={"refresh" : "true"})
+            assert models.Account.pull_by_api_key("key-two").has_role("admin")
+            time.sleep(1.1)
+            assert models.Account.pull_by_api_key("key-two") is None
+            assert not models.Account.pull_by_api_key("key-three").has_role("admin")
+
+            # as does its deletion
+            requests.delete(app.config["ELASTIC_SEARCH_HOST"] + "/" + app.config["ELASTIC_SEARCH_INDEX"] + "/account/" + acc.id,
+                            params={"refresh" : "true"})
+            assert models.Account.pull_by_api_key("key-three") is not None
+            time.sleep(1.1)
+            assert models.Account.pull_by_api_key("key-three") is None
+        finally:
+            app.config["API_KEY_CACHE_TTL"] = ttl
+
+    def test_18_contentlog_buffer(self):
+        buf = models.contentlog.ContentLogBuffer()
+        batch = app.config.get("CONTENTLOG_BATCH")
+        bufmax = app.config.get("CONTENTLOG_BUFFER_MAX")
+        app.config["CONTENTLOG_BATCH"] = 3
+        try:
+            # entries wait in the buffer until the batch fills, then are written together by the background thread
+            for i in range(2):
+                buf.add({"user" : "u1", "notification" : "n" + str(i), "delivered_from" : "store"})
+            assert buf.stats["queued"] == 2 and buf.stats["written"] == 0
+            buf.add({"user" : "u1", "notification" : "n2", "delivered_from" : "proxy"})
+            for i in range(20):
+                if buf.stats["written"] == 3:
+                    break
+                time.sleep(0.1)
+            assert buf.stats["written"] == 3
+
+            time.sleep(2)
+            logs = models.ContentLog.object_query(q={"query" : {"match_all" : {}}})
+            assert len(logs) == 3
+            assert len([l for l in logs if l.delivered_from == "proxy"]) == 1
+
+            # if the index can't be reached, the entries are dropped and counted
+            host = app.config["ELASTIC_SEARCH_HOST"]
+            app.config["ELASTIC_SEARCH_HOST"] = "http://localhost:1"
+            try:
+                buf.add({"user" : "u1", "notification" : "n3", "delivered_from" : "notfound"})
+                buf.flush()
+            finally:
+                app.config["ELASTIC_SEARCH_HOST"] = host
+            assert buf.stats["dropped"] == 1
+            assert buf.stats["written"] == 3
+
+            # once the buffer is full, further entries are dropped rather than held
+            app.config["CONTENTLOG_BATCH"] = 100
+            app.config["CONTENTLOG_BUFFER_MAX"] = 1
+            buf.add({"user" : "u1", "notification" : "n4", "delivered_from" : "store"})
+            buf.add({"user" : "u1", "notification" : "n5", "delivered_from" : "store"})
+            assert buf.stats["queued"] == 5
+            assert buf.stats["dropped"] == 2
+        finally:
+            app.config["CONTENTLOG_BATCH"] = batch
+            app.config["CONTENTLOG_BUFFER_MAX"] = bufmax
+
+    def test_19_duplicate_keys(self):
+        # the same identifiers written differently make the same keys, and other identifier types are ignored
+        keys = models.DuplicateKey.keys([
+            {"type" : "doi", "id" : "https://doi.org/10.PP/Jit.1"},
+            {"type" : "pmcid", "id" : "1234"},
+            {"type" : "pmid", "id" : " 5678 "},
+            {"type" : "issn", "id" : "1234-5678"}
+        ], "abcd")
+        assert keys == ["doi:10.pp/jit.1", "package:abcd", "pmcid:PMC1234", "pmid:5678"]
+        assert models.DuplicateKey.keys([{"type" : "doi", "id" : "doi:10.pp/jit.1"}]) == ["doi:10.pp/jit.1"]
+
+        # nothing is a duplicate until its keys have been claimed
+        assert models.DuplicateKey.find_duplicate(["doi:10.pp/jit.1"]) is None
+        assert models.DuplicateKey.claim(["doi:10.pp/jit.1", "pmid:5678"], "n1", "p1", content=False) is None
+
+        # after which a copy is a duplicate, straight away
+        dup = models.DuplicateKey.claim(["doi:10.pp/jit.1"], "n1a", "p1")
+        assert dup is not None
+        assert dup.notification == "n1"
+        assert dup.provider_id == "p1"
+        assert models.DuplicateKey.find_duplicate(["doi:10.pp/jit.1"]).notification == "n1"
+
+        # a copy which brings content the earlier one didn't have is let through, and then supersedes it
+        assert models.DuplicateKey.claim(["pmid:5678", "package:abcd"], "n2", "p2", content=True) is None
+        assert models.DuplicateKey.find_duplicate(["pmid:5678"], content=True).notification == "n2"
+        assert models.DuplicateKey.find_duplicate(["package:abcd"], content=True).notification == "n2"
+        assert models.DuplicateKey.find_duplicate(["doi:10.pp/jit.1"]).notification == "n1"
+
+        # of two copies claiming at once, only one gets the keys, and the other is a duplicate of it
+        results = []
+        threads = [Thread(target=lambda n: results.append((n, models.DuplicateKey.claim(["doi:10.pp/jit.2", "pmid:9999"], n, "p1"))), args=(n,))
+                   for n in ["n3", "n4"]]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        claimed = [n for n, dup in results if dup is None]
+        assert len(claimed) == 1
+        assert [dup.notification for n, dup in results if dup is not None] == claimed
+
+        # keys given up by a notification which failed don't make later copies duplicates
+        assert models.DuplicateKey.claim(["doi:10.pp/jit.3"], "n5", "p1") is None
+        models.DuplicateKey.release(["doi:10.pp/jit.3"])
+        assert models.DuplicateKey.claim(["doi:10.pp/jit.3"], "n6", "p1") is None
+
+        # keys older than the window are ignored
+        window = app.config.get("DUPLICATE_WINDOW_DAYS")
+        app.config["DUPLICATE_WINDOW_DAYS"] = -1
+        try:
+            assert models.DuplicateKey.find_duplicate(["doi:10.pp/jit.1"]) is None
+        finally:
+            app.config["DUPLICATE_WINDOW_DAYS"] = window
+
+    def test_20_routing_metadata_unique(self):
+        md = models.RoutingMetadata()
+        for i in range(3):
+            md.add_email("one@example.com")
+            md.add_author_id("aaaa-0000", "orcid")
+            md.add_affiliation(None)
+        md.add_email("two@example.com")
+        md.add_author_id("aaaa-0000", "other")
+
+        # the values are only held once, and are still plain lists in the data
+        assert md.data["emails"] == [u"one@example.com", u"two@example.com"]
+        assert md.author_ids == [{"id" : u"aaaa-0000", "type" : u"orcid"}, {"id" : u"aaaa-0000", "type" : u"other"}]
+        assert "affiliations" not in md.data
+
+        # changes made to the lists other than through the add methods are respected
+        md.data["emails"] = [u"three@example.com"]
+        md.add_email("one@example.com")
+        md.add_email("three@example.com")
+        assert md.emails == [u"three@example.com", u"one@example.com"]
+
+        other = models.RoutingMetadata({"emails" : [u"one@example.com", u"four@example.com"], "keywords" : [u"a", u"a"]})
+        md.merge(other)
+        assert md.emails == [u"three@example.com", u"one@example.com", u"four@example.com"]
+        assert md.keywords == [u"a"]
+
+    def test_21_delivery_counters(self):
+        r1 = models.DeliveryCounter.counter_id("2015-06", "repo1")
+        unique = models.DeliveryCounter.counter_id("2015-06")
+        other = models.DeliveryCounter.counter_id("2015-07", "repo1")
+        failed = models.DeliveryCounter.bulk_add({r1 : {"md" : 2, "content" : 1}, unique : {"md" : 1}, other : {"content" : 5}})
+        assert failed == {}
+        models.DeliveryCounter.bulk_add({r1 : {"md" : 1}})
+        time.sleep(2)
+
+        # the months are held as they are, rather than being taken for dates, so the counters can be found by month
+        counters = dict([(c.id, c) for c in models.DeliveryCounter.pull_by_months(["2015-06"])])
+        assert sorted(counters.keys()) == sorted([r1, unique])
+        assert counters[r1].md == 3
+        assert counters[r1].content == 1
+        assert counters[r1].repository == "repo1"
+        assert counters[unique].repository is None
+        assert len(models.DeliveryCounter.pull_by_months(["2015-06", "2015-07"])) == 3
@@ -17,6 +17,7 @@ from random import randint
 import time, csv, os
 
 REPORT_FILE = paths.rel2abs(__file__, "..", "resources", "report1.csv")
+REPORT_FILE_2 = paths.rel2abs(__file__, "..", "resources", "report2.csv")
 RESOURCES = paths.rel2abs(__file__, "..", "resources")
 MONTHTRACKER = paths.rel2abs(__file__, "..", "resources", "monthtracker.cfg")
 
@@ -34,6 +35,8 @@ class TestModels(ESTestCase):
         app.config["RUN_SCHEDULE"] = self.run_schedule
         if os.path.exists(REPORT_FILE):
             os.remove(REPORT_FILE)
+        if os.path.exists(REPORT_FILE_2):
+            os.remove(REPORT_FILE_2)
         app.config['REPORTSDIR'] = self.old_reportsdir
         if os.path.exists(MONTHTRACKER):
             os.remove(MONTHTRACKER)
@@ -98,6 +101,27 @@ class TestModels(ESTestCase):
 
         return name_id_map, accounts
 
+    def _scroll_counts(self, from_date, to_date, months):
+        # count the notifications one at a time, the way the report used to, to check the aggregations against
+        result = {}
+        uniques = {}
+        for m in months:
+            uniques[m] = {"md" : 0, "content" : 0}
+
+        q = reports.DeliveryReportQuery(from_date, to_date)
+        for note in models.RoutedNotification.scroll(q.query(), page_size=100, keepalive="5m"):
+            nm = note.analysis_datestamp.month
+            is_with_content = len(note.links) > 0
+            uniques[nm]["content" if is_with_content else "md"] += 1
+            for r in note.repositories:
+                if r not in result:
+                    result[r] = {}
+                    for m in months:
+                        result[r][m] = {"md" : 0, "content" : 0}
+                result[r][nm]["content" if is_with_content else "md"] += 1
+
+        return result, uniques
+
 
     def test_01_monthly_new(self):
         notes = {
@@ -481,4 +505,150 @@ class TestModels(ESTestCase):
     def test_04_scheduling(self):
         now = datetime.now()
         scheduler.monthly_reporting()
-        assert os.path.exists(os.path.join(RESOURCES, "monthly_notifications_to_institutions_" + str(now.year) + ".csv"))
\ No newline at end of file
+        assert os.path.exists(os.path.join(RESOURCES, "monthly_notifications_to_institutions_" + str(now.year) + ".csv"))
+
+    def test_05_aggregations_match_scroll(self):
+        notes = {
+            "Uni A" : {
+                1 : { "md" : 1, "content" : 2 },
+                2 : { "md" : 3, "content" : 0 }
+            },
+            "Uni B" : {
+                2 : { "md" : 0, "content" : 4 },
+                3 : { "md" : 5, "content" : 6 }
+            },
+            "Uni A, Uni B" : {
+                1 : { "md" : 7, "content" : 8 },
+                3 : { "md" : 9, "content" : 10 }
+            }
+        }
+        self._load_data(notes)
+
+        time.sleep(5)
+
+        now = datetime.utcnow()
+        year = str(now.year)
+        from_date = year + "-01-01T00:00:00Z"
+        to_date = year + "-04-01T00:00:00Z"
+        months = range(1, 5)
+
+        # the report from the index's aggregations
+        reports.delivery_report(from_date, to_date, REPORT_FILE)
+
+        # and the same report counted one notification at a time
+        result, uniques = self._scroll_counts(from_date, to_date, months)
+        reports.write_delivery_report(result, uniques, REPORT_FILE_2)
+
+        with open(REPORT_FILE, "rb") as f:
+            aggregated = f.read()
+        with open(REPORT_FILE_2, "rb") as f:
+            scrolled = f.read()
+        assert aggregated == scrolled
+
+    def test_06_local_aggregations(self):
+        notes = {
+            "Uni A" : {
+                1 : { "md" : 2, "content" : 1 },
+                3 : { "md" : 0, "content" : 3 }
+            },
+            "Uni B, Uni C" : {
+                1 : { "md" : 4, "content" : 5 },
+                2 : { "md" : 6, "content" : 0 }
+            }
+        }
+        self._load_data(notes)
+
+        time.sleep(5)
+
+        now = datetime.utcnow()
+        year = str(now.year)
+        from_date = year + "-01-01T00:00:00Z"
+        to_date = year + "-04-01T00:00:00Z"
+        months = range(1, 5)
+
+        q = reports.DeliveryReportQuery(from_date, to_date)
+        local = fixtures.LocalAggregations(models.RoutedNotification.scroll(q.query(), page_size=100, keepalive="5m"))
+
+        # the stand-in gives the same counts as the index
+        assert reports.delivery_counts(local(q.aggregation_query()), months) == \
+               reports.delivery_counts(reports.routed_aggregations(q.aggregation_query()), months)
+
+        # and so the same report
+        reports.delivery_report(from_date, to_date, REPORT_FILE)
+        reports.delivery_report(from_date, to_date, REPORT_FILE_2, aggregate=local)
+        with open(REPORT_FILE, "rb") as f:
+            indexed = f.read()
+        with open(REPORT_FILE_2, "rb") as f:
+            stood_in = f.read()
+        assert indexed == stood_in
+
+    def test_07_counters_match_aggregations(self):
+        notes = {
+            "Uni A" : {
+                1 : { "md" : 1, "content" : 2 },
+                2 : { "md" : 3, "content" : 4 }
+            },
+            "Uni A, Uni B" : {
+                2 : { "md" : 5, "content" : 6 },
+                3 : { "md" : 7, "content" : 0 }
+            }
+        }
+        self._load_data(notes)
+
+        time.sleep(5)
+
+        # the notifications were saved directly, not routed, so the counters only know about them once reconciled
+        months = reports.reconcile_counters()
+        year = str(datetime.utcnow().year)
+        assert year + "-01" in months
+        assert year + "-03" in months
+
+        time.sleep(2)
+
+        from_date = year + "-01-01T00:00:00Z"
+        to_date = year + "-04-01T00:00:00Z"
+
+        reports.delivery_report(from_date, to_date, REPORT_FILE)
+        app.config["REPORT_FROM_COUNTERS"] = True
+        try:
+            reports.delivery_report(from_date, to_date, REPORT_FILE_2)
+        finally:
+            app.config["REPORT_FROM_COUNTERS"] = False
+
+        with open(REPORT_FILE, "rb") as f:
+            aggregated = f.read()
+        with open(REPORT_FILE_2, "rb") as f:
+            counted = f.read()
+        assert aggregated == counted
+
+    def test_08_count_deliveries(self):
+        source = fixtures.NotificationFactory.routed_notification()
+        counter = reports.DeliveryCounts(batch=3)
+
+        # two with content to repositories a and b, and two metadata only to repository a
+        for i in range(4):
+            s = deepcopy(source)
+            del s["id"]
+            if i >= 2:
+                del s["links"]
+            rn = models.RoutedNotification(s)
+            rn.analysis_date = "2016-02-10T00:00:00Z"
+            rn.repositories = ["a", "b"] if i < 2 else ["a"]
+            counter.add(rn)
+
+        # the third notification filled the batch, so the first three are written, and the last is still waiting
+        assert counter.pending == 1
+        counter.flush()
+        assert counter.pending == 0
+
+        time.sleep(2)
+
+        stats = reports.delivery_statistics("2016-01", "2016-03")
+        assert stats["repositories"]["a"]["2016-02"] == {"md" : 2, "content" : 2, "total" : 4}
+        assert stats["repositories"]["b"]["2016-02"] == {"md" : 0, "content" : 2, "total" : 2}
+        assert stats["unique"]["2016-02"] == {"md" : 2, "content" : 2, "total" : 4}
+
+        # a repository only sees its own counts
+        stats = reports.delivery_statistics("2016-01", "2016-03", repository="b")
+        assert stats["repositories"].keys() == ["b"]
+        assert "unique" not in stats
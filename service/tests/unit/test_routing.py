@@ -419,6 +419,27 @@ class TestRouting(ESTestCase):
                 assert len(n.get("identifier", [])) == 1
 
 
+    def test_12_enhance_many_authors(self):
+        # a paper with thousands of authors, each known by ORCID in the notification, and by name and email with their
+        # affiliation in the metadata extracted from the package
+        source = fixtures.NotificationFactory.routed_notification()
+        source["metadata"]["author"] = [{"name" : "Author " + str(i), "identifier" : [{"type" : "orcid", "id" : "0000-" + str(i)}]} for i in range(3000)]
+        routed = models.RoutedNotification(source)
+
+        md = models.NotificationMetadata()
+        md.authors = [{"name" : "Author " + str(i), "affiliation" : "CERN"} for i in range(3000)] + \
+                     [{"name" : "Someone Else", "identifier" : [{"type" : "email", "id" : "else@example.com"}]}]
+        for i in range(3):
+            md.add_identifier("10.pp/jit.1", "doi")
+
+        routing.enhance(routed, md)
+
+        # each author is merged with the one of the same name, and the one new author is added
+        assert len(routed.authors) == 3001
+        assert routed.authors[1234] == {"name" : "Author 1234", "identifier" : [{"type" : "orcid", "id" : "0000-1234"}], "affiliation" : "CERN"}
+        assert routed.authors[3000]["name"] == "Someone Else"
+        assert routed.get_identifiers("doi").count("10.pp/jit.1") == 1
+
     def test_50_match_success(self):
         # example routing metadata from a notification
         source = fixtures.NotificationFactory.routing_metadata()
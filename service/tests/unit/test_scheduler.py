@@ -0,0 +1,212 @@
+"""
+Unit tests for the FTP processing functions in the scheduler
+"""
+
+from unittest import TestCase
+from service import scheduler, models, ftpwatch
+from octopus.core import app
+
+import os, shutil, tarfile, tempfile, zipfile, time
+
+class TestScheduler(TestCase):
+    def setUp(self):
+        super(TestScheduler, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.pub = os.path.join(self.tmp, "pub")
+        os.makedirs(os.path.join(self.pub, "sub"))
+        self.old_pull = models.Account.pull
+        self.old_submit = scheduler.submit_direct
+
+    def tearDown(self):
+        super(TestScheduler, self).tearDown()
+        shutil.rmtree(self.tmp)
+        models.Account.pull = self.old_pull
+        scheduler.submit_direct = self.old_submit
+
+    def test_01_flatten_nested(self):
+        # a jats file at the top, and one of the same name deeper down
+        with open(os.path.join(self.pub, "article.xml"), "w") as f:
+            f.write("<article/>")
+        with open(os.path.join(self.pub, "sub", "article.xml"), "w") as f:
+            f.write("<article/>")
+
+        # a zip inside a zip
+        inner = os.path.join(self.tmp, "inner.zip")
+        zf = zipfile.ZipFile(inner, "w")
+        zf.writestr("figures/fig1.png", "PNG")
+        zf.writestr("../../escape.txt", "escape")
+        zf.close()
+        zf = zipfile.ZipFile(os.path.join(self.pub, "sub", "outer.zip"), "w")
+        zf.write(inner, "deep/inner.zip")
+        zf.writestr("paper.pdf", "%PDF")
+        zf.close()
+
+        # a tar
+        tf = tarfile.open(os.path.join(self.pub, "bundle.tar.gz"), "w:gz")
+        tf.add(os.path.join(self.pub, "article.xml"), "supplementary/supp.xml")
+        tf.close()
+
+        # something which claims to be a zip but isn't
+        with open(os.path.join(self.pub, "broken.zip"), "w") as f:
+            f.write("not a zip")
+
+        pkg = os.path.join(self.tmp, "pub.zip")
+        written = scheduler.flatten_to_zip(self.pub, pkg)
+
+        assert sorted(written) == ["article.xml", "broken.zip", "escape.txt", "fig1.png", "paper.pdf", "sub/article.xml", "supp.xml"]
+
+        zf = zipfile.ZipFile(pkg)
+        types = dict([(i.filename, i.compress_type) for i in zf.infolist()])
+        assert types["paper.pdf"] == zipfile.ZIP_STORED
+        assert types["fig1.png"] == zipfile.ZIP_STORED
+        assert types["article.xml"] == zipfile.ZIP_DEFLATED
+        assert zf.read("escape.txt") == "escape"
+
+    def test_02_flatten_single_file(self):
+        fl = os.path.join(self.tmp, "deposit.zip")
+        zf = zipfile.ZipFile(fl, "w")
+        zf.writestr("a/b/c/article.xml", "<article/>")
+        zf.close()
+
+        pkg = os.path.join(self.tmp, "deposit.zip.zip")
+        written = scheduler.flatten_to_zip(fl, pkg)
+        assert written == ["article.xml"]
+
+    def test_03_safe_name(self):
+        assert scheduler.safe_name("../../etc/passwd") == "etc/passwd"
+        assert scheduler.safe_name("/abs/./path/file.xml") == "abs/path/file.xml"
+        assert scheduler.safe_name("..") == ""
+
+    def test_04_ftp_jobs_round_robin(self):
+        def mock_pull(cls, id):
+            acc = models.Account()
+            acc.id = id
+            return acc
+        models.Account.pull = classmethod(mock_pull)
+
+        userdir = os.path.join(self.tmp, "ftptmp")
+        waiting = {"busy" : 5, "quiet" : 1, "middling" : 2}
+        for acc, n in waiting.iteritems():
+            for i in range(n):
+                os.makedirs(os.path.join(userdir, acc, "u" + str(i)))
+                # make sure the modified times are in the same order as the names
+                t = time.time() - 100 + i
+                os.utime(os.path.join(userdir, acc, "u" + str(i)), (t, t))
+
+        jobs, accounts = scheduler.ftp_jobs(userdir)
+        assert accounts == 3
+        assert len(jobs) == 8
+
+        # every account gets its first directory processed before anyone gets their second
+        assert sorted([acc.id for acc, udir in jobs[:3]]) == ["busy", "middling", "quiet"]
+        assert sorted([acc.id for acc, udir in jobs[3:5]]) == ["busy", "middling"]
+        assert [acc.id for acc, udir in jobs[5:]] == ["busy", "busy", "busy"]
+
+        # and each account's directories are taken oldest first
+        busy = [os.path.basename(udir) for acc, udir in jobs if acc.id == "busy"]
+        assert busy == ["u0", "u1", "u2", "u3", "u4"]
+
+    def test_05_watcher_quiescence(self):
+        seen = []
+        watcher = ftpwatch.FTPWatcher(self.tmp, seen.append, quiet=30)
+
+        # activity outside of an xfer directory is ignored
+        assert watcher.account_for(os.path.join(self.tmp, "pub", "article.xml")) is None
+        assert watcher.account_for(os.path.join(self.tmp, "pubone", "xfer", "article.zip")) == "pubone"
+
+        # one account finishes a file, another is still writing
+        watcher.activity(os.path.join(self.tmp, "pubone", "xfer", "one.zip"), completed=True, now=100)
+        watcher.activity(os.path.join(self.tmp, "pubtwo", "xfer", "two.zip"), now=100)
+
+        # nothing is ready until the quiet period has passed
+        watcher.dispatch(now=110)
+        assert seen == []
+
+        # more writing on pubone pushes it back
+        watcher.activity(os.path.join(self.tmp, "pubone", "xfer", "big.zip"), now=120)
+        watcher.dispatch(now=140)
+        assert seen == []
+
+        # pubtwo never completed anything, so only pubone is picked up, and only once
+        watcher.dispatch(now=150)
+        assert seen == ["pubone"]
+        watcher.dispatch(now=200)
+        assert seen == ["pubone"]
+
+    def test_06_move_manifest(self):
+        output = "0123abcd\tarticle.zip\0" + "4567ef01\tname with\ttab and\nnewline\0"
+        manifest = scheduler.parse_move_manifest(output, "/tmp/ftptmp", "pubone")
+        assert len(manifest) == 2
+        assert manifest[0] == {"item" : "article.zip", "uniqueid" : "0123abcd", "uniquedir" : "/tmp/ftptmp/pubone/0123abcd"}
+        assert manifest[1]["item"] == "name with\ttab and\nnewline"
+
+        # nothing moved, nothing in the manifest
+        assert scheduler.parse_move_manifest("", "/tmp/ftptmp", "pubone") == []
+
+    def test_07_flatten_old_and_large(self):
+        # a tar member from 1970, and a file on disk just as old
+        content = os.path.join(self.tmp, "content.xml")
+        with open(content, "w") as f:
+            f.write("<article/>" * 1000)
+        tf = tarfile.open(os.path.join(self.pub, "bundle.tar"), "w")
+        info = tf.gettarinfo(content, "old.xml")
+        info.mtime = 0
+        with open(content, "rb") as f:
+            tf.addfile(info, f)
+        tf.close()
+        os.utime(content, (0, 0))
+        shutil.move(content, os.path.join(self.pub, "sub", "ancient.xml"))
+
+        # with members this size and up copied to disk rather than held in memory
+        spool = scheduler.SPOOL_MAX_SIZE
+        scheduler.SPOOL_MAX_SIZE = 100
+        try:
+            pkg = os.path.join(self.tmp, "pub.zip")
+            written = scheduler.flatten_to_zip(self.pub, pkg)
+        finally:
+            scheduler.SPOOL_MAX_SIZE = spool
+
+        assert sorted(written) == ["ancient.xml", "old.xml"]
+        zf = zipfile.ZipFile(pkg)
+        assert zf.getinfo("old.xml").date_time == scheduler.ZIP_MIN_DATE
+        assert zf.getinfo("ancient.xml").date_time == scheduler.ZIP_MIN_DATE
+        assert zf.read("old.xml") == "<article/>" * 1000
+
+    def test_08_processftp_dir_failures(self):
+        thisdir = os.path.join(self.tmp, "ftptmp", "pubone", "u0")
+        for pub in ["first", "second"]:
+            os.makedirs(os.path.join(thisdir, pub))
+            with open(os.path.join(thisdir, pub, "article.xml"), "w") as f:
+                f.write("<article/>")
+
+        # the first publication goes in, the second is refused
+        submitted = []
+        def mock_submit(acc, notification, pkg):
+            submitted.append(pkg)
+            assert not pkg.startswith(thisdir)
+            return len(submitted) == 1
+        scheduler.submit_direct = mock_submit
+
+        failed_dir = app.config.get("PROCESSFTP_FAILED_DIR")
+        attempts = app.config.get("PROCESSFTP_MAX_ATTEMPTS")
+        app.config["PROCESSFTP_FAILED_DIR"] = os.path.join(self.tmp, "failed")
+        app.config["PROCESSFTP_MAX_ATTEMPTS"] = 2
+        try:
+            stats = scheduler.processftp_dir(None, thisdir)
+            assert stats["submitted"] == 1 and stats["failed"] == 1
+
+            # the deposit is kept, with nothing left behind in it but a note of what has been submitted
+            assert sorted(os.listdir(thisdir)) == [scheduler.PROCESSFTP_STATE, "first", "second"]
+
+            # next time only the second is tried, and as it fails again the deposit is moved aside
+            stats = scheduler.processftp_dir(None, thisdir)
+            assert stats["packages"] == 1 and stats["failed"] == 1
+            assert len(submitted) == 3
+            assert not os.path.exists(thisdir)
+            assert os.path.isdir(os.path.join(self.tmp, "failed", "pubone", "u0", "second"))
+
+            # all the packages were cleaned up
+            assert len([p for p in submitted if os.path.exists(p)]) == 0
+        finally:
+            app.config["PROCESSFTP_FAILED_DIR"] = failed_dir
+            app.config["PROCESSFTP_MAX_ATTEMPTS"] = attempts
@@ -269,6 +269,7 @@ def apikey(username):
     if current_user.id != username and not current_user.is_super:
         abort(401)
     acc = models.Account.pull(username)
+    # saving drops the old key from this process's cache of API keys; other processes hold it for at most API_KEY_CACHE_TTL
     acc.data['api_key'] = str(uuid.uuid4())
     acc.save()
     time.sleep(2);
@@ -331,6 +332,7 @@ def changerole(username,role):
             else:
                 acc.remove_role(role)
                 acc.save()
+        # the account is saved with its new roles, which drops it from this process's API key cache
         time.sleep(1)
         flash("Record updated", "success")
         return redirect(url_for('.username', username=username))
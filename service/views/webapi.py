@@ -3,12 +3,14 @@ Blueprint which provides the RESTful web API for JPER
 """
 from flask import Blueprint, make_response, url_for, request, abort, redirect, current_app
 from flask import stream_with_context, Response
-import json, csv
+from werkzeug.http import is_resource_modified, http_date, quote_etag
+from datetime import datetime
+import json, csv, mimetypes
 from octopus.core import app
 from octopus.lib import webapp, dates
 from flask.ext.login import login_user, logout_user, current_user, login_required
 from service.api import JPER, ValidationException, ParameterException, UnauthorisedException
-from service import models
+from service import models, reports
 
 blueprint = Blueprint('webapi', __name__)
 
@@ -92,13 +94,9 @@ def standard_authentication():
     elif apik:
         print "API key provided " + apik
         app.logger.debug("API key connecting: {x}".format(x=apik))
-        res = models.Account.query(q='api_key:"' + apik + '"')['hits']['hits']
-        if len(res) == 1:
-            user = models.Account.pull(res[0]['_source']['id'])
-            if user is not None:
-                login_user(user, remember=False)
-            else:
-                abort(401)
+        user = models.Account.pull_by_api_key(apik)
+        if user is not None:
+            login_user(user, remember=False)
         else:
             abort(401)
     else:
@@ -207,10 +205,10 @@ def retrieve_notification(notification_id):
     :param notification_id: the id of the notification to retrieve
     :return: 404 (Not Found) if not found, else 200 (OK) and the outgoing notification as a json body
     """
-    notification = JPER.get_notification(current_user, notification_id)
+    notification = JPER.get_notification_json(current_user, notification_id)
     if notification is None:
         return _not_found()
-    resp = make_response(notification.json())
+    resp = make_response(notification)
     resp.mimetype = "application/json"
     resp.status_code = 200
     return resp
@@ -225,7 +223,8 @@ def retrieve_content(notification_id, filename=None):
 
     :param notification_id: the notification whose content to retrieve
     :param filename: the filename of the content file in the notification
-    :return: 404 (Not Found) if either the notification or content are not found) or 200 (OK) and the binary content
+    :return: 404 (Not Found) if either the notification or content are not found) or 200 (OK) and the binary content,
+        or 206 (Partial Content), 304 (Not Modified) or 416 (Range Not Satisfiable) in answer to range or conditional requests
     """
     app.logger.debug("{x} {y} content requested".format(x=notification_id, y=filename))
     if filename is None:
@@ -235,9 +234,14 @@ def retrieve_content(notification_id, filename=None):
 
     nt = None
     try:
-        filestream = JPER.get_content(current_user, notification_id, filename)
-        nt = models.ContentLog({"user":current_user.id,"notification":notification_id,"filename":fn,"delivered_from":"store"})
-        return Response(stream_with_context(filestream))
+        sc = JPER.get_stored_content(current_user, notification_id, filename)
+        if sc is None:
+            nt = models.ContentLog({"user":current_user.id,"notification":notification_id,"filename":fn,"delivered_from":"notfound"})
+            return _not_found()
+        resp = _send_content(sc)
+        if _delivers_content(resp):
+            nt = models.ContentLog({"user":current_user.id,"notification":notification_id,"filename":fn,"delivered_from":"store"})
+        return resp
     except UnauthorisedException as e:
         nt = models.ContentLog({"user":current_user.id,"notification":notification_id,"filename":fn,"delivered_from":"unauthorised"})
         return _unauthorised()
@@ -246,7 +250,90 @@ def retrieve_content(notification_id, filename=None):
         return _not_found()
     finally:
         if nt is not None:
-            nt.save()
+            nt.queue()
+
+def _send_content(sc):
+    """
+    Construct a response which delivers stored content.  Where the store can describe the content, the response
+    carries its length and validators, answers conditional requests with 304 (Not Modified), and serves a single
+    byte range if one is asked for.
+
+    :param sc: content.StoredContent to deliver
+    :return: Flask response
+    """
+    mimetype = mimetypes.guess_type(sc.filename)[0] or "application/octet-stream"
+
+    # files on the local filesystem are handed to nginx to send (including ranges and validators), so that slow
+    # downloads don't hold up a worker.  Conditional requests are answered here first, so that only responses which
+    # nginx will send in full are handed to it (and logged as deliveries); nginx makes its own etag from the
+    # modification time and size, so a client may hold either that or ours
+    accel = sc.accel_redirect
+    if accel is not None:
+        nginx_etag = "{a:x}-{b:x}".format(a=sc.last_modified, b=sc.size)
+        if _not_modified(sc, [sc.etag, nginx_etag]):
+            return Response(status=304, headers={"ETag" : quote_etag(nginx_etag), "Last-Modified" : http_date(sc.last_modified)})
+        resp = Response("", mimetype=mimetype)
+        resp.headers["X-Accel-Redirect"] = accel
+        return resp
+
+    etag = sc.etag
+    if etag is None:
+        return Response(stream_with_context(sc.stream()), mimetype=mimetype)
+
+    headers = {
+        "ETag" : quote_etag(etag),
+        "Last-Modified" : http_date(sc.last_modified),
+        "Accept-Ranges" : "bytes"
+    }
+    if _not_modified(sc, [etag]):
+        return Response(status=304, headers=headers)
+
+    start, end, status = 0, sc.size, 200
+    rng = request.range
+    if_range = request.headers.get("If-Range")
+    if rng is not None and rng.units == "bytes" and len(rng.ranges) == 1 and (if_range is None or if_range in [headers["ETag"], headers["Last-Modified"]]):
+        span = rng.range_for_length(sc.size)
+        if span is None:
+            headers["Content-Range"] = "bytes */{x}".format(x=sc.size)
+            return Response(status=416, headers=headers)
+        start, end = span
+        status = 206
+        headers["Content-Range"] = "bytes {a}-{b}/{c}".format(a=start, b=end - 1, c=sc.size)
+
+    headers["Content-Length"] = str(end - start)
+    return Response(stream_with_context(sc.stream(start, end)), status=status, headers=headers, mimetype=mimetype)
+
+def _not_modified(sc, etags):
+    """
+    Whether the request is conditional, and the client's copy of the content is still current
+
+    :param sc: content.StoredContent being requested, whose size and modification time are known
+    :param etags: the (unquoted) etags the content may be known by
+    :return: True if the request should be answered with 304 (Not Modified)
+    """
+    last_modified = datetime.utcfromtimestamp(sc.last_modified)
+    return any([not is_resource_modified(request.environ, etag=e, last_modified=last_modified) for e in etags])
+
+def _delivers_content(resp):
+    """
+    Whether a content response counts as a delivery of the content, for the content log.  A download made in several
+    ranged requests is counted once, by the request for its first range; 304 (Not Modified) and 416 (Range Not
+    Satisfiable) responses deliver nothing.
+
+    :param resp: the response from _send_content
+    :return: True if the response should be logged as a delivery
+    """
+    if resp.status_code == 206:
+        return resp.headers.get("Content-Range", "").startswith("bytes 0-")
+    if resp.status_code != 200:
+        return False
+    # nginx answers the range requests for content it is sent to serve, so go by the request (conditional requests
+    # which it would answer with 304 have already been answered by _send_content)
+    if resp.headers.get("X-Accel-Redirect") is not None:
+        rng = request.range
+        if rng is not None and rng.units == "bytes" and len(rng.ranges) == 1 and rng.ranges[0][0] not in [0, None]:
+            return False
+    return True
 
 @blueprint.route("/notification/<notification_id>/proxy/<pid>", methods=["GET"])
 def proxy_content(notification_id, pid):
@@ -254,11 +341,11 @@ def proxy_content(notification_id, pid):
     purl = JPER.get_proxy_url(current_user, notification_id, pid)
     if purl is not None:
         nt = models.ContentLog({"user":current_user.id,"notification":notification_id,"filename":pid,"delivered_from":"proxy"})
-        nt.save()
+        nt.queue()
         return redirect(purl)
     else:
         nt = models.ContentLog({"user":current_user.id,"notification":notification_id,"filename":pid,"delivered_from":"notfound"})
-        nt.save()
+        nt.queue()
         return _not_found()
 
 def _list_request(repo_id=None):
@@ -274,19 +361,24 @@ def _list_request(repo_id=None):
     since = request.values.get("since")
     page = request.values.get("page", app.config.get("DEFAULT_LIST_PAGE_START", 1))
     page_size = request.values.get("pageSize", app.config.get("DEFAULT_LIST_PAGE_SIZE", 25))
+    cursor = request.values.get("next")
+    if cursor == "":
+        cursor = None
 
-    if since is None or since == "":
-        return _bad_request("Missing required parameter 'since'")
+    # the next cursor carries the since date with it, and replaces the page number
+    if cursor is None:
+        if since is None or since == "":
+            return _bad_request("Missing required parameter 'since'")
 
-    try:
-        since = dates.reformat(since)
-    except ValueError as e:
-        return _bad_request("Unable to understand since date '{x}'".format(x=since))
+        try:
+            since = dates.reformat(since)
+        except ValueError as e:
+            return _bad_request("Unable to understand since date '{x}'".format(x=since))
 
-    try:
-        page = int(page)
-    except:
-        return _bad_request("'page' parameter is not an integer")
+        try:
+            page = int(page)
+        except:
+            return _bad_request("'page' parameter is not an integer")
 
     try:
         page_size = int(page_size)
@@ -294,7 +386,7 @@ def _list_request(repo_id=None):
         return _bad_request("'pageSize' parameter is not an integer")
 
     try:
-        nlist = JPER.list_notifications(current_user, since, page=page, page_size=page_size, repository_id=repo_id)
+        nlist = JPER.list_notifications(current_user, since, page=page, page_size=page_size, repository_id=repo_id, cursor=cursor)
     except ParameterException as e:
         return _bad_request(e.message)
 
@@ -330,6 +422,56 @@ def list_repository_routed(repo_id):
     """
     return _list_request(repo_id)
 
+@blueprint.route("/reports/delivery", methods=["GET"])
+@webapp.jsonp
+def delivery_statistics():
+    """
+    Get the number of notifications delivered to repositories each month, from the delivery counters.
+
+    Admins get the counts for all repositories, and the unique counts; repositories get only their own counts.
+
+    :return: 400 (Bad Request) if the from and to months are not given as YYYY-MM, or 200 (OK) and the counts as a json body
+    """
+    if current_user.has_role('admin'):
+        repo_id = request.values.get("repository")
+    elif current_user.has_role('repository'):
+        repo_id = current_user.id
+    else:
+        abort(401)
+
+    frm = request.values.get("from")
+    to = request.values.get("to")
+    if frm is None or to is None:
+        return _bad_request("Missing required parameters 'from' and 'to'")
+
+    try:
+        stats = reports.delivery_statistics(frm, to, repository=repo_id)
+    except ValueError:
+        return _bad_request("'from' and 'to' must be months, as YYYY-MM")
+
+    resp = make_response(json.dumps(stats))
+    resp.mimetype = "application/json"
+    resp.status_code = 200
+    return resp
+
+@blueprint.route("/stats", methods=["GET"])
+@webapp.jsonp
+def stats():
+    """
+    Get this process's internal counters, for monitoring.  Admin only.
+
+    :return: 200 (OK) and the counters as a json body
+    """
+    if not current_user.has_role('admin'):
+        abort(401)
+    resp = make_response(json.dumps({
+        "api_key_cache" : models.Account.api_key_cache_stats(),
+        "content_log" : models.contentlog.buffer.stats
+    }))
+    resp.mimetype = "application/json"
+    resp.status_code = 200
+    return resp
+
 @blueprint.route("/config", methods=["GET","POST"])
 @blueprint.route("/config/<repoid>", methods=["GET","POST"])
 @webapp.jsonp
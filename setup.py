@@ -7,7 +7,9 @@ setup(
     install_requires = [
         "octopus==1.0.0",
         "esprit",
-        "schedule==0.3.2"
+        "schedule==0.3.2",
+        # inotify is Linux only; elsewhere FTP deposits are picked up by the scheduled polling (see service/ftpwatch.py)
+        'pyinotify; platform_system == "Linux"'
     ],
     url = 'http://cottagelabs.com/',
     author = 'Cottage Labs',